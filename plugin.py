@@ -202,7 +202,7 @@ class Plugin(QObject):
         uri = QgsDataSourceUri(layer.source())
         con = psycopg2.connect(self.get_conn_from_uri(uri))
         cur = con.cursor()
-        cur.execute("""SELECT table_name FROM information_schema.tables WHERE table_schema = '{schema}' and table_name='wcs_con'""".format(
+        cur.execute("""SELECT relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE nspname = '{schema}' and relname='wcs_con'""".format(
             schema=uri.schema()))
         res = cur.fetchone()
 
@@ -1106,7 +1106,7 @@ class Plugin(QObject):
         conn = psycopg2.connect(pg_conn_info_out)
         cur = conn.cursor()
 
-        cur.execute("SELECT schema_name FROM information_schema.schemata WHERE schema_name in ('{}', '{}');".format(
+        cur.execute("SELECT nspname FROM pg_namespace WHERE nspname in ('{}', '{}');".format(
             schema, schemaShort))
         a = cur.fetchall()
         if len(a) > 0:
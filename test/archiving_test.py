@@ -96,7 +96,27 @@ def test(host, pguser):
     [ret] = pcur.fetchone()
     assert(ret == 11)
     
-    versioning.archive(pg_conn_info, 'epanet', 7)
+    # an archive interrupted after its first batch resumes where it stopped
+    def interrupt(table, moved, total):
+        raise KeyboardInterrupt
+    try:
+        versioning.archive(pg_conn_info, 'epanet', 7, batch_size=1,
+                           progress=interrupt)
+        assert(False)
+    except KeyboardInterrupt:
+        pass
+    pcur.execute("SELECT table_name, revision_end, last_rev_end, last_pk "
+                 "FROM epanet_archive.archive_progress")
+    assert(pcur.fetchall() == [('pipes', 7, 5, 5)])
+    pcur.execute("SELECT versioning_id FROM epanet_archive.pipes")
+    assert(pcur.fetchall() == [(5,)])
+
+    calls = []
+    versioning.archive(pg_conn_info, 'epanet', 7, batch_size=1,
+                       progress=lambda *args: calls.append(args))
+    assert(calls == [('pipes', 1, 1)])
+    pcur.execute("SELECT COUNT(*) FROM epanet_archive.archive_progress")
+    assert(pcur.fetchone()[0] == 0)
     printTab(pcur, 'epanet', 'pipes')
     pcur.execute("SELECT count(*) FROM epanet.pipes")
     [ret] = pcur.fetchone()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Time the versioning operations on a generated versioned schema
+
+The versioning_benchmark_db database is (re)created with a bench schema
+holding --tables tables of --rows points, versioned with --branches
+branches and --revisions revisions. historize, add_branch, checkout,
+commit, update, diff_rev_view_str, merge and archive are then timed, the
+working copy operations for each backend, and the results are written as
+JSON to --output or to the standard output.
+
+Two working copies are checked out for each backend, each one edits
+--edits of the rows of every table, --conflicts of these edits are on the
+same rows and conflict when the second working copy is updated.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from sqlite3 import dbapi2
+
+import psycopg2
+from versioningDB import versioning
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DBNAME = "versioning_benchmark_db"
+WC_DBNAME = "versioning_benchmark_wc_db"
+SCHEMA = "bench"
+BACKENDS = ['spatialite', 'pgServer', 'pgLocal']
+
+
+def max_rss():
+    """peak resident memory of the process in kB"""
+    if not resource:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Benchmark:
+
+    def __init__(self, host, pguser, args):
+        self.host = host
+        self.pguser = pguser
+        self.args = args
+        self.pg_conn_info = "dbname={} host={} user={}".format(
+            DBNAME, host, pguser)
+        self.pg_conn_info_wc = "dbname={} host={} user={}".format(
+            WC_DBNAME, host, pguser)
+        self.tables = ["layer_{}".format(i) for i in range(args.tables)]
+        self.results = []
+
+    def timed(self, backend, operation, function, *args, **kwargs):
+        """call function and record its duration"""
+        start = time.perf_counter()
+        ret = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append({'backend': backend,
+                             'operation': operation,
+                             'seconds': round(seconds, 6),
+                             'max_rss_kb': max_rss()})
+        if self.args.verbose:
+            sys.stderr.write("{} {} {:.3f}s\n".format(
+                backend, operation, seconds))
+        return ret
+
+    def createdb(self, dbname):
+        os.system("dropdb --if-exists -h {} -U {} {}".format(
+            self.host, self.pguser, dbname))
+        os.system("createdb -h {} -U {} {}".format(
+            self.host, self.pguser, dbname))
+        os.system("psql -h {} -U {} {} -c 'CREATE EXTENSION postgis'".format(
+            self.host, self.pguser, dbname))
+
+    def edit(self, cur, prefix, first, last):
+        """modify the features with id between first and last of every
+        table of a working copy, prefix is the working copy schema"""
+        for table in self.tables:
+            cur.execute("UPDATE {}{}_view SET value = value + 1 "
+                        "WHERE id BETWEEN {} AND {}".format(
+                            prefix, table, first, last))
+        cur.commit()
+
+    def generate(self):
+        """create the versioned schema"""
+        rows = self.args.rows
+        self.createdb(DBNAME)
+        pcur = versioning.Db(psycopg2.connect(self.pg_conn_info))
+        pcur.execute("CREATE SCHEMA " + SCHEMA)
+        for table in self.tables:
+            pcur.execute("""
+            CREATE TABLE {schema}.{table} (
+            id serial PRIMARY KEY,
+            value float,
+            label varchar,
+            geom geometry('POINT', 2154))""".format(
+                schema=SCHEMA, table=table))
+            pcur.execute("""
+            INSERT INTO {schema}.{table} (value, label, geom)
+            SELECT g, 'feature ' || g,
+            ST_SetSRID(ST_MakePoint(g % 1000, g / 1000), 2154)
+            FROM generate_series(1, {rows}) AS g""".format(
+                schema=SCHEMA, table=table, rows=rows))
+        pcur.commit()
+
+        self.timed('pg', 'historize', versioning.historize,
+                   self.pg_conn_info, SCHEMA)
+        for i in range(1, self.args.branches):
+            self.timed('pg', 'add_branch', versioning.add_branch,
+                       self.pg_conn_info, SCHEMA, "branch{}".format(i),
+                       "benchmark branch")
+
+        # history, each revision modifies a slice of the features
+        depth = self.args.revisions - 1
+        if depth > 0:
+            wcs = SCHEMA + "_history_wc"
+            with versioning.pgServer(self.pg_conn_info, wcs) as wc:
+                wc.checkout(["{}_trunk_rev_head.{}".format(SCHEMA, table)
+                             for table in self.tables])
+                step = max(1, rows // depth)
+                for r in range(depth):
+                    self.edit(pcur, wcs + ".", r*step + 1, (r + 1)*step)
+                    wc.commit("benchmark revision {}".format(r))
+
+        # changes to merge
+        if self.args.branches > 1:
+            wcs = SCHEMA + "_branch_wc"
+            with versioning.pgServer(self.pg_conn_info, wcs) as wc:
+                wc.checkout(["{}_branch1_rev_head.{}".format(SCHEMA, table)
+                             for table in self.tables])
+                self.edit(pcur, wcs + ".", 1, self.edits())
+                wc.commit("benchmark branch edits")
+        pcur.close()
+
+    def edits(self):
+        """number of features modified by a working copy in each table"""
+        return max(1, int(self.args.rows * self.args.edits))
+
+    def working_copy(self, backend, name):
+        """return a versioning object, the working copy cursor and the
+        working copy schema prefix of table names"""
+        if backend == 'spatialite':
+            filename = os.path.join(tempfile.gettempdir(),
+                                    "benchmark_{}.sqlite".format(name))
+            if os.path.isfile(filename):
+                os.remove(filename)
+            wc = versioning.spatialite(filename, self.pg_conn_info)
+            return wc, lambda: versioning.Db(dbapi2.connect(filename)), ""
+
+        wcs = "{}_wc_{}".format(SCHEMA, name)
+        if backend == 'pgServer':
+            wc = versioning.pgServer(self.pg_conn_info, wcs)
+            pg_conn_info = self.pg_conn_info
+        else:
+            wc = versioning.pgLocal(self.pg_conn_info, wcs,
+                                    self.pg_conn_info_wc)
+            pg_conn_info = self.pg_conn_info_wc
+        return (wc, lambda: versioning.Db(psycopg2.connect(pg_conn_info)),
+                wcs + ".")
+
+    def run_backend(self, backend):
+        tables = ["{}_trunk_rev_head.{}".format(SCHEMA, table)
+                  for table in self.tables]
+        if backend == 'pgLocal':
+            self.createdb(WC_DBNAME)
+
+        wc_a, connect_a, prefix_a = self.working_copy(backend, 'a')
+        wc_b, connect_b, prefix_b = self.working_copy(backend, 'b')
+        self.timed(backend, 'checkout', wc_a.checkout, tables)
+        wc_b.checkout(tables)
+
+        edits = self.edits()
+        overlap = int(edits * self.args.conflicts)
+
+        cur = connect_b()
+        self.edit(cur, prefix_b, 1, edits)
+        cur.close()
+        self.timed(backend, 'commit', wc_b.commit, "benchmark commit")
+
+        cur = connect_a()
+        self.edit(cur, prefix_a, edits - overlap + 1, 2*edits - overlap)
+        self.timed(backend, 'late', wc_a.late)
+        self.timed(backend, 'update', wc_a.update)
+
+        # keep our version of the conflicting features
+        conflicts = 0
+        for table in self.tables:
+            cur.execute("SELECT COUNT(*) FROM {}{}_conflicts "
+                        "WHERE origin = 'theirs'".format(prefix_a, table))
+            conflicts += cur.fetchone()[0]
+            cur.execute("DELETE FROM {}{}_conflicts "
+                        "WHERE origin = 'theirs'".format(prefix_a, table))
+        cur.commit()
+        cur.close()
+        self.results[-1]['conflicts'] = conflicts
+
+        self.timed(backend, 'commit_after_update', wc_a.commit,
+                   "benchmark commit after update")
+        wc_a.close()
+        wc_b.close()
+
+    def run_history(self):
+        pcur = versioning.Db(psycopg2.connect(self.pg_conn_info))
+        pcur.execute("SELECT MAX(rev) FROM {}.revisions".format(SCHEMA))
+        [max_rev] = pcur.fetchone()
+
+        def diff(table):
+            sql = versioning.diff_rev_view_str(
+                self.pg_conn_info, SCHEMA, table, 'trunk', 1, max_rev)
+            pcur.execute("SELECT COUNT(*) FROM ({}) AS diff".format(sql))
+            return pcur.fetchone()[0]
+
+        for table in self.tables:
+            self.timed('pg', 'diff_rev_view_str', diff, table)
+        pcur.close()
+
+        if self.args.branches > 1:
+            self.timed('pg', 'merge', versioning.merge,
+                       self.pg_conn_info, SCHEMA, 'branch1')
+
+        self.timed('pg', 'archive', versioning.archive,
+                   self.pg_conn_info, SCHEMA, max(1, max_rev // 2))
+
+    def run(self):
+        self.generate()
+        for backend in self.args.backends:
+            self.run_backend(backend)
+        self.run_history()
+
+        pcur = versioning.Db(psycopg2.connect(self.pg_conn_info))
+        pcur.execute("SHOW server_version")
+        [server_version] = pcur.fetchone()
+        pcur.close()
+
+        parameters = vars(self.args).copy()
+        del parameters['output']
+        del parameters['verbose']
+        return {'date': datetime.now().isoformat(),
+                'parameters': parameters,
+                'environment': {'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'postgres': server_version},
+                'results': self.results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('host')
+    parser.add_argument('pguser')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help="features per table")
+    parser.add_argument('--tables', type=int, default=2)
+    parser.add_argument('--branches', type=int, default=2,
+                        help="number of branches, trunk included")
+    parser.add_argument('--revisions', type=int, default=10,
+                        help="revisions created before the benchmark")
+    parser.add_argument('--edits', type=float, default=0.01,
+                        help="fraction of the features modified by a "
+                        "working copy")
+    parser.add_argument('--conflicts', type=float, default=0.1,
+                        help="fraction of the edits in conflict")
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS,
+                        default=BACKENDS)
+    parser.add_argument('--output', help="JSON result file")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print durations on the error output")
+    args = parser.parse_args()
+
+    result = Benchmark(args.host, args.pguser, args).run()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
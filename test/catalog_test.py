@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -c 'CREATE EXTENSION postgis'")
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("CREATE SCHEMA cat")
+    pcur.execute("CREATE TYPE cat.status AS ENUM ('on', 'off')")
+    pcur.execute("CREATE DOMAIN cat.label AS varchar(12)")
+    pcur.execute("""
+    CREATE TABLE cat.features (
+    id serial PRIMARY KEY,
+    code char(3),
+    name varchar(10),
+    comment text,
+    label cat.label,
+    status cat.status,
+    measures float[],
+    tags varchar[],
+    uid uuid,
+    created timestamp without time zone,
+    geom geometry('POINT', 2154))""")
+    pcur.execute("ALTER TABLE cat.features DROP COLUMN comment")
+    pcur.execute("CREATE VIEW cat.features_view AS SELECT * FROM cat.features")
+    pcur.commit()
+
+    # same values as information_schema
+    for table in ['features', 'features_view']:
+        pcur.execute("""
+        SELECT c.column_name, c.data_type, c.udt_name,
+        c.character_maximum_length, e.data_type
+        FROM information_schema.columns c
+        LEFT JOIN information_schema.element_types e
+        ON ((c.table_catalog, c.table_schema, c.table_name,
+        'TABLE', c.dtd_identifier)
+        = (e.object_catalog, e.object_schema, e.object_name,
+        e.object_type, e.collection_type_identifier))
+        WHERE c.table_schema = 'cat' AND c.table_name = '"""+table+"""'
+        ORDER BY c.ordinal_position""")
+        expected = pcur.fetchall()
+        assert(versioning.pg_columns(pcur, 'cat', table) == expected)
+        assert(versioning.pg_column_names(pcur, 'cat', table)
+               == [col for col, _, _, _, _ in expected])
+
+    assert(versioning.pg_user_defined_type(pcur, 'cat', 'features', 'status')
+           == 'status')
+    assert(versioning.pg_array_elem_type(pcur, 'cat', 'features', 'tags')
+           == 'character varying')
+    assert(versioning.pg_array_elem_type(pcur, 'cat', 'features', 'name')
+           is None)
+
+    pcur.execute("SELECT table_name, table_type FROM information_schema.tables "
+                 "WHERE table_schema = 'cat' ORDER BY table_name")
+    tables = pcur.fetchall()
+    assert(versioning.pg_tables(pcur, 'cat') == [t for t, _ in tables])
+    assert(versioning.pg_tables(pcur, 'cat', base_tables=True)
+           == [t for t, kind in tables if kind == 'BASE TABLE'])
+    assert(versioning.pg_tables(pcur, 'cat', like='%_view')
+           == ['features_view'])
+
+    assert(versioning.pg_schema_exists(pcur, 'cat'))
+    assert(not versioning.pg_schema_exists(pcur, 'cat_trunk_rev_head'))
+
+    # the cached metadata of a versioned schema is the same
+    pcur.execute("DROP VIEW cat.features_view")
+    pcur.commit()
+    versioning.historize(pg_conn_info, 'cat')
+    pcur.close()
+    pool = versioning.ConnectionPool()
+    cur = pool.connect(pg_conn_info)
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    assert(versioning.pg_columns(cur, 'cat', 'features')
+           == versioning.pg_columns(pcur, 'cat', 'features'))
+    cur.close()
+    pcur.close()
+    pool.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 catalog_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from sqlite3 import dbapi2
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+    tmp_dir = tempfile.gettempdir()
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    wc = [os.path.join(tmp_dir, "conflict_chain_wc0.sqlite"),
+          os.path.join(tmp_dir, "conflict_chain_wc1.sqlite")]
+    spversioning = []
+    for f in wc:
+        if os.path.isfile(f):
+            os.remove(f)
+        spversioning.append(versioning.spatialite(f, pg_conn_info))
+        spversioning[-1].checkout(['epanet_trunk_rev_head.junctions'])
+
+    scur = [versioning.Db(dbapi2.connect(f)) for f in wc]
+
+    # three successive modifications of the same junction
+    for elevation in [1, 2, 3]:
+        scur[0].execute("UPDATE junctions_view SET elevation = {} "
+                        "WHERE id = 2".format(elevation))
+        scur[0].commit()
+        spversioning[0].commit("elevation {}".format(elevation))
+    # and a concurrent one
+    scur[1].execute("UPDATE junctions_view SET elevation = 10 WHERE id = 2")
+    scur[1].commit()
+
+    late_by, layers, revisions = spversioning[1].late(detail=True)
+    assert(late_by == 3 and spversioning[1].late() == 3)
+    assert(layers == {('epanet', 'junctions'): 3})
+    assert([(schema, rev, msg) for schema, rev, branch, msg, date, author
+            in revisions] == [('epanet', 2, 'elevation 1'),
+                              ('epanet', 3, 'elevation 2'),
+                              ('epanet', 4, 'elevation 3')])
+
+    spversioning[1].update()
+
+    # theirs is the last version of the chain
+    scur[1].execute("SELECT origin, action, elevation FROM junctions_conflicts "
+                    "ORDER BY origin")
+    assert(scur[1].fetchall() == [('mine', 'modified', 10.),
+                                  ('theirs', 'modified', 3.)])
+
+    # the last version of the chain is a deletion
+    scur[1].execute("DELETE FROM junctions_conflicts WHERE origin = 'theirs'")
+    scur[1].commit()
+    spversioning[1].commit("elevation 10")
+    spversioning[0].update()
+    for elevation in [4, 5]:
+        scur[0].execute("UPDATE junctions_view SET elevation = {} "
+                        "WHERE id = 2".format(elevation))
+        scur[0].commit()
+        spversioning[0].commit("elevation {}".format(elevation))
+    scur[0].execute("DELETE FROM junctions_view WHERE id = 2")
+    scur[0].commit()
+    spversioning[0].commit("delete")
+
+    scur[1].execute("UPDATE junctions_view SET elevation = 11 WHERE id = 2")
+    scur[1].commit()
+    spversioning[1].update()
+    scur[1].execute("SELECT origin, action FROM junctions_conflicts "
+                    "ORDER BY origin")
+    assert(scur[1].fetchall() == [('mine', 'modified'),
+                                  ('theirs', 'deleted')])
+
+    for cur in scur:
+        cur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 conflict_chain_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
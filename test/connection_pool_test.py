@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning, utils
+import psycopg2
+import os
+import time
+
+
+def backends(pcur):
+    """number of connections to the test database, ours excepted"""
+    pcur.execute("SELECT COUNT(*) FROM pg_stat_activity "
+                 "WHERE datname = 'epanet_test_db' "
+                 "AND pid != pg_backend_pid()")
+    [count] = pcur.fetchone()
+    return count
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+
+    # a released connection is reused and left without pending transaction
+    pool = versioning.ConnectionPool()
+    cur = pool.connect(pg_conn_info)
+    con = cur.con
+    cur.execute("CREATE TABLE epanet.pool_rollback (id integer)")
+    cur.close()
+    cur = pool.connect(pg_conn_info)
+    assert(cur.con is con)
+    cur.execute("SELECT to_regclass('epanet.pool_rollback')")
+    assert(cur.fetchone()[0] is None)
+    cur.close()
+
+    versioning.historize(pg_conn_info, 'epanet', pool=pool)
+    assert(versioning.revisions(pg_conn_info, 'epanet', pool=pool) == [1])
+    assert(backends(pcur) == 1)
+    pool.close()
+    assert(backends(pcur) == 0)
+
+    # all operations of a working copy share the connections of its pool
+    tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+    with versioning.pgServer(pg_conn_info, 'epanet_working_copy') as wc:
+        wc.checkout(tables)
+        assert(backends(pcur) == 1)
+        pcur.execute("UPDATE epanet_working_copy.pipes_view "
+                     "SET length = 4 WHERE versioning_id = 1")
+        pcur.commit()
+        assert(wc.commit('pooled commit') == 1)
+        assert(list(wc.ver.last_commit_timings) == ['pipes'])
+        wc.revision()
+        wc.late()
+        assert(versioning.revisions(pg_conn_info, 'epanet',
+                                    pool=wc.pool) == [1, 2])
+        assert(backends(pcur) == 1)
+    assert(backends(pcur) == 0)
+
+    # cached catalog metadata matches the catalog queries
+    pool = versioning.ConnectionPool()
+    cur = pool.connect(pg_conn_info)
+    for table in ['junctions', 'pipes']:
+        assert(versioning.pg_pk(cur, 'epanet', table)
+               == versioning.pg_pk(pcur, 'epanet', table))
+        assert(versioning.pg_geoms(cur, 'epanet', table)
+               == versioning.pg_geoms(pcur, 'epanet', table))
+        assert(sorted(versioning.pg_column_names(cur, 'epanet', table))
+               == sorted(versioning.pg_column_names(pcur, 'epanet', table)))
+    assert(versioning.pg_branches(cur, 'epanet') == ['trunk'])
+    cur.close()
+
+    # and is invalidated when a branch is added
+    versioning.add_branch(pg_conn_info, 'epanet', 'mybranch', 'add branch',
+                          pool=pool)
+    cur = pool.connect(pg_conn_info)
+    assert(sorted(versioning.pg_branches(cur, 'epanet'))
+           == ['mybranch', 'trunk'])
+    assert('mybranch_rev_begin'
+           in versioning.pg_column_names(cur, 'epanet', 'junctions'))
+    cur.close()
+
+    # a branch added by another connection is seen once the cached schema
+    # is checked again
+    versioning.add_branch(pg_conn_info, 'epanet', 'otherbranch',
+                          'add branch')
+    cur = pool.connect(pg_conn_info)
+    time.sleep(utils.CATALOG_CHECK_SECONDS)
+    assert(sorted(versioning.pg_branches(cur, 'epanet'))
+           == ['mybranch', 'otherbranch', 'trunk'])
+    cur.close()
+    pool.close()
+
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 connection_pool_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -341,8 +341,24 @@ class BaseTest:
         self.commit_and_check([("referenced", 3), ("referencing", 2)])
 
 
+    def test_indexes(self):
+
+        # constraints checks are backed by working copy indexes
+        self.cur.execute(self.sql_indexes)
+        names = sorted(name for [name] in self.cur.fetchall())
+        assert(names == ["{}_id1_id2_idx".format(self.referenced),
+                         "{}_fkid1_fkid2_idx".format(self.referencing),
+                         "{}_id_idx".format(self.referencing)]), names
+
+
 class SpatialiteTest(BaseTest):
 
+    referencing = "referencing"
+    referenced = "referenced"
+    sql_indexes = """SELECT name FROM sqlite_master WHERE type = 'index'
+    AND name LIKE '%\\_idx' ESCAPE '\\'
+    AND tbl_name IN ('referencing', 'referenced')"""
+
     def __init__(self, host, pguser, additional_sql=None):
 
         super().__init__(host, pguser, "main", additional_sql)
@@ -370,6 +386,11 @@ class SpatialiteTest(BaseTest):
 
 class PgServerTest(BaseTest):
 
+    referencing = "referencing_diff"
+    referenced = "referenced_diff"
+    sql_indexes = """SELECT indexname FROM pg_indexes
+    WHERE schemaname = 'myschema_workingcopy' AND indexname LIKE '%\\_idx'"""
+
     def __init__(self, host, pguser, additional_sql=None):
 
         wc_schema = "myschema_workingcopy"
@@ -386,6 +407,10 @@ class PgServerTest(BaseTest):
 
 class PgLocalTest(BaseTest):
 
+    referencing = "referencing"
+    referenced = "referenced"
+    sql_indexes = PgServerTest.sql_indexes
+
     def __init__(self, host, pguser, additional_sql=None):
 
         wc_schema = "myschema_workingcopy"
@@ -419,6 +444,7 @@ def test(host, pguser):
 
         test = test_class(host, pguser)
         test.test_insert()
+        test.test_indexes()
         del test
 
         test = test_class(host, pguser)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from versioningDB.transfer import StreamTransfer
+from sqlite3 import dbapi2
+import psycopg2
+import os
+import tempfile
+
+
+class RecordingTransfer(StreamTransfer):
+    """Stream engine recording the tables copied to the base database"""
+
+    def __init__(self):
+        self.copied = []
+
+    def sqlite_to_pg(self, sqlite_filename, scur, source, pg_conn_info, pcur,
+                     dest, fid, geometry_name=''):
+        self.copied.append(dest)
+        StreamTransfer.sqlite_to_pg(self, sqlite_filename, scur, source,
+                                    pg_conn_info, pcur, dest, fid,
+                                    geometry_name)
+
+    def pg_to_pg(self, pg_conn_info, pcur, source, pg_conn_info_copy,
+                 pcurcpy, dest, fid, geometry_name='', spatial_index=True,
+                 dest_fid='ogc_fid'):
+        self.copied.append(dest)
+        StreamTransfer.pg_to_pg(self, pg_conn_info, pcur, source,
+                                pg_conn_info_copy, pcurcpy, dest, fid,
+                                geometry_name, spatial_index, dest_fid)
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    pg_conn_info_cpy = ("dbname=epanet_test_copy_db host=" + host
+                        + " user=" + pguser)
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+    tmp_dir = tempfile.gettempdir()
+    sqlite_test_filename = os.path.join(tmp_dir, "delta_commit_test.sqlite")
+    if os.path.isfile(sqlite_test_filename):
+        os.remove(sqlite_test_filename)
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_copy_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_copy_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+
+    def head_lengths():
+        pcur.execute("SELECT length FROM epanet_trunk_rev_head.pipes "
+                     "ORDER BY id")
+        return [length for [length] in pcur.fetchall()]
+
+    def staging_schemas():
+        pcur.execute("SELECT COUNT(*) FROM pg_namespace "
+                     "WHERE nspname LIKE '%_diff'")
+        return pcur.fetchone()[0]
+
+    # spatialite working copy
+    spversioning = versioning.spatialite(sqlite_test_filename, pg_conn_info)
+    spversioning.checkout(tables)
+    recorder = RecordingTransfer()
+    spversioning.ver.transfer = recorder
+
+    def sp_execute(sql=None):
+        scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+        if sql:
+            scur.execute(sql)
+            scur.commit()
+        scur.execute("SELECT table_name, changes FROM initial_revision "
+                     "ORDER BY table_name")
+        changes = scur.fetchall()
+        scur.close()
+        return changes
+
+    # nothing edited, nothing sent
+    assert(sp_execute() == [('junctions', 0), ('pipes', 0)])
+    assert(spversioning.commit("nothing") == 0)
+    assert(recorder.copied == [])
+    assert(staging_schemas() == 0)
+
+    # only the edited table is sent
+    assert(sp_execute("UPDATE pipes_view SET length = 4")
+           == [('junctions', 0), ('pipes', 1)])
+    assert(spversioning.commit("rev 2") == 1)
+    assert(recorder.copied == ['epanet_trunk_1_to_2_diff.epanet_pipes_diff'])
+    assert(staging_schemas() == 0)
+    assert(head_lengths() == [4.])
+    assert(sp_execute() == [('junctions', 0), ('pipes', 0)])
+    assert(spversioning.revision() == 3)
+
+    # edits undone leave an empty diff, nothing is sent
+    del recorder.copied[:]
+    sp_execute("INSERT INTO pipes_view(id, start_node, end_node, geom) "
+               "VALUES (2, 1, 2, GeomFromText('LINESTRING(1 1,0 1)', 2154))")
+    assert(sp_execute("DELETE FROM pipes_view WHERE id = 2")
+           == [('junctions', 0), ('pipes', 2)])
+    assert(spversioning.commit("undone") == 0)
+    assert(recorder.copied == [])
+    assert(sp_execute() == [('junctions', 0), ('pipes', 0)])
+
+    # postgres working copy in another database
+    pgversioning = versioning.pgLocal(pg_conn_info, 'epanet_working_copy',
+                                      pg_conn_info_cpy)
+    pgversioning.checkout(tables)
+    recorder = RecordingTransfer()
+    pgversioning.ver.transfer = recorder
+    pcurcpy = versioning.Db(psycopg2.connect(pg_conn_info_cpy))
+
+    def pg_execute(sql=None):
+        if sql:
+            pcurcpy.execute(sql)
+        pcurcpy.execute("SELECT table_name, changes "
+                        "FROM epanet_working_copy.initial_revision "
+                        "ORDER BY table_name")
+        changes = pcurcpy.fetchall()
+        pcurcpy.commit()
+        return changes
+
+    assert(pgversioning.commit("nothing") == 0)
+    assert(recorder.copied == [])
+
+    # one count per statement
+    assert(pg_execute("UPDATE epanet_working_copy.junctions_view "
+                      "SET elevation = 5")
+           == [('junctions', 1), ('pipes', 0)])
+    assert(pgversioning.commit("rev 3") == 1)
+    assert(recorder.copied
+           == ['epanet_trunk_2_to_3_diff.epanet_junctions_diff'])
+    assert(staging_schemas() == 0)
+    pcur.execute("SELECT DISTINCT elevation "
+                 "FROM epanet_trunk_rev_head.junctions")
+    assert(pcur.fetchall() == [(5.,)])
+    assert(pg_execute() == [('junctions', 0), ('pipes', 0)])
+    assert(head_lengths() == [4.])
+
+    pcurcpy.close()
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 delta_commit_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -102,6 +102,31 @@ def test(host, pguser):
     pcur.execute(select_str + " WHERE " + where_str)
     assert( len(pcur.fetchall()) == 1 )
 
+    # branch columns are filled without default and their foreign keys are
+    # validated
+    pcur.execute("SELECT DISTINCT mybranch_rev_begin FROM epanet.junctions")
+    assert( pcur.fetchall() == [(2,)] )
+    pcur.execute("SELECT COUNT(*) FROM pg_attrdef d "
+                 "JOIN pg_attribute a ON (a.attrelid, a.attnum) "
+                 "= (d.adrelid, d.adnum) "
+                 "WHERE a.attname LIKE 'mybranch_%'")
+    assert( pcur.fetchone()[0] == 0 )
+    pcur.execute("SELECT conname, convalidated FROM pg_constraint "
+                 "WHERE conname LIKE '%_mybranch_%_fkey' ORDER BY conname")
+    res = pcur.fetchall()
+    assert( len(res) == 8 and all(valid for _, valid in res) )
+
+    # rows ended in the base branch are not in the new branch
+    pcur.execute("UPDATE epanet.junctions SET trunk_rev_end = 2 "
+                 "WHERE id = '0'")
+    pcur.commit()
+    versioning.add_branch( pg_conn_info, 'epanet', 'other', 'other msg' )
+    pcur.execute("SELECT id FROM epanet_other_rev_head.junctions")
+    assert( pcur.fetchall() == [('1',)] )
+    pcur.execute("SELECT id, other_rev_begin FROM epanet.junctions "
+                 "ORDER BY id")
+    assert( pcur.fetchall() == [('0', None), ('1', 3)] )
+
     pcur.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+    versioning.add_branch(pg_conn_info, "epanet", "mybranch", "add branch")
+
+    # the indexes of both branches are created by add_branch
+    advice = versioning.advise_indexes(pg_conn_info, "epanet")
+    assert(len(advice) == 2*2*6)
+    assert(all(status == 'present' for _, status, _, _ in advice))
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT indexdef FROM pg_indexes "
+                 "WHERE indexname = 'idx_rev_pipes_trunk_head'")
+    assert(pcur.fetchone()[0].endswith(
+        "(versioning_id) WHERE ((trunk_rev_end IS NULL) "
+        "AND (trunk_rev_begin IS NOT NULL))"))
+
+    # an index dropped is missing, a single column index starting the
+    # (rev_begin, rev_end) one is redundant
+    pcur.execute("DROP INDEX epanet.idx_rev_pipes_trunk_head")
+    pcur.execute("CREATE INDEX idx_rev_junctions_rev_begin "
+                 "ON epanet.junctions (trunk_rev_begin)")
+    pcur.commit()
+    advice = versioning.advise_indexes(pg_conn_info, "epanet")
+    assert([(table, sql) for table, status, sql, _ in advice
+            if status == 'missing']
+           == [('pipes', "CREATE INDEX IF NOT EXISTS idx_rev_pipes_trunk_head "
+                "ON epanet.pipes (versioning_id) "
+                "WHERE trunk_rev_end IS NULL "
+                "AND trunk_rev_begin IS NOT NULL")])
+    assert([table for table, status, _, _ in advice
+            if status == 'redundant'] == ['junctions'])
+
+    statements = versioning.create_indexes(pg_conn_info, "epanet",
+                                           drop_redundant=True, workers=2)
+    assert(sorted(statements) == [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_rev_pipes_trunk_head "
+        "ON epanet.pipes (versioning_id) "
+        "WHERE trunk_rev_end IS NULL AND trunk_rev_begin IS NOT NULL",
+        "DROP INDEX CONCURRENTLY IF EXISTS "
+        "epanet.idx_rev_junctions_rev_begin"])
+    advice = versioning.advise_indexes(pg_conn_info, "epanet")
+    assert(len(advice) == 2*2*6)
+    assert(all(status == 'present' for _, status, _, _ in advice))
+
+    # an index left invalid, as by a cancelled concurrent build, is rebuilt
+    pcur.execute("UPDATE pg_index SET indisvalid = false "
+                 "WHERE indexrelid = 'epanet.idx_rev_pipes_trunk_head'"
+                 "::regclass")
+    pcur.commit()
+    advice = versioning.advise_indexes(pg_conn_info, "epanet")
+    assert([table for table, status, _, _ in advice
+            if status == 'invalid'] == ['pipes'])
+    statements = versioning.create_indexes(pg_conn_info, "epanet")
+    assert(statements[0] == "DROP INDEX CONCURRENTLY IF EXISTS "
+           "epanet.idx_rev_pipes_trunk_head")
+    advice = versioning.advise_indexes(pg_conn_info, "epanet")
+    assert(all(status == 'present' for _, status, _, _ in advice))
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 index_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
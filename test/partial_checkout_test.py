@@ -10,10 +10,36 @@ import tempfile
 tmp_dir = tempfile.gettempdir()
 sqlite_test_filename = os.path.join(tmp_dir, "partial_checkout_test.sqlite")
 
+sql_valves = """
+    CREATE TABLE epanet.valves (
+    id serial PRIMARY KEY,
+    pipe_id integer REFERENCES epanet.pipes(id),
+    geom geometry('POINT',2154)
+    );
+
+    INSERT INTO epanet.valves (pipe_id, geom)
+    VALUES (1, ST_GeometryFromText('POINT(0.5 0.5)',2154));
+    """
+
+sql_tanks = """
+    CREATE TABLE epanet.tanks (
+    id serial PRIMARY KEY,
+    geom geometry('POINT',2154)
+    );
+
+    INSERT INTO epanet.tanks (geom)
+    VALUES (ST_GeometryFromText('POINT(2 2)',2154));
+
+    ALTER TABLE epanet.pipes
+    ADD COLUMN tank_id integer REFERENCES epanet.tanks(id);
+
+    UPDATE epanet.pipes SET tank_id = 1 WHERE id = 1;
+    """
+
 
 class PartialCheckoutTest:
 
-    def __init__(self, host, pguser, schema):
+    def __init__(self, host, pguser, schema, additional_sql=None):
 
         self.schema = schema
         self.cur = None
@@ -47,6 +73,8 @@ class PartialCheckoutTest:
                 x=float(i+1),
                 y=float(i+1)
             ))
+        if additional_sql:
+            self.pcur.execute(additional_sql)
         self.pcon.commit()
 
         versioning.historize(self.pg_conn_info, 'epanet')
@@ -97,6 +125,44 @@ class PartialCheckoutTest:
             self.schema))
         assert([res[0] for res in self.cur.fetchall()] == [1, 2, 6, 7])
 
+    def test_referenced_chain(self):
+        """ checkout table, the features referenced by its referenced
+        features must appear too"""
+
+        self.checkout(["epanet_trunk_rev_head.valves"], [[1]])
+        self.cur.execute("SELECT id from {}.pipes_view order by id".format(
+            self.schema))
+        assert([res[0] for res in self.cur.fetchall()] == [1])
+
+        self.cur.execute("SELECT id from {}.junctions_view order by id".format(
+            self.schema))
+        assert([res[0] for res in self.cur.fetchall()] == [1, 2])
+
+    def test_referenced_targets(self):
+        """ checkout table, the features referenced through the two
+        foreign keys to one table and the one to another table must
+        appear"""
+
+        # the two foreign keys to junctions are followed before the one
+        # to tanks
+        self.pcur.execute("""
+        CREATE TEMPORARY TABLE constraints AS
+        SELECT * FROM epanet.versioning_constraints;
+        DELETE FROM epanet.versioning_constraints;
+        INSERT INTO epanet.versioning_constraints
+        SELECT * FROM constraints ORDER BY table_to = 'tanks';
+        DROP TABLE constraints""")
+        self.pcon.commit()
+
+        self.checkout(["epanet_trunk_rev_head.pipes"], [[1]])
+        self.cur.execute("SELECT id from {}.junctions_view order by id".format(
+            self.schema))
+        assert([res[0] for res in self.cur.fetchall()] == [1, 2])
+
+        self.cur.execute("SELECT id from {}.tanks_view order by id".format(
+            self.schema))
+        assert([res[0] for res in self.cur.fetchall()] == [1])
+
     def test_referencing(self):
         """ checkout table, its referencing table and the referencing
         features must appear"""
@@ -110,6 +176,21 @@ class PartialCheckoutTest:
             self.schema))
         assert([res[0] for res in self.cur.fetchall()] == [1])
 
+    def test_large_selection(self):
+        """ selected ids are staged by chunks, ids without feature are
+        ignored"""
+
+        self.checkout(["epanet_trunk_rev_head.junctions"],
+                      [[6, 7] + list(range(100, 25100))])
+        self.cur.execute("SELECT id from {}.junctions_view order by id".format(
+            self.schema))
+        assert([res[0] for res in self.cur.fetchall()] == [6, 7])
+
+        # no staging table is left in the versioned schema
+        self.pcur.execute("SELECT to_regclass("
+                          "'epanet.junctions_checkout_temp_fids')")
+        assert(self.pcur.fetchone()[0] is None)
+
     def test_duplicate_pkey_on_insert(self):
 
         self.checkout(["epanet_trunk_rev_head.junctions"], [[6, 7, 8]])
@@ -195,8 +276,8 @@ class PartialCheckoutTest:
 
 class SpatialitePartialCheckoutTest(PartialCheckoutTest):
 
-    def __init__(self, host, pguser):
-        super().__init__(host, pguser, "main")
+    def __init__(self, host, pguser, additional_sql=None):
+        super().__init__(host, pguser, "main", additional_sql)
 
         if os.path.isfile(sqlite_test_filename):
             os.remove(sqlite_test_filename)
@@ -216,10 +297,10 @@ class SpatialitePartialCheckoutTest(PartialCheckoutTest):
 
 class PgServerPartialCheckoutTest(PartialCheckoutTest):
 
-    def __init__(self, host, pguser):
+    def __init__(self, host, pguser, additional_sql=None):
 
         wc_schema = "epanet_workingcopy"
-        super().__init__(host, pguser, wc_schema)
+        super().__init__(host, pguser, wc_schema, additional_sql)
 
         self.versioning = versioning.pgServer(self.pg_conn_info,
                                               wc_schema)
@@ -232,10 +313,10 @@ class PgServerPartialCheckoutTest(PartialCheckoutTest):
 
 class PgLocalPartialCheckoutTest(PartialCheckoutTest):
 
-    def __init__(self, host, pguser):
+    def __init__(self, host, pguser, additional_sql=None):
 
         wc_schema = "epanet_workingcopy"
-        super().__init__(host, pguser, wc_schema)
+        super().__init__(host, pguser, wc_schema, additional_sql)
 
         self.versioning = versioning.pgLocal(
             self.pg_conn_info, wc_schema, self.pg_conn_info_cpy)
@@ -266,10 +347,22 @@ def test(host, pguser):
         test.test_referenced_union()
         del test
 
+        test = test_class(host, pguser, sql_valves)
+        test.test_referenced_chain()
+        del test
+
+        test = test_class(host, pguser, sql_tanks)
+        test.test_referenced_targets()
+        del test
+
         test = test_class(host, pguser)
         test.test_referencing()
         del test
 
+        test = test_class(host, pguser)
+        test.test_large_selection()
+        del test
+
         test = test_class(host, pguser)
         test.test_duplicate_pkey_on_insert()
         del test
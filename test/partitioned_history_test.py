@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet", partitioned=True)
+
+    tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+    pgversioning = versioning.pgServer(pg_conn_info, 'epanet_working_copy')
+    pgversioning.checkout(tables)
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("UPDATE epanet_working_copy.pipes_view SET length = 4 "
+                 "WHERE versioning_id = 1")
+    pcur.execute("INSERT INTO epanet_working_copy.pipes_view"
+                 "(id, start_node, end_node, geom) "
+                 "VALUES ('2', '1', '2', "
+                 "ST_GeometryFromText('LINESTRING(1 1,0 1)', 2154))")
+    pcur.commit()
+    pgversioning.commit("rev 2")
+
+    pcur.execute("DELETE FROM epanet_working_copy.pipes_view "
+                 "WHERE versioning_id = 3")
+    pcur.commit()
+    pgversioning.commit("rev 3")
+
+    # the ended rows are moved in the history table
+    pcur.execute("SELECT versioning_id FROM ONLY epanet.pipes "
+                 "ORDER BY versioning_id")
+    assert(pcur.fetchall() == [(2,)])
+    pcur.execute("SELECT versioning_id, trunk_rev_end, trunk_child "
+                 "FROM epanet_history.pipes ORDER BY versioning_id")
+    assert(pcur.fetchall() == [(1, 1, 2), (3, 2, None)])
+    pcur.execute("SELECT COUNT(*) FROM epanet.pipes")
+    assert(pcur.fetchone()[0] == 3)
+
+    # head queries do not read the history
+    pcur.execute("EXPLAIN SELECT * FROM epanet_trunk_rev_head.pipes")
+    assert('epanet_history' not in str(pcur.fetchall()))
+    pcur.execute("SELECT id, length FROM epanet_trunk_rev_head.pipes")
+    assert(pcur.fetchall() == [(1, 4.)])
+
+    # past revisions read both
+    select_str, where_str = versioning.rev_view_str(
+        pg_conn_info, 'epanet', 'pipes', 'trunk', 2)
+    pcur.execute("SELECT versioning_id FROM (" + select_str + " WHERE "
+                 + where_str + ") AS rev ORDER BY versioning_id")
+    assert(pcur.fetchall() == [(2,), (3,)])
+
+    # branches and working copy updates work on the partitioned tables
+    versioning.add_branch(pg_conn_info, 'epanet', 'mybranch', 'branch')
+    pcur.execute("SELECT COUNT(*) FROM epanet_mybranch_rev_head.pipes")
+    assert(pcur.fetchone()[0] == 1)
+    pcur.execute("SELECT COUNT(*) FROM epanet_history.pipes "
+                 "WHERE mybranch_rev_begin IS NOT NULL")
+    assert(pcur.fetchone()[0] == 0)
+
+    # the revision foreign keys, not inherited, are on the history table
+    pcur.execute("SELECT conname FROM pg_constraint "
+                 "WHERE conrelid = 'epanet_history.pipes'::regclass "
+                 "AND contype = 'f' ORDER BY conname")
+    assert([name for [name] in pcur.fetchall()] == [
+        'pipes_mybranch_rev_begin_fkey', 'pipes_mybranch_rev_end_fkey',
+        'pipes_trunk_rev_begin_fkey', 'pipes_trunk_rev_end_fkey'])
+
+    pgversioning2 =versioning.pgServer(pg_conn_info, 'epanet_working_copy2')
+    pgversioning2.checkout(tables)
+    pcur.execute("UPDATE epanet_working_copy2.pipes_view SET length = 5")
+    pcur.commit()
+    pgversioning2.commit("rev 5")
+    pgversioning.update()
+    pcur.execute("SELECT length FROM epanet_working_copy.pipes_view")
+    assert(pcur.fetchall() == [(5.,)])
+
+    # and archive
+    versioning.archive(pg_conn_info, 'epanet', 2)
+    pcur.execute("SELECT versioning_id FROM epanet_archive.pipes "
+                 "ORDER BY versioning_id")
+    assert(pcur.fetchall() == [(1,), (3,)])
+    pcur.execute("SELECT COUNT(*) FROM epanet_history.pipes")
+    assert(pcur.fetchone()[0] == 1)
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 partitioned_history_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
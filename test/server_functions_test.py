@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+import posgres_working_copy_test
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+
+    # the postgres working copy scenario, updates and commits being done by
+    # the functions installed by historize
+    os.environ['VERSIONING_SERVER_FUNCTIONS'] = '1'
+    posgres_working_copy_test.test(host, pguser)
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT COUNT(*) FROM epanet.revisions")
+    assert(pcur.fetchone()[0] == 4)
+    pcur.execute("SELECT COUNT(*) FROM epanet_working_copy_cflt.pipes_diff")
+    assert(pcur.fetchone()[0] > 0)
+    pcur.close()
+
+    # errors are reported like the python implementation ones
+    pgversioning = versioning.pgServer(pg_conn_info, 'epanet_working_copy')
+    try:
+        pgversioning.commit("late commit")
+        assert(False and "commit of a late working copy should fail")
+    except RuntimeError as e:
+        assert(str(e).startswith(
+            "Working copy epanet_working_copy is not up to date. "
+            "It's late by 2 commit(s)."))
+
+    pgversioning.update()
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT rev FROM epanet_working_copy.initial_revision")
+    assert([r for [r] in pcur.fetchall()] == [4, 4])
+    pcur.execute("UPDATE epanet_working_copy.pipes_view SET length = 3")
+    pcur.commit()
+    assert(pgversioning.commit("commit after update") == 1)
+    pcur.execute("SELECT COUNT(*) FROM epanet_working_copy.pipes_diff")
+    assert(pcur.fetchone()[0] == 0)
+    assert(pgversioning.ver.last_commit_timings == {})
+
+    # functions of an older version are not called, the python
+    # implementation is used instead
+    pcur.execute("DROP FUNCTION epanet.versioning_functions_version()")
+    pcur.execute("UPDATE epanet_working_copy.pipes_view SET length = 4")
+    pcur.commit()
+    assert(pgversioning.commit("commit without functions") == 1)
+    assert(list(pgversioning.ver.last_commit_timings) == ['pipes'])
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 server_functions_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
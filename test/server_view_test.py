@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+    wc1 = versioning.pgServer(pg_conn_info, 'epanet_working_copy')
+    wc1.checkout(tables)
+    wc2 = versioning.pgServer(pg_conn_info, 'epanet_working_copy2')
+    wc2.checkout(tables)
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+
+    def view_def(wcs):
+        pcur.execute("SELECT pg_get_viewdef('"+wcs+".pipes_view')")
+        return pcur.fetchone()[0]
+
+    def plan(wcs):
+        pcur.execute("SET enable_seqscan = off")
+        pcur.execute("EXPLAIN SELECT * FROM "+wcs+".pipes_view "
+                     "WHERE geom && ST_MakeEnvelope(0, 0, 1, 1, 2154)")
+        res = str(pcur.fetchall())
+        pcur.execute("RESET enable_seqscan")
+        return res
+
+    # the revision is a constant and the diff is excluded by an anti join
+    assert('initial_revision' not in view_def('epanet_working_copy'))
+    assert('JOIN' not in view_def('epanet_working_copy'))
+    assert('NOT (EXISTS' in view_def('epanet_working_copy'))
+    assert('trunk_rev_begin <= 1' in view_def('epanet_working_copy'))
+
+    # bbox filters use the gist indexes of the diff and of the head rows
+    res = plan('epanet_working_copy')
+    assert('idx_rev_pipes_trunk_head_geom' in res)
+    assert('pipes_diff_geom_idx' in res)
+    assert('Anti Join' in res)
+
+    # the view follows commits and updates
+    pcur.execute("UPDATE epanet_working_copy.pipes_view SET length = 4 "
+                 "WHERE versioning_id = 1")
+    pcur.execute("INSERT INTO epanet_working_copy.pipes_view"
+                 "(id, start_node, end_node, geom) VALUES (2, 1, 2, "
+                 "ST_GeometryFromText('LINESTRING(1 1,0 1)', 2154))")
+    pcur.commit()
+    pcur.execute("SELECT id, length FROM epanet_working_copy.pipes_view "
+                 "ORDER BY id")
+    assert(pcur.fetchall() == [(1, 4.), (2, None)])
+    wc1.commit("rev 2")
+    assert('trunk_rev_begin <= 2' in view_def('epanet_working_copy'))
+    pcur.execute("SELECT id, length FROM epanet_working_copy.pipes_view "
+                 "ORDER BY id")
+    assert(pcur.fetchall() == [(1, 4.), (2, None)])
+
+    pcur.execute("INSERT INTO epanet_working_copy2.pipes_view"
+                 "(id, start_node, end_node, geom) VALUES (3, 2, 1, "
+                 "ST_GeometryFromText('LINESTRING(0 1,1 1)', 2154))")
+    pcur.commit()
+    wc2.update()
+    assert('trunk_rev_begin <= 2' in view_def('epanet_working_copy2'))
+    pcur.execute("SELECT id, length FROM epanet_working_copy2.pipes_view "
+                 "ORDER BY id")
+    assert(pcur.fetchall() == [(1, 4.), (2, None), (3, None)])
+
+    # the triggers are kept when the view is replaced
+    pcur.execute("UPDATE epanet_working_copy2.pipes_view SET length = 5 "
+                 "WHERE id = 2")
+    pcur.commit()
+    wc2.commit("rev 3")
+    pcur.execute("SELECT id, length FROM epanet_trunk_rev_head.pipes "
+                 "ORDER BY id")
+    assert(pcur.fetchall() == [(1, 4.), (2, 5.), (3, None)])
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 server_view_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import psycopg2
+import os
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    tables = ['epanet_trunk_rev_head.junctions', 'epanet_trunk_rev_head.pipes']
+    pgversioning = versioning.pgServer(pg_conn_info, 'epanet_working_copy')
+    pgversioning.checkout(tables)
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    for i, sql in enumerate([
+            "INSERT INTO epanet_working_copy.pipes_view"
+            "(id, start_node, end_node, geom) VALUES (2, 1, 2, "
+            "ST_GeometryFromText('LINESTRING(1 1,0 1)', 2154))",
+            "UPDATE epanet_working_copy.pipes_view SET length = 4 "
+            "WHERE id = 1",
+            "DELETE FROM epanet_working_copy.pipes_view WHERE id = 2",
+            "INSERT INTO epanet_working_copy.pipes_view"
+            "(id, start_node, end_node, geom) VALUES (3, 2, 1, "
+            "ST_GeometryFromText('LINESTRING(0 1,1 1)', 2154))"]):
+        pcur.execute(sql)
+        pcur.commit()
+        pgversioning.commit("rev {}".format(i + 2))
+
+    def revision(rev):
+        select_str, where_str = versioning.rev_view_str(
+            pg_conn_info, 'epanet', 'pipes', 'trunk', rev)
+        pcur.execute("SELECT versioning_id, id, length FROM (" + select_str
+                     + " WHERE " + where_str + ") AS rev "
+                     "ORDER BY versioning_id")
+        return pcur.fetchall()
+
+    def snapshot(name):
+        pcur.execute("SELECT versioning_id, id, length FROM "+name+".pipes "
+                     "ORDER BY versioning_id")
+        return pcur.fetchall()
+
+    # from the history
+    name = versioning.materialize_revision(pg_conn_info, 'epanet', 'trunk', 2)
+    assert(name == 'epanet_trunk_snapshot_2')
+    assert(snapshot(name) == revision(2))
+    pcur.execute("SELECT indexdef FROM pg_indexes "
+                 "WHERE schemaname = 'epanet_trunk_snapshot_2' "
+                 "AND tablename = 'pipes' AND indexdef LIKE '%gist%'")
+    assert(len(pcur.fetchall()) == 1)
+
+    # rebased on the older snapshot
+    for rev in [4, 5, 3]:
+        name = versioning.materialize_revision(
+            pg_conn_info, 'epanet', 'trunk', rev, keep=3)
+        assert(snapshot(name) == revision(rev))
+    pcur.execute("SELECT column_name FROM information_schema.columns "
+                 "WHERE table_schema = 'epanet_trunk_snapshot_5' "
+                 "AND table_name = 'pipes' AND column_name LIKE 'trunk_%'")
+    assert(not pcur.fetchall())
+
+    # the least recently used one is dropped, a used one is kept
+    assert([rev for _, rev, _ in versioning.snapshots(pg_conn_info, 'epanet')]
+           == [3, 5, 4])
+    assert(not versioning.pg_schema_exists(pcur, 'epanet_trunk_snapshot_2'))
+    versioning.materialize_revision(pg_conn_info, 'epanet', 'trunk', 4, keep=3)
+    versioning.materialize_revision(pg_conn_info, 'epanet', 'trunk', 1, keep=3)
+    assert([rev for _, rev, _ in versioning.snapshots(pg_conn_info, 'epanet')]
+           == [1, 4, 3])
+    assert(not versioning.pg_schema_exists(pcur, 'epanet_trunk_snapshot_5'))
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 snapshot_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
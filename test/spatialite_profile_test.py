@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from sqlite3 import dbapi2
+import psycopg2
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    tmp_dir = tempfile.gettempdir()
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    tables = ["epanet_trunk_rev_head.junctions", "epanet_trunk_rev_head.pipes"]
+
+    for transfer in ['stream', 'ogr2ogr']:
+        sqlite_test_filename = os.path.join(
+            tmp_dir, "spatialite_profile_test_{}.sqlite".format(transfer))
+        if os.path.isfile(sqlite_test_filename):
+            os.remove(sqlite_test_filename)
+        spversioning = versioning.spatialite(sqlite_test_filename,
+                                             pg_conn_info, transfer)
+        spversioning.checkout(tables)
+
+        scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+        scur.execute("PRAGMA journal_mode")
+        assert(scur.fetchone()[0] == 'wal')
+        scur.execute("PRAGMA page_size")
+        assert(scur.fetchone()[0] == 8192)
+        scur.execute("PRAGMA synchronous")
+        assert(scur.fetchone()[0] == 1)
+
+        # spatial indexes built after the load and statistics gathered
+        scur.execute("SELECT f_table_name, spatial_index_enabled "
+                     "FROM geometry_columns "
+                     "WHERE f_table_name IN ('junctions', 'pipes') "
+                     "ORDER BY f_table_name")
+        assert(scur.fetchall() == [('junctions', 1), ('pipes', 1)])
+        scur.execute("SELECT COUNT(*) FROM idx_junctions_geom")
+        assert(scur.fetchone()[0] == 2)
+        scur.execute("SELECT COUNT(*) FROM sqlite_stat1 "
+                     "WHERE tbl = 'junctions'")
+        assert(scur.fetchone()[0] > 0)
+        scur.close()
+
+    # updates keep the profile
+    pgversioning = versioning.pgServer(pg_conn_info, 'epanet_working_copy')
+    pgversioning.checkout(tables)
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("UPDATE epanet_working_copy.pipes_view SET length = 4")
+    pcur.commit()
+    pcur.close()
+    pgversioning.commit("rev 2")
+    spversioning.update()
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+    scur.execute("SELECT length FROM pipes_view")
+    assert(scur.fetchall() == [(4.,)])
+    scur.execute("PRAGMA journal_mode")
+    assert(scur.fetchone()[0] == 'wal')
+    scur.execute("SELECT COUNT(*) FROM idx_pipes_geom")
+    assert(scur.fetchone()[0] == 2)
+    scur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 spatialite_profile_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from versioningDB.utils import stage_features
+from sqlite3 import dbapi2
+import psycopg2
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    tmp_dir = tempfile.gettempdir()
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+    # rows come by lists of itersize rows, other statements can run in
+    # between
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    chunks = []
+    for rows in pcur.stream("SELECT i FROM generate_series(1, 25) AS i",
+                            itersize=10):
+        pcur.execute("SELECT COUNT(*) FROM epanet.pipes")
+        assert(pcur.fetchone()[0] == 1)
+        chunks.append([i for [i] in rows])
+    assert([len(chunk) for chunk in chunks] == [10, 10, 5])
+    assert(sum(chunks, []) == list(range(1, 26)))
+    assert(list(pcur.stream("SELECT 1 WHERE False")) == [])
+
+    # features are staged from any iterable
+    fids = stage_features(pcur, "stream_test_fids", "epanet", "junctions",
+                          "id", (i for i in range(3)), temporary=True)
+    pcur.execute("SELECT fid FROM stream_test_fids ORDER BY fid")
+    assert(pcur.fetchall() == [(0,), (1,), (2,)])
+    assert(fids == "(SELECT fid FROM stream_test_fids)")
+    pcur.close()
+
+    sqlite_test_filename = os.path.join(tmp_dir, "stream_test.sqlite")
+    if os.path.isfile(sqlite_test_filename):
+        os.remove(sqlite_test_filename)
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+    scur.execute("CREATE TABLE numbers (i integer)")
+    scur.executemany("INSERT INTO numbers VALUES (?)",
+                     [(i,) for i in range(25)])
+    scur.commit()
+    assert([len(rows) for rows in scur.stream("SELECT i FROM numbers",
+                                              itersize=10)] == [10, 10, 5])
+    scur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 stream_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+import json
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+    trace_filename = os.path.join(tempfile.gettempdir(), "trace_test.jsonl")
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+
+    # statements are collected with their originating function
+    collector = versioning.StatementCollector()
+    assert(versioning.set_trace_sink(collector) is None)
+    versioning.historize(pg_conn_info, 'epanet')
+    versioning.set_trace_sink(None)
+
+    operations = set(entry['operation'] for entry in collector.entries)
+    assert(operations == {'versioning.historize'}), operations
+    callers = set(entry['caller'] for entry in collector.entries)
+    assert('versioning.add_branch' in callers), callers
+    assert(all(entry['db'] == 'pg' and entry['seconds'] >= 0
+               for entry in collector.entries))
+
+    # the report sums identical statements and keeps the slowest
+    report = collector.report(3)
+    assert(list(report.keys()) == ['versioning.historize'])
+    assert(len(report['versioning.historize']) == 3)
+    seconds = [s for s, calls, sql in report['versioning.historize']]
+    assert(seconds == sorted(seconds, reverse=True))
+    assert(sum(calls for s, calls, sql in versioning.trace_report(
+        collector.entries, len(collector.entries))['versioning.historize'])
+        == len(collector.entries))
+
+    # nothing is traced without sink
+    count = len(collector.entries)
+    versioning.revisions(pg_conn_info, 'epanet')
+    assert(len(collector.entries) == count)
+
+    # json lines sink, with rowcount
+    if os.path.isfile(trace_filename):
+        os.remove(trace_filename)
+    sink = versioning.JsonLinesSink(trace_filename)
+    versioning.set_trace_sink(sink)
+    assert(versioning.revisions(pg_conn_info, 'epanet') == [1])
+    versioning.set_trace_sink(None)
+    sink.close()
+    with open(trace_filename) as trace_file:
+        entries = [json.loads(line) for line in trace_file]
+    assert([(entry['operation'], entry['rowcount']) for entry in entries]
+           == [('versioning.revisions', 1)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 trace_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
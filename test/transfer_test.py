@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from versioningDB.transfer import StreamTransfer
+from sqlite3 import dbapi2
+import psycopg2
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    tmp_dir = tempfile.gettempdir()
+    test_data_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # create the test database
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -f "+test_data_dir+"/epanet_test_db.sql")
+    versioning.historize(pg_conn_info, "epanet")
+
+    tables = ["epanet_trunk_rev_head.junctions", "epanet_trunk_rev_head.pipes"]
+
+    # the same checkout with both engines gives the same working copy
+    contents = {}
+    for transfer in ['stream', 'ogr2ogr']:
+        sqlite_test_filename = os.path.join(
+            tmp_dir, "transfer_test_{}.sqlite".format(transfer))
+        if os.path.isfile(sqlite_test_filename):
+            os.remove(sqlite_test_filename)
+        spversioning = versioning.spatialite(sqlite_test_filename,
+                                             pg_conn_info, transfer)
+        spversioning.checkout(tables)
+
+        scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+        scur.execute("SELECT ogc_fid, id, elevation, AsText(geom) "
+                     "FROM junctions_view ORDER BY ogc_fid")
+        contents[transfer] = scur.fetchall()
+        scur.execute("SELECT f_table_name, f_geometry_column, srid "
+                     "FROM geometry_columns "
+                     "WHERE f_table_name IN ('junctions', 'pipes') "
+                     "ORDER BY f_table_name")
+        assert(scur.fetchall() == [('junctions', 'geom', 2154),
+                                   ('pipes', 'geom', 2154)])
+        scur.close()
+
+    assert(contents['stream'] == contents['ogr2ogr'])
+    assert(len(contents['stream']) == 2)
+
+    # tables copied concurrently give the same working copy
+    sqlite_test_filename = os.path.join(tmp_dir, "transfer_test_workers.sqlite")
+    if os.path.isfile(sqlite_test_filename):
+        os.remove(sqlite_test_filename)
+    spversioning = versioning.spatialite(sqlite_test_filename, pg_conn_info)
+    spversioning.checkout(tables, workers=2)
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+    scur.execute("SELECT ogc_fid, id, elevation, AsText(geom) "
+                 "FROM junctions_view ORDER BY ogc_fid")
+    assert(scur.fetchall() == contents['stream'])
+    scur.execute("SELECT table_name FROM initial_revision")
+    assert([t for [t] in scur.fetchall()] == ['junctions', 'pipes'])
+    scur.close()
+
+    # commit and update go through the stream engine
+    sqlite_test_filename1 = os.path.join(tmp_dir, "transfer_test_stream.sqlite")
+    sqlite_test_filename2 = os.path.join(tmp_dir, "transfer_test_update.sqlite")
+    if os.path.isfile(sqlite_test_filename2):
+        os.remove(sqlite_test_filename2)
+    spversioning1 = versioning.spatialite(sqlite_test_filename1, pg_conn_info)
+    spversioning2 = versioning.spatialite(sqlite_test_filename2, pg_conn_info)
+    spversioning2.checkout(tables)
+
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename1))
+    scur.execute("UPDATE junctions_view SET elevation = 8 WHERE id = 2")
+    scur.execute("INSERT INTO junctions_view(id, elevation, geom) "
+                 "VALUES (10, 4, GeomFromText('POINT(2 3)', 2154))")
+    scur.commit()
+    scur.close()
+    assert(spversioning1.commit('stream commit') == 1)
+
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("SELECT elevation, ST_AsText(geom) FROM epanet.junctions "
+                 "WHERE trunk_rev_end IS NULL ORDER BY id")
+    assert(pcur.fetchall() == [(0., 'POINT(1 0)'), (8., 'POINT(0 1)'),
+                               (4., 'POINT(2 3)')])
+    pcur.close()
+
+    spversioning2.update()
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename2))
+    scur.execute("SELECT id, elevation, AsText(geom) FROM junctions_view "
+                 "ORDER BY id")
+    assert(scur.fetchall() == [(1, 0., 'POINT(1 0)'),
+                               (2, 8., 'POINT(0 1)'),
+                               (10, 4., 'POINT(2 3)')])
+    scur.close()
+
+    # a failed insert in the destination is reported, not the broken pipe
+    # of the source still being read
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("CREATE SCHEMA transfer_dest")
+    pcur.execute("CREATE TABLE epanet.duplicates AS "
+                 "SELECT 1 AS id UNION ALL "
+                 "SELECT generate_series(1, 500000) AS id")
+    pcur.commit()
+    pcurcpy = versioning.Db(psycopg2.connect(pg_conn_info))
+    try:
+        StreamTransfer().pg_to_pg(pg_conn_info, pcur, "epanet.duplicates",
+                                  pg_conn_info, pcurcpy,
+                                  "transfer_dest.duplicates", "id")
+        assert(False and "copy of duplicated ids should fail")
+    except psycopg2.IntegrityError:
+        pass
+    pcurcpy.close()
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 transfer_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sys
+from versioningDB import versioning
+from sqlite3 import dbapi2
+import psycopg2
+import os
+import tempfile
+
+
+def test(host, pguser):
+    pg_conn_info = "dbname=epanet_test_db host=" + host + " user=" + pguser
+    tmp_dir = tempfile.gettempdir()
+    sqlite_test_filename = os.path.join(tmp_dir, "unique_check_test.sqlite")
+    if os.path.isfile(sqlite_test_filename):
+        os.remove(sqlite_test_filename)
+
+    os.system("dropdb --if-exists -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("createdb -h " + host + " -U "+pguser+" epanet_test_db")
+    os.system("psql -h " + host + " -U "+pguser+" epanet_test_db -c 'CREATE EXTENSION postgis'")
+
+    # composite key with a non integer column
+    pcur = versioning.Db(psycopg2.connect(pg_conn_info))
+    pcur.execute("CREATE SCHEMA uniq")
+    pcur.execute("""
+    CREATE TABLE uniq.items (
+    code varchar,
+    num integer,
+    name varchar,
+    geom geometry('POINT', 2154),
+    PRIMARY KEY (code, num))""")
+    pcur.execute("INSERT INTO uniq.items (code, num, name) "
+                 "VALUES ('a', 1, 'first'), ('b', 2, 'second')")
+    pcur.commit()
+    versioning.historize(pg_conn_info, 'uniq')
+
+    tables = ['uniq_trunk_rev_head.items']
+    wc1 = versioning.pgServer(pg_conn_info, 'uniq_wc1')
+    wc1.checkout(tables)
+    wc2 = versioning.pgServer(pg_conn_info, 'uniq_wc2')
+    wc2.checkout(tables)
+    spversioning = versioning.spatialite(sqlite_test_filename, pg_conn_info)
+    spversioning.checkout(tables)
+
+    # a key with a tab is committed first
+    pcur.execute("INSERT INTO uniq_wc1.items_view (code, num, name) "
+                 "VALUES ('x\ty', 3, 'wc1')")
+    pcur.commit()
+    wc1.commit("rev 2")
+
+    def commit_error(wc):
+        wc.update()
+        try:
+            wc.commit("duplicate")
+        except RuntimeError as e:
+            return str(e)
+        return None
+
+    # spatialite working copy, keys copied to the base database
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+    scur.execute("INSERT INTO items_view (code, num, name) "
+                 "VALUES ('x\ty', 3, 'sp'), ('z', 5, 'sp')")
+    scur.commit()
+    scur.close()
+    error = commit_error(spversioning)
+    assert(error and "items : code=x\ty and num=3" in error)
+    assert("code=z" not in error)
+
+    # the local diff of the failed commit is not left in the working copy
+    scur = versioning.Db(dbapi2.connect(sqlite_test_filename))
+    scur.execute("SELECT COUNT(*) FROM sqlite_master "
+                 "WHERE name = 'items_diff'")
+    assert(scur.fetchone()[0] == 0)
+    scur.execute("SELECT COUNT(*) FROM geometry_columns "
+                 "WHERE f_table_name = 'items_diff'")
+    assert(scur.fetchone()[0] == 0)
+    scur.close()
+
+    # postgres working copy in the base database
+    pcur.execute("INSERT INTO uniq_wc2.items_view (code, num, name) "
+                 "VALUES ('x\ty', 3, 'wc2'), ('b', 4, 'wc2')")
+    pcur.commit()
+    error = commit_error(wc2)
+    assert(error and "uniq_wc2.items : code=x\ty and num=3" in error)
+    assert("code=b" not in error)
+
+    # nothing is left in the session
+    pcur.execute("SELECT COUNT(*) FROM pg_class "
+                 "WHERE relname LIKE 'unique_check_keys_%'")
+    assert(pcur.fetchone()[0] == 0)
+    pcur.execute("SELECT COUNT(*) FROM uniq_trunk_rev_head.items")
+    assert(pcur.fetchone()[0] == 3)
+    pcur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 unique_check_test.py host pguser")
+    else:
+        test(*sys.argv[1:])
@@ -20,7 +20,7 @@
  ***************************************************************************/
 """
 
-from .utils import get_pkeys
+from .utils import get_pkeys, copy_rows
 
 
 class Constraint:
@@ -75,19 +75,22 @@ class Constraint:
 
 class ConstraintBuilder:
 
-    def __init__(self, b_cur, wc_cur, b_schema, wc_schema):
+    def __init__(self, b_cur, wc_cur, b_schema, wc_schema, branch=None):
         """ Constructor to build unique and foreign key constraint
 
         :param b_cur: base cursor (must be opened and valid)
         :param wc_cur: working copy cursor (must be opened and valid)
         :param b_schema: base schema
         :param wc_schema: working copy schema
+        :param branch: checked out branch, constraints are checked against
+        the working copy tables instead of their views if given
 
         """
         self.b_cur = b_cur
         self.wc_cur = wc_cur
         self.b_schema = b_schema
         self.wc_schema = wc_schema
+        self.branch = branch
 
         b_cur.execute(f"""
         SELECT table_from, columns_from, defaults_from, table_to,
@@ -114,6 +117,53 @@ class ConstraintBuilder:
                 self.referenced_constraints.setdefault(table_to, []).append(
                     constraint)
 
+    def get_exists(self, table, where):
+        """ Build and return an EXISTS expression checking for current rows
+        of the given working copy table matching where
+
+        :param table: working copy table
+        :param where: list of conditions on table columns
+        :returns: sql expression
+        :rtype: str
+
+        """
+        q_table = ((self.wc_schema + "." + table) if self.wc_schema
+                   else table)
+
+        # pgServer current rows are split between base and diff tables
+        if not self.branch or self.b_cur is self.wc_cur:
+            q_table += "_view"
+        else:
+            where = [f"{self.branch}_rev_end IS NULL",
+                     f"{self.branch}_rev_begin IS NOT NULL"] + where
+
+        return "EXISTS (SELECT 1 FROM {} WHERE {})".format(
+            q_table, " AND ".join(where))
+
+    def create_indexes(self, table):
+        """ Create the indexes used by constraints checks on the given
+        working copy table
+
+        :param table: working copy table
+
+        """
+        columns_list = (
+            [constraint.columns_from
+             for constraint in self.referencing_constraints.get(table, [])]
+            + [constraint.columns_to
+               for constraint in self.referenced_constraints.get(table, [])])
+
+        # pgServer rows are edited in the diff table
+        wc_table = (table + "_diff" if self.b_cur is self.wc_cur
+                    else table)
+        q_table = ((self.wc_schema + "." + wc_table) if self.wc_schema
+                   else wc_table)
+
+        for columns in sorted(set(tuple(columns) for columns in columns_list)):
+            self.wc_cur.execute(
+                "CREATE INDEX IF NOT EXISTS {}_{}_idx ON {}({})".format(
+                    wc_table, "_".join(columns), q_table, ",".join(columns)))
+
     def get_referencing_constraint(self, method, table):
         """ Build and return unique and foreign key referencing constraints
         sql for given table
@@ -137,9 +187,10 @@ class ConstraintBuilder:
                 q_table_from = constraint.get_q_table_from(self.wc_schema)
 
                 # check if unique keys already exist
-                when_filter = "(SELECT COUNT(*) FROM {}_view WHERE {}) != 0".format(
-                    q_table_from,
-                    " AND ".join(["{0} = NEW.{0}".format(column) for column in constraint.columns_from]))
+                when_filter = self.get_exists(
+                    constraint.table_from,
+                    ["{0} = NEW.{0}".format(column)
+                     for column in constraint.columns_from])
 
                 # check if unique keys have been modified
                 if method == 'update': 
@@ -164,15 +215,13 @@ class ConstraintBuilder:
             # foreign key constraint
             else:
 
-                q_table_to = constraint.get_q_table_to(self.wc_schema)
-
                 # check if referenced keys exists
-                when_filter = "(SELECT COUNT(*) FROM {}_view WHERE {}) = 0".format(
-                    q_table_to, " AND ".join(
-                        [f"(NEW.{column_from} IS NULL "
-                         f"OR {column_to} = NEW.{column_from})"
-                         for column_to, column_from
-                         in zip(constraint.columns_to, constraint.columns_from)]))
+                when_filter = "NOT " + self.get_exists(
+                    constraint.table_to,
+                    [f"(NEW.{column_from} IS NULL "
+                     f"OR {column_to} = NEW.{column_from})"
+                     for column_to, column_from
+                     in zip(constraint.columns_to, constraint.columns_from)])
 
                 keys = ",".join(constraint.columns_from)
 
@@ -263,8 +312,11 @@ class ConstraintBuilder:
             # fail
             else:
 
-                where += f""" AND (SELECT COUNT(*) FROM {q_table_from}_view
-                WHERE {col_where}) > 0"""
+                where += " AND " + self.get_exists(
+                    constraint.table_from,
+                    [f"{column_from} = OLD.{column_to}"
+                     for column_from, column_to in
+                     zip(constraint.columns_from, constraint.columns_to)])
                 
                 keys_label = ",".join(constraint.columns_to) + (" is" if len(constraint.columns_to) == 1 else " are")
                 sql_constraint += (f"""IF {where} THEN RAISE EXCEPTION '{keys_label} still referenced by {q_table_from}'; END IF;"""
@@ -274,14 +326,24 @@ class ConstraintBuilder:
         return sql_constraint
 
 
-def check_unique_constraints(b_cur, wc_cur, wc_schema):
+def check_unique_constraints(b_cur, wc_cur, wc_schema, tables=None):
+    """Raise a RuntimeError if keys of rows inserted or updated in the
+    working copy are already used in the head of the base tables, of the
+    tables listed in tables only if given.
+
+    The new keys of each layer are copied in a temporary table typed like
+    the base table keys, unless the working copy is in the base database,
+    and are then checked against the base tables by a single query"""
 
     wc_cur.execute("SELECT rev, branch, table_schema, table_name "
                    f"FROM {wc_schema}.initial_revision")
     versioned_layers = wc_cur.fetchall()
 
-    errors = []
-    for [rev, branch, b_schema, table] in versioned_layers:
+    checks = []
+    keys_tables = []
+    for i, [rev, branch, b_schema, table] in enumerate(versioned_layers):
+        if tables is not None and table not in tables:
+            continue
 
         # Spatialite
         if wc_cur.isSpatialite():
@@ -299,11 +361,13 @@ def check_unique_constraints(b_cur, wc_cur, wc_schema):
             vid = "ogc_fid"
 
         pkeys = get_pkeys(b_cur, b_schema, table)
+        if not pkeys:
+            continue
         pkey_list = ",".join(["trev." + pkey for pkey in pkeys])
         new_pkeys_filter = " OR ".join(["trev.{0} != trev2.{0}".format(pkey)
                                         for pkey in pkeys])
 
-        wc_cur.execute(f"""
+        new_keys_sql = f"""
         -- INSERTED PKEY
         SELECT {pkey_list}
         FROM {table_w_revs} trev
@@ -318,34 +382,42 @@ def check_unique_constraints(b_cur, wc_cur, wc_schema):
         AND trev.{branch}_rev_begin > 1
         AND trev.{branch}_parent = trev2.{vid}
         AND ({new_pkeys_filter})
-        """)
-
-        new_keys = wc_cur.fetchall()
-
-        if not new_keys:
-            continue
-
-        # search in database if there are some working copy new key that
-        # already exist.
-        new_key_list = ",".join(["({})".format(
-            ",".join([str(int_key)for int_key in new_key]))
-                                 for new_key in new_keys])
+        """
 
-        b_cur.execute(f"""
-        SELECT {pkey_list}
+        keys_table = f"unique_check_keys_{i}"
+        keys_tables.append(keys_table)
+        create = (f"DROP TABLE IF EXISTS {keys_table};\n"
+                  f"CREATE TEMP TABLE {keys_table} AS "
+                  f"SELECT {pkey_list} FROM {b_schema}.{table} trev "
+                  "WHERE False")
+        index = (f"CREATE INDEX ON {keys_table} ({','.join(pkeys)});\n"
+                 f"ANALYZE {keys_table}")
+        if b_cur is wc_cur:
+            b_cur.execute(f"{create};\n"
+                          f"INSERT INTO {keys_table} {new_keys_sql};\n"
+                          f"{index}")
+        else:
+            b_cur.execute(create)
+            for new_keys in wc_cur.stream(new_keys_sql):
+                copy_rows(b_cur, keys_table, pkeys, new_keys)
+            b_cur.execute(index)
+
+        # existing keys, described as 'pkey=value and ...'
+        label = " || ' and ' || ".join(
+            [f"'{pkey}=' || trev.{pkey}::text" for pkey in pkeys])
+        checks.append(f"""
+        SELECT '{table}', {label}
         FROM {b_schema}.{table} trev
         WHERE {branch}_rev_end is NULL
         AND {branch}_parent is NULL
-        INTERSECT
-        SELECT *
-        FROM (VALUES {new_key_list}) AS new_keys""")
-
-        def to_string(rec):
-            return " and ".join(
-                [f"{pkey}={value}" for pkey, value in zip(pkeys, rec)])
+        AND ({pkey_list}) IN (SELECT * FROM {keys_table})""")
 
-        errors += ["   {}.{} : {}".format(wc_schema, table, to_string(res))
-                   for res in b_cur.fetchall()]
+    errors = []
+    if checks:
+        b_cur.execute(" UNION ALL ".join(checks))
+        errors = ["   {}.{} : {}".format(wc_schema, table, key)
+                  for table, key in b_cur.fetchall()]
+        b_cur.execute("DROP TABLE " + ", ".join(keys_tables))
 
     if errors:
         raise RuntimeError("Some new or updated row violate the primary key"
@@ -3,51 +3,37 @@
 from __future__ import absolute_import
 from .utils import (Db, pg_pk, pg_geom, pg_geoms, pg_branches, quote_ident,
                     preserve_fid, escape_quote, get_username, os_info,
-                    get_checkout_tables, get_pkey)
+                    get_checkout_tables, get_pkey, pg_connect,
+                    pg_column_names, follow_conflict_children, pg_late,
+                    checkout_workers, run_parallel, stage_features,
+                    pg_columns, pg_tables, pg_schema_exists,
+                    changed_tables)
 from .constraints import ConstraintBuilder, check_unique_constraints
-
-import psycopg2
-import tempfile
-import os
+from .transfer import get_transfer
 
 DEBUG = False
 
 
 class pgVersioningLocal(object):
-    def __pragmaTableInfo(self, schema, table):
-        """returns an sql query to fetch information like PRAGMA table_info(table) from SQLite"""
-        sql = """select 
-          ordinal_position, 
-          column_name, 
-          data_type, 
-          is_nullable, 
-          column_default, 
-          COALESCE(pk.pk, false) as pk 
-        from 
-          INFORMATION_SCHEMA.COLUMNS 
-          LEFT JOIN (
-            SELECT 
-              a.attname, 
-              true AS pk 
-            FROM 
-              pg_index i 
-              JOIN pg_attribute a ON a.attrelid = i.indrelid 
-              AND a.attnum = ANY(i.indkey) 
-            WHERE 
-              i.indrelid = '{schema}.{table}' :: regclass 
-              AND i.indisprimary
-          ) pk ON pk.attname = column_name 
-        WHERE 
-          (table_schema, table_name) = ('{schema}', '{table}') 
-        ORDER BY 
-          ordinal_position""".format(schema=schema, table=table)
-
-        return sql
+    def __init__(self, transfer=None, pool=None):
+        """transfer is the engine used to copy tables between the two
+        postgres databases, see transfer.get_transfer, connections are
+        taken from the optional ConnectionPool pool"""
+        self.transfer = transfer if transfer else get_transfer()
+        self.pool = pool
+
+    def __pragmaTableInfo(self, cur, schema, table):
+        """returns the (cid, name, type) of the columns of table, like the
+        first fields of PRAGMA table_info(table) from SQLite, read from
+        the catalog by pg_columns"""
+        return [(cid, column, data_type)
+                for cid, (column, data_type, _, _, _)
+                in enumerate(pg_columns(cur, schema, table))]
 
     def revision(self, connection):
         (pg_conn_info, wcs, pg_conn_info_copy) = connection
         """returns the revision the working copy was created from plus one"""
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
         pcurcpy.execute("SELECT rev " + "FROM "+wcs+".initial_revision")
         rev = 0
         for [res] in pcurcpy.fetchall():
@@ -58,27 +44,21 @@ class pgVersioningLocal(object):
         pcurcpy.close()
         return rev + 1
 
-    def late(self, connection):
+    def late(self, connection, detail=False):
         (pg_conn_info, wcs, pg_conn_info_copy) = connection
-        """Return 0 if up to date, the number of commits in between otherwise"""
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcurcpy.execute("SELECT rev, branch, table_schema "
+        """Return 0 if up to date, the number of commits in between otherwise,
+        see pg_late for detail"""
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
+        pcurcpy.execute("SELECT rev, branch, table_schema, table_name "
                         "FROM "+wcs+".initial_revision")
         versioned_layers = pcurcpy.fetchall()
+        pcurcpy.close()
         if not versioned_layers:
             raise RuntimeError("Cannot find versioned layer in "
                                + wcs)
 
-        late_by = 0
-
-        for [rev, branch, table_schema] in versioned_layers:
-            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-                         "WHERE branch = '"+branch+"'")
-            [max_rev] = pcur.fetchone()
-            late_by = max(max_rev - rev, late_by)
-
-        pcurcpy.close()
+        pcur = pg_connect(pg_conn_info, self.pool)
+        late_by = pg_late(pcur, versioned_layers, detail)
         pcur.close()
         return late_by
 
@@ -97,13 +77,13 @@ class pgVersioningLocal(object):
         # merge changes and update target_revision
         # delete diff
 
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
         pcurcpy.execute("SELECT rev, branch, table_schema, table_name, max_pk "
                         "FROM {}.initial_revision".format(wcs))
         versioned_layers = pcurcpy.fetchall()
 
         for [rev, branch, table_schema, table, current_max_pk] in versioned_layers:
-            pcur = Db(psycopg2.connect(pg_conn_info))
+            pcur = pg_connect(pg_conn_info, self.pool)
             pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
                          "WHERE branch = '"+branch+"'")
             [max_rev] = pcur.fetchone()
@@ -126,9 +106,7 @@ class pgVersioningLocal(object):
             # create the diff
             diff_schema = (table_schema+"_"+branch+"_"+str(rev) +
                            "_to_"+str(max_rev)+"_diff")
-            pcur.execute("SELECT schema_name FROM information_schema.schemata "
-                         "WHERE schema_name = '"+diff_schema+"'")
-            if not pcur.fetchone():
+            if not pg_schema_exists(pcur, diff_schema):
                 pcur.execute("CREATE SCHEMA "+diff_schema)
 
             other_branches = pg_branches(pcur, table_schema).remove(branch)
@@ -137,14 +115,10 @@ class pgVersioningLocal(object):
                 [brch+'_rev_begin', brch+'_rev_end',
                  brch+'_parent', brch+'_child']
                 for brch in other_branches], [])
-            pcur.execute("SELECT column_name "
-                         "FROM information_schema.columns "
-                         "WHERE table_schema = '"+table_schema+"' "
-                         "AND table_name = '"+table+"'")
             cols = ""
-            for col in pcur.fetchall():
-                if col[0] not in pgeoms and col[0] not in other_branches_columns:
-                    cols += quote_ident(col[0])+", "
+            for col in pg_column_names(pcur, table_schema, table):
+                if col not in pgeoms and col not in other_branches_columns:
+                    cols += quote_ident(col)+", "
             cols = cols[:-2]  # remove last coma and space
             pcur.execute("""
                 SELECT f_geometry_column, srid, type
@@ -177,31 +151,18 @@ class pgVersioningLocal(object):
             pcurcpy.commit()
 
             # import the diff to postgresql
-            pgeom = pg_geom(pcur, table_schema, table)
-            cmd = ['ogr2ogr',
-                   '-preserve_fid',
-                   '-lco', 'FID=ogc_fid',
-                   '-lco', 'schema=' + wcs,
-                   '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                   '-f', 'PostgreSQL',
-                   '-update',
-                   'PG:"'+pg_conn_info_copy+'"',
-                   'PG:"'+pg_conn_info+'"',
-                   diff_schema+'.'+table+"_diff",
-                   '-nln', wcs+'.'+table+"_diff"]
-
-            if DEBUG:
-                print(' '.join(cmd))
-            os.system(' '.join(cmd))
+            self.transfer.pg_to_pg(
+                pg_conn_info, pcur, diff_schema+'.'+table+"_diff",
+                pg_conn_info_copy, pcurcpy, wcs+'.'+table+"_diff",
+                fid=pkey, geometry_name=pgeom, spatial_index=False)
 
             # cleanup in postgis
             pcur.execute("DROP SCHEMA "+diff_schema+" CASCADE")
             pcur.commit()
             pcur.close()
 
-            pcurcpy.execute(self.__pragmaTableInfo(wcs, table))
             cols = ""
-            for col in pcurcpy.fetchall():
+            for col in self.__pragmaTableInfo(pcurcpy, wcs, table):
                 cols += quote_ident(col[1])+", "
             cols = cols[:-2]  # remove last coma and space
 
@@ -302,31 +263,9 @@ class pgVersioningLocal(object):
 
                 # now follow child if any for 'theirs' 'modified' since several
                 # edition could be made we want the very last child
-                while True:
-                    pcurcpy.execute("SELECT conflict_id, ogc_fid, "+branch+"_child "
-                                    "FROM "+wcs+"."+table+"_conflicts WHERE origin='theirs' "
-                                    "AND action='modified' AND "+branch+"_child IS NOT NULL")
-                    res = pcurcpy.fetchall()
-                    if not res:
-                        break
-                    # replaces each entries by it's child
-                    for [cflt_id, fid, child] in res:
-                        pcurcpy.execute("DELETE FROM "+wcs+"."+table+"_conflicts "
-                                        "WHERE ogc_fid = "+str(fid))
-                        pcurcpy.execute("INSERT INTO "+wcs+"."+table+"_conflicts "
-                                        "SELECT "+str(cflt_id) +
-                                        " AS conflict_id, "
-                                        "'theirs' AS origin, 'modified' AS action, "+cols+" "
-                                        "FROM "+wcs+"."+table+"_diff "
-                                        "WHERE ogc_fid = "+str(child)+" "
-                                        "AND "+branch+"_rev_end IS NULL")
-                        pcurcpy.execute("INSERT INTO "+wcs+"."+table+"_conflicts "
-                                        "SELECT "+str(cflt_id) +
-                                        " AS conflict_id, "
-                                        "'theirs' AS origin, 'deleted' AS action, "+cols+" "
-                                        "FROM "+wcs+"."+table+"_diff "
-                                        "WHERE ogc_fid = "+str(child)+" "
-                                        "AND "+branch+"_rev_end IS NOT NULL")
+                follow_conflict_children(pcurcpy, wcs+"."+table+"_conflicts",
+                                         wcs+"."+table+"_diff", "ogc_fid",
+                                         branch, cols)
 
                 pcurcpy.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
                                 + table+"_conflicts_idx ON "+wcs+"."+table+"_conflicts(ogc_fid)")
@@ -374,17 +313,10 @@ class pgVersioningLocal(object):
             # insert and replace all in diff
             pkey = pg_pk(pcurcpy, wcs, table)
             
-            pcurcpy.execute("""
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_schema = '{table_schema}'
-                AND table_name = '{table}'
-                """.format(table_schema=wcs, table=table))
             history_columns = [pkey]
             cols = ""
             coli = ""
-            allcols = pcurcpy.fetchall()
-            for [col] in allcols:
+            for col in pg_column_names(pcurcpy, wcs, table):
                 if col not in history_columns:
                     cols = quote_ident(col)+", "+cols
                     coli = quote_ident(col)+", "+coli
@@ -401,29 +333,32 @@ class pgVersioningLocal(object):
         pcurcpy.commit()
         pcurcpy.close()
 
-    def checkout(self, connection, pg_table_names, selected_feature_lists=[]):
+    def checkout(self, connection, pg_table_names, selected_feature_lists=[],
+                 workers=None):
         (pg_conn_info, wcs, pg_conn_info_copy) = connection
         """create working copy from versioned database tables
         pg_table_names must be complete schema.table names
         the schema name must end with _branch_rev_head
         the views and trigger for local edition will be created
-        along with the tables and triggers for conflict resolution"""
+        along with the tables and triggers for conflict resolution
+        workers is the number of tables copied concurrently, see
+        checkout_workers"""
 
         tables = get_checkout_tables(pg_conn_info, pg_table_names,
-                                     selected_feature_lists)
+                                     selected_feature_lists, self.pool)
 
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
+        pcur = pg_connect(pg_conn_info, self.pool)
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
 
         pcurcpy.execute("CREATE SCHEMA " + wcs)
+        pcurcpy.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
         pcurcpy.commit()
 
         temp_view_names = []
-        first_table = True
+        temp_table_names = []
+        layers = []
         for (schema, table, branch), feature_list in tables.items():
 
-            constraint_builder = ConstraintBuilder(pcur, pcurcpy, schema, wcs)
-
             # fetch the current rev
             pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
             current_rev = int(pcur.fetchone()[0])
@@ -438,96 +373,82 @@ class pgVersioningLocal(object):
             temp_view_name = schema+"."+table+"_checkout_temp_view"
             temp_view_names.append(temp_view_name)
 
-            # export schema and tables to the database
-            tmp_dir = tempfile.gettempdir()
-            tmp_dump = os.path.join(tmp_dir, "versioning.sql")
-            # use ogr2ogr to create the dump
-            if first_table:
-                first_table = False
-                # We use the same logic as spatialite
-                # TODO: improve postgresql logic
-                pcur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = \'" +
-                             schema+"\' AND table_name   = \'"+table+"\'")
-                column_list = pcur.fetchall()
-                new_columns_str = preserve_fid(pkey, column_list)
-                view_str = f"""
-                CREATE OR REPLACE VIEW {temp_view_name} AS
-                SELECT {new_columns_str} FROM {schema}.{table}"""
-                if feature_list:
-                    actual_table_pk = get_pkey(pcur, schema, table)
-                    fids_str = ",".join([str(feature_list[i]) for i in range(0, len(feature_list))])
-                    view_str += f" WHERE {actual_table_pk} in ({fids_str})"
-                pcur.execute(view_str)
-                pcur.commit()
+            # We use the same logic as spatialite
+            # TODO: improve postgresql logic
+            column_list = [[col] for col in pg_column_names(pcur, schema, table)]
+            new_columns_str = preserve_fid(pkey, column_list)
+            view_str = f"""
+            CREATE OR REPLACE VIEW {temp_view_name} AS
+            SELECT {new_columns_str} FROM {schema}.{table}"""
+            if feature_list:
+                # selected features are staged in a table joined by the view
+                filter_pk = get_pkey(pcur, schema, table) if not layers else pkey
+                temp_table_name = schema+"."+table+"_checkout_temp_fids"
+                temp_table_names.append(temp_table_name)
+                fids = stage_features(pcur, temp_table_name, schema, table,
+                                      filter_pk, feature_list)
+                view_str += f" WHERE {filter_pk} IN {fids}"
+            pcur.execute(view_str)
+            pcur.commit()
 
-                pgeom = pg_geom(pcur, schema, table)
-                cmd = ['ogr2ogr',
-                       '-lco', 'schema=' + wcs,
-                       '-lco', 'DROP_TABLE=OFF',
-                       '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                       '-f', 'PGDump',
-                       '"' + tmp_dump + '"',
-                       'PG:"'+pg_conn_info+' tables=' + wcs + '.' + table + '"', temp_view_name,
-                       '-nln', table]
+            pgeom = pg_geom(pcur, schema, table)
+            layers.append((schema, table, branch, current_rev, max_pg_pk,
+                           temp_view_name, pgeom))
+
+        # copy the tables to the database, with several workers each table
+        # is copied by its own connections
+        workers = checkout_workers(workers)
+
+        def transfer(temp_view_name, table, pgeom):
+            if workers == 1:
+                self.transfer.pg_to_pg(
+                    pg_conn_info, pcur, temp_view_name,
+                    pg_conn_info_copy, pcurcpy, wcs+'.'+table,
+                    fid='ogc_fid', geometry_name=pgeom)
+                return
+            tpcur = pg_connect(pg_conn_info, self.pool)
+            tpcurcpy = pg_connect(pg_conn_info_copy, self.pool)
+            try:
+                self.transfer.pg_to_pg(
+                    pg_conn_info, tpcur, temp_view_name,
+                    pg_conn_info_copy, tpcurcpy, wcs+'.'+table,
+                    fid='ogc_fid', geometry_name=pgeom)
+            finally:
+                tpcurcpy.close()
+                tpcur.close()
+
+        run_parallel(transfer, [(temp_view_name, table, pgeom)
+                                for (schema, table, branch, current_rev,
+                                     max_pg_pk, temp_view_name, pgeom)
+                                in layers], workers)
 
-                if DEBUG:
-                    print(' '.join(cmd))
-                
-                os.system(' '.join(cmd))
-                pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
-                pcurcpy.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
-                pcurcpy.execute(open(tmp_dump, "r").read().replace(
-                    "CREATE SCHEMA", "CREATE SCHEMA IF NOT EXISTS"))
-                pcurcpy.commit()
+        first_table = True
+        for (schema, table, branch, current_rev, max_pg_pk, temp_view_name,
+             pgeom) in layers:
 
+            constraint_builder = ConstraintBuilder(pcur, pcurcpy, schema, wcs,
+                                                   branch)
+            constraint_builder.create_indexes(table)
+
+            if first_table:
+                first_table = False
                 # save target revision in a table
                 pcurcpy.execute("CREATE TABLE "+wcs+".initial_revision AS SELECT " +
                                 str(current_rev)+" AS rev, '" +
                                 str(branch)+"'::text AS branch, '" +
                                 str(schema)+"'::text AS table_schema, '" +
                                 str(table)+"'::text AS table_name, " +
-                                str(max_pg_pk)+" AS max_pk")
+                                str(max_pg_pk)+" AS max_pk, "
+                                "0 AS changes")
                 pcurcpy.commit()
 
             else:
-                # Same comments as in 'if feature_list' above
-                pcur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = \'" +
-                             schema+"\' AND table_name   = \'"+table+"\'")
-                column_list = pcur.fetchall()
-                new_columns_str = preserve_fid(pkey, column_list)
-                view_str = "CREATE OR REPLACE VIEW "+temp_view_name + \
-                    " AS SELECT "+new_columns_str+" FROM " + schema+"."+table
-                if feature_list:
-                    view_str = "CREATE OR REPLACE VIEW "+temp_view_name+" AS SELECT "+new_columns_str+" FROM " + schema+"." + \
-                        table+" WHERE "+pkey + \
-                        ' in ('+",".join([str(feature_list[i])
-                                          for i in range(0, len(feature_list))])+')'
-                pcur.execute(view_str)
-                pcur.commit()
-
-                pgeom = pg_geom(pcur, schema, table)
-                cmd = ['ogr2ogr',
-                       '-lco', 'schema=' + wcs,
-                       '-lco', 'DROP_TABLE=OFF',
-                       '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                       '-f', 'PGDump',
-                       '"' + tmp_dump + '"',
-                       'PG:"'+pg_conn_info+' tables=' + wcs + '.' + table + '"', temp_view_name,
-                       '-nln', table]
-                
-                if DEBUG:
-                    print(' '.join(cmd))
-                os.system(' '.join(cmd))
-                pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
-                pcurcpy.execute(open(tmp_dump, "r").read().replace(
-                    "CREATE SCHEMA", "CREATE SCHEMA IF NOT EXISTS"))
-                pcurcpy.commit()
-
                 # save target revision in a table if not in there
                 pcurcpy.execute("INSERT INTO "+wcs+".initial_revision"
-                                "(rev, branch, table_schema, table_name, max_pk) "
+                                "(rev, branch, table_schema, table_name, max_pk, "
+                                "changes) "
                                 "VALUES ("+str(current_rev)+", '"+branch+"', '" +
-                                schema+"', '"+table+"', "+str(max_pg_pk)+")")
+                                schema+"', '"+table+"', "+str(max_pg_pk)+", 0)")
                 pcurcpy.commit()
 
             # create views and triggers in postgresql copy
@@ -535,7 +456,7 @@ class pgVersioningLocal(object):
             newcols = ""
             hcols = ['ogc_fid'] + sum([[brch+'_rev_begin', brch+'_rev_end',
                                         brch+'_parent', brch+'_child'] for brch in pg_branches(pcur, schema)], [])
-            for res in pcurcpy.execute(self.__pragmaTableInfo(wcs, table)).fetchall():
+            for res in self.__pragmaTableInfo(pcurcpy, wcs, table):
                 if res[1].lower() not in [c.lower() for c in hcols]:
                     cols += quote_ident(res[1]) + ", "
                     newcols += "new."+quote_ident(res[1])+", "
@@ -711,11 +632,34 @@ class pgVersioningLocal(object):
                             "EXECUTE PROCEDURE "+wcs+".delete_"+table+"();")
             pcurcpy.commit()
 
+            # edits are counted so that commit skips untouched tables, the
+            # statement trigger fires once per statement handled by the
+            # row triggers above
+            pcurcpy.execute("CREATE OR REPLACE FUNCTION " +
+                            wcs+".count_changes() RETURNS trigger AS $$\n"
+                            "BEGIN\n"
+                            "UPDATE "+wcs+".initial_revision "
+                            "SET changes = changes + 1 "
+                            "WHERE table_name = TG_ARGV[0];\n"
+                            "RETURN NULL;\n"
+                            "END;\n"
+                            "$$ LANGUAGE plpgsql;")
+            pcurcpy.execute("CREATE TRIGGER "
+                            "count_changes_"+table+" "
+                            "AFTER INSERT OR UPDATE OR DELETE "
+                            "ON "+wcs+"."+table+"_view "
+                            "FOR EACH STATEMENT "
+                            "EXECUTE PROCEDURE "+wcs+".count_changes('"+table+"');")
+            pcurcpy.commit()
+
         # Remove temp views after sqlite file is written
         for i in temp_view_names:
             del_view_str = "DROP VIEW IF EXISTS " + i
             pcur.execute(del_view_str)
             pcur.commit()
+        for i in temp_table_names:
+            pcur.execute("DROP TABLE IF EXISTS " + i)
+            pcur.commit()
 
         pcurcpy.execute("""CREATE TABLE %s.wcs_con as SELECT '%s'::text as connection""" % (wcs,
                                                                                             pg_conn_info.replace("'", "''")))
@@ -727,15 +671,13 @@ class pgVersioningLocal(object):
         (pg_conn_info, wcs, pg_conn_info_copy) = connection
         """return a list of tables with unresolved conflicts"""
         found = []
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
-        pcurcpy.execute("SELECT table_name FROM information_schema.tables "
-                        "WHERE table_schema='"+wcs+"' AND table_name LIKE '%_conflicts'")
-        for table_conflicts in pcurcpy.fetchall():
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
+        for table_conflicts in pg_tables(pcurcpy, wcs, like='%_conflicts'):
             if DEBUG:
-                print('table_conflicts:', table_conflicts[0])
-            pcurcpy.execute("SELECT * FROM "+table_conflicts[0])
+                print('table_conflicts:', table_conflicts)
+            pcurcpy.execute("SELECT * FROM "+table_conflicts)
             if pcurcpy.fetchone():
-                found.append(table_conflicts[0][:-10])
+                found.append(table_conflicts[:-10])
         pcurcpy.commit()
         pcurcpy.close()
         return found
@@ -763,7 +705,7 @@ class pgVersioningLocal(object):
                                "It's late by "+str(late_by)+" commit(s).\n\n"
                                "Please update before commiting your modifications")
 
-        pcurcpy = Db(psycopg2.connect(pg_conn_info_copy))
+        pcurcpy = pg_connect(pg_conn_info_copy, self.pool)
         pcurcpy.execute("SELECT rev, branch, table_schema, table_name "
                         "FROM "+wcs+".initial_revision")
         versioned_layers = pcurcpy.fetchall()
@@ -771,16 +713,18 @@ class pgVersioningLocal(object):
         if not versioned_layers:
             raise RuntimeError("Cannot find a versioned layer in "+wcs)
 
-        check_unique_constraints(Db(psycopg2.connect(pg_conn_info)),
-                                 pcurcpy, wcs)
-        
-        schema_list = {}  # for final cleanup
-        nb_of_updated_layer = 0
-        next_rev = 0
-        for [rev, branch, table_schema, table] in versioned_layers:
-            diff_schema = (table_schema+"_"+branch+"_"+str(rev) +
-                           "_to_"+str(rev+1)+"_diff")
+        # tables that have not been edited have nothing to commit
+        changed = changed_tables(pcurcpy, wcs)
+        if changed is not None:
+            candidate_layers = [layer for layer in versioned_layers
+                                if layer[3] in changed]
+        else:
+            candidate_layers = versioned_layers
 
+        # build the diffs locally, only the non empty ones are transfered
+        modified_layers = []
+        next_rev = 0
+        for [rev, branch, table_schema, table] in candidate_layers:
             if next_rev:
                 assert(next_rev == rev + 1)
             else:
@@ -793,7 +737,6 @@ class pgVersioningLocal(object):
             if DEBUG:
                 print(sql)
             pcurcpy.execute(sql)
-            pcurcpy.commit()
 
             pcurcpy.execute("INSERT INTO "+wcs+"."+table+"_diff "
                             "SELECT * "
@@ -805,8 +748,30 @@ class pgVersioningLocal(object):
             if DEBUG:
                 print("there_is_something_to_commit ",
                       there_is_something_to_commit)
+
+            if there_is_something_to_commit:
+                modified_layers.append([rev, branch, table_schema, table])
+            else:
+                if DEBUG:
+                    print("nothing to commit for ", wcs+"."+table)
+                pcurcpy.execute("DROP TABLE "+wcs+"."+table+"_diff")
             pcurcpy.commit()
 
+        if not modified_layers:
+            if changed is not None:
+                pcurcpy.execute("UPDATE "+wcs+".initial_revision "
+                                "SET changes = 0")
+            pcurcpy.commit()
+            pcurcpy.close()
+            return 0
+
+        pcur = pg_connect(pg_conn_info, self.pool)
+        diff_schema = None
+        try:
+            check_unique_constraints(
+                pcur, pcurcpy, wcs,
+                [table for [_, _, _, table] in modified_layers])
+
             # Better if we could have a QgsDataSourceURI.username()
             try:
                 pg_username = pg_conn_info.split(
@@ -814,143 +779,121 @@ class pgVersioningLocal(object):
             except (IndexError):
                 pg_username = ''
 
-            pcur = Db(psycopg2.connect(pg_conn_info))
-            pkey = pg_pk(pcur, table_schema, table)
-            pgeom = pg_geom(pcur, table_schema, table)
-
-            # import layers in postgis schema
-            pcur.execute("SELECT schema_name FROM information_schema.schemata "
-                         "WHERE schema_name = '"+diff_schema+"'")
-            if not pcur.fetchone():
-                schema_list[diff_schema] = pg_conn_info
-                pcur.execute("CREATE SCHEMA "+diff_schema)
-            pcur.execute("DROP TABLE IF EXISTS "+diff_schema+"."+table+"_diff")
+            # all the diffs are staged in a single schema
+            [rev, branch, table_schema, table] = modified_layers[0]
+            diff_schema = (table_schema+"_"+branch+"_"+str(rev) +
+                           "_to_"+str(rev+1)+"_diff")
+            pcur.execute("DROP SCHEMA IF EXISTS "+diff_schema+" CASCADE")
+            pcur.execute("CREATE SCHEMA "+diff_schema)
             pcur.commit()
-            cmd = ['ogr2ogr',
-                   '-preserve_fid',
-                   '-f',
-                   'PostgreSQL',
-                   'PG:"'+pg_conn_info+'"',
-                   '-lco', 'FID='+pkey,
-                   '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                   'PG:"'+pg_conn_info_copy+'"',
-                   wcs+"."+table+"_diff",
-                   '-nln', diff_schema+'.'+table+"_diff"]
-
-            if DEBUG:
-                print(' '.join(cmd))
-            os.system(' '.join(cmd))
 
-            for l in pcur.execute("select * from geometry_columns").fetchall():
-                if DEBUG:
-                    print(l)
-
-            # remove dif table and geometry column
-            pcurcpy.execute("DELETE FROM geometry_columns "
-                            "WHERE f_table_name = '"+wcs+"."+table+"_diff'")
-            pcurcpy.execute("DROP TABLE "+wcs+"."+table+"_diff")
-
-            if not there_is_something_to_commit:
-                if DEBUG:
-                    print("nothing to commit for ", wcs+"."+table)
-                pcur.close()
-                continue
-
-            nb_of_updated_layer += 1
-
-            pcur.execute("SELECT rev FROM "+table_schema+".revisions "
-                         "WHERE rev = "+str(rev+1))
-            if not pcur.fetchone():
-                if DEBUG:
-                    print("inserting rev ", str(rev+1))
-                pcur.execute("INSERT INTO "+table_schema+".revisions "
-                             "(rev, commit_msg, branch, author) "
-                             "VALUES ("+str(rev+1)+", '" +
-                             escape_quote(commit_msg)+"', '"+branch+"',"
-                             "'"+os_info()+":"+get_username()+"."+pg_username+"."+commit_user+"')")
+            for [rev, branch, table_schema, table] in modified_layers:
+                pkey = pg_pk(pcur, table_schema, table)
+                pgeom = pg_geom(pcur, table_schema, table)
+                self.transfer.pg_to_pg(
+                    pg_conn_info_copy, pcurcpy, wcs+"."+table+"_diff",
+                    pg_conn_info, pcur,
+                    diff_schema+'.'+table_schema+'_'+table+"_diff",
+                    fid='ogc_fid', geometry_name=pgeom, spatial_index=False,
+                    dest_fid=pkey)
+
+                pcurcpy.execute("DROP TABLE "+wcs+"."+table+"_diff")
+                pcurcpy.commit()
 
-            other_branches = pg_branches(pcur, table_schema).remove(branch)
-            other_branches = other_branches if other_branches else []
-            other_branches_columns = sum([
-                [brch+'_rev_begin', brch+'_rev_end',
-                 brch+'_parent', brch+'_child']
-                for brch in other_branches], [])
-                
-            pkey = pg_pk( pcur, table_schema, table )
-            pcur.execute("""
-                SELECT column_name, data_type
-                FROM information_schema.columns
-                WHERE table_schema = '{table_schema}'
-                AND table_name = '{table}'
-                """.format(table_schema=table_schema, table=table))
-            history_columns = [pkey]
-            cols = ""
-            coli = ""
-            allcols = pcur.fetchall()
-            for col, dtype in allcols:
-                if col not in history_columns:
-                    # Workaround for uuid type
-                    if dtype == 'uuid':
-                        cols = 'uuid('+quote_ident(col)+')'+", "+cols
+            for [rev, branch, table_schema, table] in modified_layers:
+                diff_table = diff_schema+"."+table_schema+"_"+table+"_diff"
+
+                pcur.execute("SELECT rev FROM "+table_schema+".revisions "
+                             "WHERE rev = "+str(rev+1))
+                if not pcur.fetchone():
+                    if DEBUG:
+                        print("inserting rev ", str(rev+1))
+                    pcur.execute("INSERT INTO "+table_schema+".revisions "
+                                 "(rev, commit_msg, branch, author) "
+                                 "VALUES ("+str(rev+1)+", '" +
+                                 escape_quote(commit_msg)+"', '"+branch+"',"
+                                 "'"+os_info()+":"+get_username()+"."+pg_username+"."+commit_user+"')")
+
+                pkey = pg_pk( pcur, table_schema, table )
+                history_columns = [pkey]
+                cols = ""
+                coli = ""
+                for col, dtype, _, _, _ in pg_columns(pcur, table_schema, table):
+                    if col not in history_columns:
+                        # Workaround for uuid type
+                        if dtype == 'uuid':
+                            cols = 'uuid('+quote_ident(col)+')'+", "+cols
+                        else:
+                            cols = quote_ident(col)+", "+cols
+                        coli = quote_ident(col)+", "+coli
                     else:
-                        cols = quote_ident(col)+", "+cols
-                    coli = quote_ident(col)+", "+coli
-                else:
-                    coli = quote_ident(col)+", "+coli
-                    cols = "(SELECT max({pkey}) FROM {table_schema}.{table}) + row_number() over() as ".format(table_schema=table_schema,
-                                                           table=table, pkey=pkey)+quote_ident(pkey)+", "+cols
+                        coli = quote_ident(col)+", "+coli
+                        cols = "(SELECT max({pkey}) FROM {table_schema}.{table}) + row_number() over() as ".format(table_schema=table_schema,
+                                                               table=table, pkey=pkey)+quote_ident(pkey)+", "+cols
                     
-            cols = cols[:-2] # remove last coma and space
-            coli = coli[:-2]
-            # insert inserted and modified
-            sql = """INSERT INTO {table_schema}.{table} ({coli}) 
-                SELECT {cols} FROM {diff_schema}.{table}_diff 
-                WHERE {branch}_rev_begin = {rev}""".format(table_schema=table_schema,
-                                                           table=table, coli=coli, cols=cols, diff_schema=diff_schema, branch=branch, rev=str(rev+1))
-            if DEBUG:
-                print(sql)
-            pcur.execute(sql)
-
-            # update deleted and modified
-            pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
-                         "SET ("+branch+"_rev_end, "+branch+"_child)"
-                         "=(src."+branch+"_rev_end, src."+branch+"_child) "
-                         "FROM "+diff_schema+"."+table+"_diff AS src "
-                         "WHERE dest."+pkey+" = src."+pkey+" "
-                         "AND src."+branch+"_rev_end = "+str(rev))
-
+                cols = cols[:-2] # remove last coma and space
+                coli = coli[:-2]
+                # insert inserted and modified
+                sql = """INSERT INTO {table_schema}.{table} ({coli}) 
+                    SELECT {cols} FROM {diff_table} 
+                    WHERE {branch}_rev_begin = {rev}""".format(table_schema=table_schema,
+                                                               table=table, coli=coli, cols=cols, diff_table=diff_table, branch=branch, rev=str(rev+1))
+                if DEBUG:
+                    print(sql)
+                pcur.execute(sql)
+
+                # update deleted and modified
+                pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
+                             "SET ("+branch+"_rev_end, "+branch+"_child)"
+                             "=(src."+branch+"_rev_end, src."+branch+"_child) "
+                             "FROM "+diff_table+" AS src "
+                             "WHERE dest."+pkey+" = src."+pkey+" "
+                             "AND src."+branch+"_rev_end = "+str(rev))
+
+            # all the tables are merged in a single transaction, a failure
+            # leaves none of them in the base database
             pcur.commit()
+        except Exception:
+            # the diffs are not left in the working copy, nor in the base
+            # database, e.g. when a key is already used
+            pcur.con.rollback()
+            if diff_schema:
+                pcur.execute("DROP SCHEMA IF EXISTS "+diff_schema+" CASCADE")
+                pcur.commit()
             pcur.close()
-
+            pcurcpy.con.rollback()
+            for [rev, branch, table_schema, table] in modified_layers:
+                pcurcpy.execute("DROP TABLE IF EXISTS "+wcs+"."+table+"_diff")
             pcurcpy.commit()
+            pcurcpy.close()
+            raise
 
-        if nb_of_updated_layer:
-            for [rev, branch, table_schema, table] in versioned_layers:
-                pcur = Db(psycopg2.connect(pg_conn_info))
-                pkey = pg_pk(pcur, table_schema, table)
-                pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
-                [rev] = pcur.fetchone()
-                pcur.execute("SELECT MAX("+pkey+") FROM " +
-                             table_schema+"."+table)
-                [max_pk] = pcur.fetchone()
-                if not max_pk:
-                    max_pk = 0
-                pcur.close()
-                pcurcpy.execute("UPDATE "+wcs+".initial_revision "
-                                "SET rev = "+str(rev) +
-                                ", max_pk = "+str(max_pk)+" "
-                                "WHERE table_schema = '"+table_schema+"' "
-                                "AND table_name = '"+table+"' "
-                                "AND branch = '"+branch+"'")
+        nb_of_updated_layer = len(modified_layers)
+        for [rev, branch, table_schema, table] in versioned_layers:
+            pkey = pg_pk(pcur, table_schema, table)
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
+            [rev] = pcur.fetchone()
+            pcur.execute("SELECT MAX("+pkey+") FROM " +
+                         table_schema+"."+table)
+            [max_pk] = pcur.fetchone()
+            if not max_pk:
+                max_pk = 0
+            pcurcpy.execute("UPDATE "+wcs+".initial_revision "
+                            "SET rev = "+str(rev) +
+                            ", max_pk = "+str(max_pk)+" "
+                            "WHERE table_schema = '"+table_schema+"' "
+                            "AND table_name = '"+table+"' "
+                            "AND branch = '"+branch+"'")
+        if changed is not None:
+            pcurcpy.execute("UPDATE "+wcs+".initial_revision "
+                            "SET changes = 0")
 
         pcurcpy.commit()
         pcurcpy.close()
 
         # cleanup diffs in postgis
-        for schema, conn_info in schema_list.items():
-            pcur = Db(psycopg2.connect(conn_info))
-            pcur.execute("DROP SCHEMA "+schema+" CASCADE")
-            pcur.commit()
-            pcur.close()
+        pcur.execute("DROP SCHEMA "+diff_schema+" CASCADE")
+        pcur.commit()
+        pcur.close()
 
         return nb_of_updated_layer
@@ -2,20 +2,28 @@
 
 from __future__ import absolute_import
 from .utils import *
-import psycopg2
 
 from itertools import zip_longest
+import os
+import time
+import psycopg2
 
 DEBUG=False
 
 from .constraints import ConstraintBuilder, check_unique_constraints
 
-class pgVersioningServer(object):    
-    
+class pgVersioningServer(object):
+
+    def __init__(self, pool=None):
+        """connections are taken from the optional ConnectionPool pool"""
+        self.pool = pool
+        # duration in seconds of the commit of each table by the last commit
+        self.last_commit_timings = {}
+
     def revision(self, connection ):
         (pg_conn_info, working_copy_schema) = connection
         """returns the revision the working copy was created from plus one"""
-        pcur = Db(psycopg2.connect(pg_conn_info))
+        pcur = pg_connect(pg_conn_info, self.pool)
         pcur.execute("SELECT rev "+ "FROM "+working_copy_schema+".initial_revision")
         rev = 0
         for [res] in pcur.fetchall():
@@ -26,25 +34,21 @@ class pgVersioningServer(object):
         pcur.close()
         return rev + 1    
     
-    def late(self, connection ):
+    def late(self, connection, detail=False):
         (pg_conn_info, working_copy_schema) = connection
-        """Return 0 if up to date, the number of commits in between otherwise"""
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcur.execute("SELECT rev, branch, table_schema "
+        """Return 0 if up to date, the number of commits in between otherwise,
+        see pg_late for detail"""
+        pcur = pg_connect(pg_conn_info, self.pool)
+        pcur.execute("SELECT rev, branch, table_schema, table_name "
             "FROM "+working_copy_schema+".initial_revision")
         versioned_layers = pcur.fetchall()
         if not versioned_layers:
             raise RuntimeError("Cannot find versioned layer in "
                     +working_copy_schema)
-    
-        late_by = 0
-    
-        for [rev, branch, table_schema] in versioned_layers:
-            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-                "WHERE branch = '"+branch+"'")
-            [max_rev] = pcur.fetchone()
-            late_by = max(max_rev - rev, late_by)
-    
+
+        late_by = pg_late(pcur, versioned_layers, detail)
+        pcur.close()
+
         return late_by
 
     def update(self, connection ):
@@ -52,6 +56,17 @@ class pgVersioningServer(object):
         """merge modifications since last update into working copy"""
         if DEBUG: print("update")
         wcs = working_copy_schema
+
+        pcur = pg_connect(pg_conn_info, self.pool)
+        schema = self.__functions_schema(pcur, wcs)
+        if schema:
+            geometry_column = os.environ.get('VERSIONING_GEOMETRY_COLUMN')
+            self.__call_function(pcur, wcs, "SELECT "+schema+".versioning_update("
+                "'"+wcs+"', "+("'"+escape_quote(geometry_column)+"'"
+                    if geometry_column else "NULL")+")")
+            return
+        pcur.close()
+
         if self.unresolved_conflicts([pg_conn_info, wcs]):
             raise RuntimeError("There are unresolved conflicts in "+wcs)
     
@@ -60,11 +75,12 @@ class pgVersioningServer(object):
         # merge changes and update target_revision
     
     
-        pcur = Db(psycopg2.connect(pg_conn_info))
+        pcur = pg_connect(pg_conn_info, self.pool)
         pcur.execute("SELECT rev, branch, table_schema, table_name, max_pk "
             "FROM "+wcs+".initial_revision")
         versioned_layers = pcur.fetchall()
     
+        updated = False
         for [rev, branch, table_schema, table, current_max_pk] in versioned_layers:
     
             pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
@@ -74,6 +90,7 @@ class pgVersioningServer(object):
                 if DEBUG: print("Nothing new in branch "+branch+" "
                     "in "+table_schema+"."+table+" since last update")
                 continue
+            updated = True
     
             # get the max pkey
             pkey = pg_pk( pcur, table_schema, table )
@@ -84,14 +101,10 @@ class pgVersioningServer(object):
                 max_pg_pk = 0
     
             # create the diff
-            pcur.execute("SELECT column_name "
-                    "FROM information_schema.columns "
-                    "WHERE table_schema = '"+table_schema+"' "
-                    "AND table_name = '"+table+"'")
             cols = ""
-            for col in pcur.fetchall():
-                if col[0] != pgeom:
-                    cols += quote_ident(col[0])+", "
+            for col in pg_column_names(pcur, table_schema, table):
+                if col != pgeom:
+                    cols += quote_ident(col)+", "
             cols = cols[:-2] # remove last coma and space
     
             pcur.execute("SELECT srid, type "
@@ -199,44 +212,18 @@ class pgVersioningServer(object):
                 # now follow child if any for 'theirs' 'modified'
                 # since several edition could be made
                 # we want the very last child
-                while True:
-                    pcur.execute("SELECT conflict_id, "+pkey+", "+branch+"_child "
-                        "FROM "+wcs+"."+table+"_cflt "
-                        "WHERE origin='theirs' "
-                        "AND action='modified' "
-                        "AND "+branch+"_child IS NOT NULL")
-                    res = pcur.fetchall()
-                    if not res :
-                        break
-                    # replaces each entries by it's child
-                    for [cflt_id, fid, child] in res:
-                        pcur.execute("DELETE FROM "+wcs+"."+table+"_cflt "
-                            "WHERE "+pkey+" = "+str(fid))
-                        pcur.execute("INSERT INTO "+wcs+"."+table+"_cflt "
-                            "SELECT "+str(cflt_id)+" AS conflict_id, "
-                                "'theirs' AS origin, 'modified' AS action, "
-                                +cols+" FROM "+wcs+"."+table+"_update_diff "
-                            "WHERE "+pkey+" = "+str(child)+" "
-                            "AND "+branch+"_rev_end IS NULL" )
-                        pcur.execute("INSERT INTO "+wcs+"."+table+"_cflt "
-                            "SELECT "+str(cflt_id)+" AS conflict_id, "
-                                "'theirs' AS origin, 'deleted' AS action, "
-                                +cols+" FROM "+wcs+"."+table+"_update_diff "
-                            "WHERE "+pkey+" = "+str(child)+" "
-                            "AND "+branch+"_rev_end IS NOT NULL" )
+                follow_conflict_children(pcur, wcs+"."+table+"_cflt",
+                                         wcs+"."+table+"_update_diff", pkey,
+                                         branch, cols+geom)
     
                 # create trigers such that on delete the conflict is resolved
                 # if we delete 'theirs', we set their child to our fid
                 # and their rev_end
                 # if we delete 'mine'... well, we delete 'mine'
     
-                pcur.execute("SELECT column_name "
-                        "FROM information_schema.columns "
-                        "WHERE table_schema = '"+wcs+"' "
-                        "AND table_name = '"+table+"_diff'")
                 cols = ""
-                for col in pcur.fetchall():
-                    cols += quote_ident(col[0])+", "
+                for col in pg_column_names(pcur, wcs, table+"_diff"):
+                    cols += quote_ident(col)+", "
                 cols = cols[:-2] # remove last coma and space
     
                 pcur.execute("CREATE OR REPLACE VIEW "
@@ -292,6 +279,8 @@ class pgVersioningServer(object):
                     "ADD CONSTRAINT "+table+"_"+branch+"conflicts_pk_pk "
                     "PRIMARY KEY ("+pkey+")")
     
+        if updated:
+            self.__refresh_views(pcur, wcs)
         pcur.commit()
         pcur.close()
         
@@ -300,22 +289,23 @@ class pgVersioningServer(object):
     # we need the initial_revision table all the same
     # for each table we need a diff and a view and triggers
     
-    def checkout(self, connection, pg_table_names, selected_feature_lists = []):
+    def checkout(self, connection, pg_table_names, selected_feature_lists = [],
+            workers=None):
         (pg_conn_info, working_copy_schema) = connection
         """create postgres working copy from versioned database tables
         pg_table_names must be complete schema.table names
         the schema name must end with _branch_rev_head
         the working_copy_schema must not exist
         the views and triggers for local edition will be created
-        along with the tables and triggers for conflict resolution"""
-        pcur = Db(psycopg2.connect(pg_conn_info))
+        along with the tables and triggers for conflict resolution
+        workers is ignored, no data is copied in this working copy"""
+        pcur = pg_connect(pg_conn_info, self.pool)
         wcs = working_copy_schema
-        pcur.execute("SELECT schema_name FROM information_schema.schemata "
-            "WHERE schema_name = '"+wcs+"'")
-        if pcur.fetchone():
+        if pg_schema_exists(pcur, wcs):
             raise RuntimeError("Schema "+wcs+" already exists")
 
-        tables = get_checkout_tables(pg_conn_info, pg_table_names, selected_feature_lists)
+        tables = get_checkout_tables(pg_conn_info, pg_table_names,
+                                     selected_feature_lists, self.pool)
 
         pcur.execute("CREATE SCHEMA "+wcs)
     
@@ -353,13 +343,9 @@ class pgVersioningServer(object):
                     "'"+table+"', "+str(max_pg_pk)+")" )
     
             # create diff, views and triggers
-            pcur.execute("SELECT column_name "
-                    "FROM information_schema.columns "
-                    "WHERE table_schema = '"+schema+"' "
-                    "AND table_name = '"+table+"'")
             cols = ""
             newcols = ""
-            for [col] in pcur.fetchall():
+            for col in pg_column_names(pcur, schema, table):
                 if col not in history_columns:
                     cols = quote_ident(col)+", "+cols
                     newcols = "new."+quote_ident(col)+", "+newcols
@@ -379,32 +365,24 @@ class pgVersioningServer(object):
                 "ADD COLUMN "+branch+"_child     integer "
                 "REFERENCES "+wcs+"."+table+"_diff("+pkey+") "
                 "ON UPDATE CASCADE ON DELETE CASCADE")
+            constraint_builder.create_indexes(table)
+            for geom in pg_geoms(pcur, schema, table):
+                pcur.execute("CREATE INDEX "+table+"_diff_"+geom+"_idx "
+                    "ON "+wcs+"."+table+"_diff USING gist ("+geom+")")
     
             if feature_list:
+                # selected features are staged in a table joined by the view
                 actual_table_pk = get_pkey(pcur, schema, table)
-                fids_str = ",".join([str(feature_list[i]) for i in range(0, len(feature_list))])
-                additional_filter = f"AND t.{actual_table_pk} IN ({fids_str})"
+                fids = stage_features(pcur, wcs+"."+table+"_checkout_fids",
+                                      schema, table, actual_table_pk,
+                                      feature_list)
+                additional_filter = f"AND t.{actual_table_pk} IN {fids}"
             else:
                 additional_filter = ""
     
+            pcur.execute(self.__view_sql(pcur, wcs, schema, table, branch,
+                                         current_rev, additional_filter))
             current_rev_sub = "(SELECT MAX(rev) FROM "+wcs+".initial_revision)"
-            pcur.execute(f"""
-                CREATE VIEW {wcs}.{table}_view AS 
-                    SELECT {pkey}, {cols}
-                    FROM {wcs}.{table}_diff 
-                    WHERE ({branch}_rev_end IS NULL OR {branch}_rev_end >= {current_rev_sub}+1 ) 
-                    AND {branch}_rev_begin IS NOT NULL 
-                    UNION ALL
-                    SELECT /*DISTINCT ON ({pkey})*/ t.{pkey}, {cols}
-                    FROM {schema}.{table} AS t 
-                    LEFT JOIN (SELECT {pkey} FROM {wcs}.{table}_diff) AS d ON t.{pkey} = d.{pkey} 
-                    WHERE d.{pkey} IS NULL 
-                    AND t.{branch}_rev_begin <= {current_rev_sub} 
-                    AND ((t.{branch}_rev_end IS NULL 
-                        OR t.{branch}_rev_end >= {current_rev_sub}) 
-                        AND t.{branch}_rev_begin IS NOT NULL)
-                    {additional_filter}
-                """)
     
             max_fid_sub = ("( SELECT MAX(max_fid) FROM ( SELECT MAX("+pkey+") "
                 "AS max_fid FROM "+wcs+"."+table+"_diff "
@@ -542,128 +520,276 @@ class pgVersioningServer(object):
         pcur.commit()
         pcur.close()
 
+    def __view_sql(self, pcur, wcs, schema, table, branch, rev,
+            additional_filter):
+        """Returns the statement (re)creating the view of the working copy
+        table at revision rev: the rows of the diff table and the rows of
+        the versioned table which are not in the diff. The revision is a
+        constant, so the head rows are read with the partial indexes of the
+        versioned table (see versioning.branch_indexes) and the spatial
+        filters by the GiST indexes of each branch of the union. The diff
+        is excluded by NOT EXISTS, an anti join probing the primary key of
+        the diff: a NOT IN subplan is only hashed while the diff fits in
+        work_mem and is rescanned for each row otherwise"""
+        pkey = pg_pk( pcur, schema, table )
+        history_columns = [pkey] + sum([
+            [brch+'_rev_end', brch+'_rev_begin',
+            brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, schema )],[])
+        cols = ""
+        for col in pg_column_names(pcur, schema, table):
+            if col not in history_columns:
+                cols = quote_ident(col)+", "+cols
+        cols = cols[:-2] # remove last coma and space
+        not_in_diff = (f"NOT EXISTS (SELECT 1 FROM {wcs}.{table}_diff AS d "
+                       f"WHERE d.{pkey} = t.{pkey}) {additional_filter}")
+        return f"""
+            CREATE OR REPLACE VIEW {wcs}.{table}_view AS
+                SELECT {pkey}, {cols}
+                FROM {wcs}.{table}_diff
+                WHERE ({branch}_rev_end IS NULL OR {branch}_rev_end > {rev})
+                AND {branch}_rev_begin IS NOT NULL
+                UNION ALL
+                SELECT t.{pkey}, {cols}
+                FROM {schema}.{table} AS t
+                WHERE t.{branch}_rev_end IS NULL
+                AND t.{branch}_rev_begin IS NOT NULL
+                AND t.{branch}_rev_begin <= {rev}
+                AND {not_in_diff}
+                UNION ALL
+                SELECT t.{pkey}, {cols}
+                FROM {schema}.{table} AS t
+                WHERE t.{branch}_rev_end >= {rev}
+                AND t.{branch}_rev_begin <= {rev}
+                AND {not_in_diff}
+            """
+
+    def __refresh_views(self, pcur, wcs):
+        """Recreate the views of the working copy tables for the revision
+        they are at, after an update or a commit"""
+        pcur.execute("SELECT MAX(rev) FROM "+wcs+".initial_revision")
+        [rev] = pcur.fetchone()
+        pcur.execute("SELECT branch, table_schema, table_name "
+            "FROM "+wcs+".initial_revision")
+        versioned_layers = pcur.fetchall()
+        staged = pg_tables(pcur, wcs, like='%_checkout_fids')
+        statements = []
+        for [branch, schema, table] in versioned_layers:
+            additional_filter = ""
+            if table+"_checkout_fids" in staged:
+                additional_filter = ("AND t."+get_pkey(pcur, schema, table)
+                    +" IN (SELECT fid FROM "+wcs+"."+table+"_checkout_fids)")
+            statements.append(self.__view_sql(pcur, wcs, schema, table,
+                branch, rev, additional_filter))
+        pcur.execute(";\n".join(statements))
+
     def unresolved_conflicts(self, connection ):
         (pg_conn_info, working_copy_schema) = connection
         """return a list of tables with unresolved conflicts"""
         found = []
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcur.execute("SELECT table_name FROM information_schema.tables "
-            "WHERE table_schema='"+working_copy_schema+"' "
-            "AND table_name LIKE '%_cflt'")
-        for table_conflicts in pcur.fetchall():
-            if DEBUG: print('table_conflicts:', table_conflicts[0])
+        pcur = pg_connect(pg_conn_info, self.pool)
+        for table_conflicts in pg_tables(pcur, working_copy_schema,
+                                         like='%_cflt'):
+            if DEBUG: print('table_conflicts:', table_conflicts)
             pcur.execute("SELECT * "
-                "FROM "+working_copy_schema+"."+table_conflicts[0])
+                "FROM "+working_copy_schema+"."+table_conflicts)
             if pcur.fetchone():
-                found.append( table_conflicts[0][:-5] )
+                found.append( table_conflicts[:-5] )
         pcur.commit()
         pcur.close()
         return found
-    
-    def commit(self, connection, commit_msg, commit_user=''):
-        (pg_conn_info, working_copy_schema) = connection
-        """merge modifications into database
-        returns the number of updated layers"""
-        wcs = working_copy_schema
-    
-        unresolved = self.unresolved_conflicts([pg_conn_info, wcs])
-        if unresolved:
-            raise RuntimeError("There are unresolved conflicts in "+wcs+" "
-                "for table(s) "+', '.join(unresolved) )
-    
-        late_by = self.late([pg_conn_info, wcs])
-        if late_by:
-            raise RuntimeError("Working copy "+working_copy_schema+" "
-                "is not up to date. It's late by "+str(late_by)+" commit(s).\n\n"
-                "Please update before committing your modifications")
 
-        # Better if we could have a QgsDataSourceURI.username()
-        try :
-            pg_username = pg_conn_info.split(' ')[3].replace("'","").split('=')[1]
-        except (IndexError):
-            pg_username = ''
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        pcur.execute("SELECT rev, branch, table_schema, table_name "
-            "FROM "+wcs+".initial_revision")
-        versioned_layers = pcur.fetchall()
+    def __functions_schema(self, pcur, wcs):
+        """Returns the schema holding the versioning_update and
+        versioning_commit functions (see sql/functions.sql) if they are
+        enabled with VERSIONING_SERVER_FUNCTIONS=1 and installed, in their
+        current version, in every versioned schema of the working copy,
+        None otherwise"""
+        if os.environ.get('VERSIONING_SERVER_FUNCTIONS') != '1':
+            return None
+        pcur.execute("SELECT DISTINCT table_schema "
+            "FROM "+wcs+".initial_revision ORDER BY table_schema")
+        schemas = [schema for [schema] in pcur.fetchall()]
+        if not schemas:
+            return None
+        pcur.execute("SELECT bool_and("
+            "to_regprocedure(s || '.versioning_update(text, text)') IS NOT NULL "
+            "AND to_regprocedure(s || '.versioning_commit(text, text, text)') "
+            "IS NOT NULL "
+            "AND to_regprocedure(s || '.versioning_functions_version()') "
+            "IS NOT NULL) "
+            "FROM unnest(ARRAY['"+"', '".join(schemas)+"']) AS s")
+        [installed] = pcur.fetchone()
+        if not installed:
+            return None
+        pcur.execute("SELECT bool_and(version = "
+            +str(SERVER_FUNCTIONS_VERSION)+") FROM ("+" UNION ALL ".join(
+            "SELECT "+schema+".versioning_functions_version() AS version"
+            for schema in schemas)+") AS versions")
+        [current] = pcur.fetchone()
+        return schemas[0] if current else None
 
-        check_unique_constraints(pcur, pcur, wcs)
+    def __call_function(self, pcur, wcs, sql):
+        """Run and commit the call of a server side function, its errors
+        are raised as RuntimeError like the python implementation ones.
+        Unless the function returns 0 (nothing committed), the views of the
+        working copy wcs are recreated in the same transaction, so that
+        they never lag behind initial_revision"""
+        try:
+            pcur.execute(sql)
+            [res] = pcur.fetchone()
+            if res != 0:
+                self.__refresh_views(pcur, wcs)
+        except psycopg2.Error as e:
+            pcur.con.rollback()
+            pcur.close()
+            raise RuntimeError(e.diag.message_primary or str(e))
+        except Exception:
+            pcur.con.rollback()
+            pcur.close()
+            raise
+        pcur.commit()
+        pcur.close()
+        return res
 
-        if not versioned_layers:
-            raise RuntimeError("Cannot find a versioned layer in "+wcs)
-    
-    
-        nb_of_updated_layer = 0
+    def __commit_plan(self, pcur, wcs, versioned_layers, commit_msg, author):
+        """Returns the (table, sql) list of statements committing the
+        modified tables of the working copy, the metadata of all the tables
+        is gathered before anything is written"""
+        branches = {}
+        for [rev, branch, table_schema, table] in versioned_layers:
+            if table_schema not in branches:
+                branches[table_schema] = pg_branches(pcur, table_schema)
+
+        # tables with something to commit, in one query
+        pcur.execute(" UNION ALL ".join([
+            "SELECT '"+table+"', EXISTS (SELECT 1 FROM "+wcs+"."+table+"_diff)"
+            for [rev, branch, table_schema, table] in versioned_layers]))
+        modified = set(table for table, exists in pcur.fetchall() if exists)
+
+        plan = []
+        revised_schemas = set()
         next_rev = 0
         for [rev, branch, table_schema, table] in versioned_layers:
             if next_rev:
                 assert( next_rev == rev + 1 )
             else: next_rev = rev + 1
-    
+
+            if table not in modified:
+                if DEBUG: print("nothing to commit for ", table)
+                continue
+
             pkey = pg_pk( pcur, table_schema, table )
             history_columns = [pkey] + sum([
                 [brch+'_rev_end', brch+'_rev_begin',
-                brch+'_child', brch+'_parent' ] for brch in pg_branches( pcur, table_schema )],[])
-            pcur.execute("SELECT column_name "
-                    "FROM information_schema.columns "
-                    "WHERE table_schema = '"+table_schema+"' "
-                    "AND table_name = '"+table+"'")
+                brch+'_child', brch+'_parent' ] for brch in branches[table_schema]],[])
             cols = ""
-            for [col] in pcur.fetchall():
+            for col in pg_column_names(pcur, table_schema, table):
                 if col not in history_columns:
                     cols = quote_ident(col)+", "+cols
             cols = cols[:-2] # remove last coma and space
             hcols = (pkey+", "+branch+"_rev_begin, "+branch+"_rev_end, "
                     +branch+"_parent, "+branch+"_child")
-    
-            pcur.execute( "SELECT "+pkey+" FROM "+wcs+"."+table+"_diff")
-            there_is_something_to_commit = pcur.fetchone()
-    
-            if not there_is_something_to_commit:
-                if DEBUG: print("nothing to commit for ", table)
-                continue
-            nb_of_updated_layer += 1
-    
-            pcur.execute("SELECT rev FROM "+table_schema+".revisions "
-                "WHERE rev = "+str(rev+1))
-            if not pcur.fetchone():
-                if DEBUG: print("inserting rev ", str(rev+1))
-                pcur.execute("INSERT INTO "+table_schema+".revisions "
+
+            statements = []
+            if table_schema not in revised_schemas:
+                revised_schemas.add(table_schema)
+                statements.append("INSERT INTO "+table_schema+".revisions "
                     "(rev, commit_msg, branch, author) "
-                    "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+"', '"+branch+"',"
-                    "'"+os_info()+":"+get_username()+"."+pg_username+"')")
-    
+                    "SELECT "+str(rev+1)+", '"+escape_quote(commit_msg)+"', "
+                    "'"+branch+"', '"+escape_quote(author)+"' "
+                    "WHERE NOT EXISTS (SELECT 1 FROM "+table_schema+".revisions "
+                    "WHERE rev = "+str(rev+1)+")")
+
             # insert inserted and modified
-            pcur.execute("INSERT INTO "+table_schema+"."+table+" "
+            statements.append("INSERT INTO "+table_schema+"."+table+" "
                 "("+cols+", "+hcols+") "
                 "SELECT "+cols+", "+hcols+" FROM "+wcs+"."+table+"_diff "
                 "WHERE "+branch+"_rev_begin = "+str(rev+1))
-    
+
             # update deleted and modified
-            pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
+            statements.append("UPDATE "+table_schema+"."+table+" AS dest "
                     "SET ("+branch+"_rev_end, "+branch+"_child)"
                         "=(src."+branch+"_rev_end, src."+branch+"_child) "
                     "FROM "+wcs+"."+table+"_diff AS src "
                     "WHERE dest."+pkey+" = src."+pkey+" "
                     "AND src."+branch+"_rev_end = "+str(rev))
-    
-            if DEBUG: print("truncate diff for ", table)
+
             # clears the diff
-            pcur.execute("TRUNCATE TABLE "+wcs+"."+table+"_diff CASCADE")
-            #pcur.execute("DELETE FROM "+wcs+"."+table+"_diff_pkey")
-            if DEBUG: print("diff truncated for ", table)
-    
-        if nb_of_updated_layer:
-            for [rev, branch, table_schema, table] in versioned_layers:
-                pkey = pg_pk( pcur, table_schema, table )
-                pcur.execute("UPDATE "+wcs+".initial_revision "
-                    "SET (rev, max_pk) "
-                    "= ((SELECT MAX(rev) FROM "+table_schema+".revisions), "
-                        "(SELECT MAX("+pkey+") FROM "+table_schema+"."+table+")) "
-                    "WHERE table_schema = '"+table_schema+"' "
-                    "AND table_name = '"+table+"' "
-                    "AND branch = '"+branch+"'")
+            statements.append("TRUNCATE TABLE "+wcs+"."+table+"_diff CASCADE")
+
+            plan.append((table, ";\n".join(statements)))
+        return plan
+
+    def commit(self, connection, commit_msg, commit_user=''):
+        (pg_conn_info, working_copy_schema) = connection
+        """merge modifications into database
+        returns the number of updated layers"""
+        wcs = working_copy_schema
+
+        # Better if we could have a QgsDataSourceURI.username()
+        try :
+            pg_username = pg_conn_info.split(' ')[3].replace("'","").split('=')[1]
+        except (IndexError):
+            pg_username = ''
+        author = os_info()+":"+get_username()+"."+pg_username
+
+        pcur = pg_connect(pg_conn_info, self.pool)
+        schema = self.__functions_schema(pcur, wcs)
+        if schema:
+            self.last_commit_timings = {}
+            return self.__call_function(pcur, wcs, "SELECT "
+                +schema+".versioning_commit("
+                "'"+wcs+"', '"+escape_quote(commit_msg)+"', "
+                "'"+escape_quote(author)+"')")
+        pcur.close()
+
+        unresolved = self.unresolved_conflicts([pg_conn_info, wcs])
+        if unresolved:
+            raise RuntimeError("There are unresolved conflicts in "+wcs+" "
+                "for table(s) "+', '.join(unresolved) )
     
+        late_by = self.late([pg_conn_info, wcs])
+        if late_by:
+            raise RuntimeError("Working copy "+working_copy_schema+" "
+                "is not up to date. It's late by "+str(late_by)+" commit(s).\n\n"
+                "Please update before committing your modifications")
+
+        pcur = pg_connect(pg_conn_info, self.pool)
+        pcur.execute("SELECT rev, branch, table_schema, table_name "
+            "FROM "+wcs+".initial_revision")
+        versioned_layers = pcur.fetchall()
+
+        check_unique_constraints(pcur, pcur, wcs)
+
+        if not versioned_layers:
+            raise RuntimeError("Cannot find a versioned layer in "+wcs)
+
+        plan = self.__commit_plan(pcur, wcs, versioned_layers, commit_msg,
+                                  author)
+
+        # one round trip per table, timed
+        self.last_commit_timings = {}
+        for table, sql in plan:
+            start = time.perf_counter()
+            pcur.execute(sql)
+            self.last_commit_timings[table] = time.perf_counter() - start
+            if DEBUG: print("committed ", table, " in ",
+                            self.last_commit_timings[table], "s")
+
+        if plan:
+            pcur.execute(";\n".join([
+                "UPDATE "+wcs+".initial_revision "
+                "SET (rev, max_pk) "
+                "= ((SELECT MAX(rev) FROM "+table_schema+".revisions), "
+                    "(SELECT MAX("+pg_pk(pcur, table_schema, table)+") "
+                    "FROM "+table_schema+"."+table+")) "
+                "WHERE table_schema = '"+table_schema+"' "
+                "AND table_name = '"+table+"' "
+                "AND branch = '"+branch+"'"
+                for [rev, branch, table_schema, table] in versioned_layers]))
+            self.__refresh_views(pcur, wcs)
+
+        nb_of_updated_layer = len(plan)
         pcur.commit()
         pcur.close()
         return nb_of_updated_layer
@@ -7,9 +7,20 @@ from itertools import zip_longest
 import os
 DEBUG=False
 
+# seconds a worker waits for the other ones to release the spatialite file
+SQLITE_TIMEOUT = 600
+
 from .constraints import ConstraintBuilder, check_unique_constraints
+from .transfer import get_transfer, sqlite_geometry_columns
 
 class spVersioning(object):
+
+    def __init__(self, transfer=None, pool=None):
+        """transfer is the engine used to copy tables between postgres and
+        spatialite, see transfer.get_transfer, postgres connections are
+        taken from the optional ConnectionPool pool"""
+        self.transfer = transfer if transfer else get_transfer()
+        self.pool = pool
     
     def revision(self, connection ):
         sqlite_filename = connection[0]
@@ -25,24 +36,21 @@ class spVersioning(object):
         scur.close()
         return rev+ 1
     
-    def late(self, connection ):
+    def late(self, connection, detail=False):
         (sqlite_filename, pg_conn_info) = connection
-        """Return 0 if up to date, the number of commits in between otherwise"""
+        """Return 0 if up to date, the number of commits in between otherwise,
+        see pg_late for detail"""
         scur = Db(dbapi2.connect(sqlite_filename))
-        scur.execute("SELECT rev, branch, table_schema "
+        scur.execute("SELECT rev, branch, table_schema, table_name "
             "FROM initial_revision")
         versioned_layers = scur.fetchall()
+        scur.close()
         if not versioned_layers:
             raise RuntimeError("Cannot find versioned layer in "+sqlite_filename)
     
-        late_by = 0
-    
-        for [rev, branch, table_schema] in versioned_layers:
-            pcur = Db(psycopg2.connect(pg_conn_info))
-            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
-                "WHERE branch = '"+branch+"'")
-            [max_rev] = pcur.fetchone()
-            late_by = max(max_rev - rev, late_by)
+        pcur = pg_connect(pg_conn_info, self.pool)
+        late_by = pg_late(pcur, versioned_layers, detail)
+        pcur.close()
     
         return late_by
     
@@ -61,12 +69,13 @@ class spVersioning(object):
         # delete diff
     
         scur = Db(dbapi2.connect(sqlite_filename))
+        sqlite_bulk_load(scur)
         scur.execute("SELECT rev, branch, table_schema, table_name, max_pk "
             "FROM initial_revision")
         versioned_layers = scur.fetchall()
     
         for [rev, branch, table_schema, table, current_max_pk] in versioned_layers:
-            pcur = Db(psycopg2.connect(pg_conn_info))
+            pcur = pg_connect(pg_conn_info, self.pool)
             pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions "
                 "WHERE branch = '"+branch+"'")
             [max_rev] = pcur.fetchone()
@@ -88,9 +97,7 @@ class spVersioning(object):
             # create the diff
             diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
                 "_to_"+str(max_rev)+"_diff")
-            pcur.execute("SELECT schema_name FROM information_schema.schemata "
-                "WHERE schema_name = '"+diff_schema+"'")
-            if not pcur.fetchone():
+            if not pg_schema_exists(pcur, diff_schema):
                 pcur.execute("CREATE SCHEMA "+diff_schema)
     
             other_branches = pg_branches( pcur, table_schema ).remove(branch)
@@ -99,14 +106,10 @@ class spVersioning(object):
                 [brch+'_rev_begin', brch+'_rev_end',
                 brch+'_parent', brch+'_child']
                 for brch in other_branches], [])
-            pcur.execute("SELECT column_name "
-                    "FROM information_schema.columns "
-                    "WHERE table_schema = '"+table_schema+"' "
-                    "AND table_name = '"+table+"'")
             cols = ""
-            for col in pcur.fetchall():
-                if col[0] not in pgeoms and col[0] not in other_branches_columns:
-                    cols += quote_ident(col[0])+", "
+            for col in pg_column_names(pcur, table_schema, table):
+                if col not in pgeoms and col not in other_branches_columns:
+                    cols += quote_ident(col)+", "
             cols = cols[:-2] # remove last coma and space
             pcur.execute("""
                 SELECT f_geometry_column, srid, type
@@ -138,18 +141,10 @@ class spVersioning(object):
             scur.commit()
     
             # import the diff to spatialite
-            cmd = ['ogr2ogr',
-                   '-preserve_fid',
-                   '-lco', 'FID=ogc_fid',
-                   '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                   '-f', 'SQLite',
-                   '-update',
-                   '"' + sqlite_filename + '"',
-                   'PG:"'+pg_conn_info+'"',
-                   diff_schema+'.'+table+"_diff",
-                   '-nln', table+"_diff"]
-            if DEBUG: print(' '.join(cmd))
-            os.system(' '.join(cmd))
+            self.transfer.pg_to_sqlite(
+                pg_conn_info, pcur, diff_schema+'.'+table+"_diff",
+                sqlite_filename, scur, table+"_diff",
+                fid=pkey, geometry_name=pgeom, spatial_index=False)
     
             # cleanup in postgis
             pcur.execute("DROP SCHEMA "+diff_schema+" CASCADE")
@@ -245,29 +240,9 @@ class spVersioning(object):
     
                 # now follow child if any for 'theirs' 'modified' since several
                 # edition could be made we want the very last child
-                while True:
-                    scur.execute("SELECT conflict_id, ogc_fid, "+branch+"_child "
-                        "FROM "+table+"_conflicts WHERE origin='theirs' "
-                        "AND action='modified' AND "+branch+"_child IS NOT NULL")
-                    res = scur.fetchall()
-                    if not res :
-                        break
-                    # replaces each entries by it's child
-                    for [cflt_id, fid, child] in res:
-                        scur.execute("DELETE FROM "+table+"_conflicts "
-                            "WHERE ogc_fid = "+str(fid))
-                        scur.execute("INSERT INTO "+table+"_conflicts "
-                            "SELECT "+str(cflt_id)+" AS conflict_id, "
-                            "'theirs' AS origin, 'modified' AS action, "+cols+" "
-                            "FROM "+table+"_diff "
-                            "WHERE ogc_fid = "+str(child)+" "
-                            "AND "+branch+"_rev_end IS NULL" )
-                        scur.execute("INSERT INTO "+table+"_conflicts "
-                            "SELECT "+str(cflt_id)+" AS conflict_id, "
-                            "'theirs' AS origin, 'deleted' AS action, "+cols+" "
-                            "FROM "+table+"_diff "
-                            "WHERE ogc_fid = "+str(child)+" "
-                            "AND "+branch+"_rev_end IS NOT NULL" )
+                follow_conflict_children(scur, table+"_conflicts",
+                                         table+"_diff", "ogc_fid", branch,
+                                         cols)
     
                 scur.execute("DELETE FROM geometry_columns "
                     "WHERE f_table_name = '"+table+"_conflicts'")
@@ -320,26 +295,41 @@ class spVersioning(object):
             scur.execute("INSERT OR REPLACE INTO "+table+" ("+cols+") "
                 "SELECT "+cols+" FROM "+table+"_diff")
     
-        scur.commit()
+        sqlite_end_bulk_load(scur)
         scur.close()
         
-    def checkout(self, connection, pg_table_names, selected_feature_lists = []):
+    def checkout(self, connection, pg_table_names, selected_feature_lists = [],
+            workers=None):
         (sqlite_filename, pg_conn_info) = connection
         """create working copy from versioned database tables
         pg_table_names must be complete schema.table names
         the schema name must end with _branch_rev_head
         the file sqlite_filename must not exists
         the views and trigger for local edition will be created
-        along with the tables and triggers for conflict resolution"""
+        along with the tables and triggers for conflict resolution
+        workers is the number of tables copied concurrently, see
+        checkout_workers"""
 
         if os.path.isfile(sqlite_filename):
             raise RuntimeError("File "+sqlite_filename+" already exists")
+        # the WAL of a removed working copy would be replayed in the new one
+        for ext in ['-wal', '-shm']:
+            if os.path.isfile(sqlite_filename+ext):
+                os.remove(sqlite_filename+ext)
 
-        tables = get_checkout_tables(pg_conn_info, pg_table_names, selected_feature_lists)
-        pcur = Db(psycopg2.connect(pg_conn_info))
+        tables = get_checkout_tables(pg_conn_info, pg_table_names,
+                                     selected_feature_lists, self.pool)
+        pcur = pg_connect(pg_conn_info, self.pool)
+
+        # create the spatialite db
+        scur = Db(dbapi2.connect(sqlite_filename))
+        scur.execute("SELECT InitSpatialMetadata(1)")
+        scur.commit()
+        sqlite_bulk_load(scur)
     
         temp_view_names = []
-        first_table = True
+        temp_table_names = []
+        layers = []
         for (schema, table, branch), feature_list in tables.items():
 
             # fetch the current rev
@@ -355,83 +345,91 @@ class spVersioning(object):
     
             temp_view_name = schema+"."+table+"_checkout_temp_view"
             temp_view_names.append(temp_view_name)
-            # use ogr2ogr to create spatialite db
             pgeom = pg_geom(pcur, schema, table)
+            # We need to create a temp view because of windows commandline
+            # limitations with the ogr2ogr transfer, e.g. ogr2ogr with a
+            # very long where clause
+            # Get column names because we cannot just call 'SELECT *'
+            column_list = [[col] for col in pg_column_names(pcur, schema, table)]
+            new_columns_str = preserve_fid( pkey, column_list)
+            view_str = f"""
+            CREATE OR REPLACE VIEW {temp_view_name} AS
+            SELECT {new_columns_str} FROM {schema}.{table}"""
+            if feature_list:
+                # selected features are staged in a table joined by the view
+                filter_pk = get_pkey(pcur, schema, table) if not layers else pkey
+                temp_table_name = schema+"."+table+"_checkout_temp_fids"
+                temp_table_names.append(temp_table_name)
+                fids = stage_features(pcur, temp_table_name, schema, table,
+                                      filter_pk, feature_list)
+                view_str += f" WHERE {filter_pk} IN {fids}"
+            pcur.execute(view_str)
+            pcur.commit()
+
+            layers.append((schema, table, branch, current_rev, max_pg_pk,
+                           temp_view_name, pgeom))
+
+        # copy the data, with several workers each table is copied by its
+        # own connections, only the writes to the spatialite file are
+        # serialized by sqlite
+        workers = checkout_workers(workers)
+        if not self.transfer.concurrent_sqlite:
+            workers = 1
+
+        # the spatial indexes are built once all the tables are loaded
+        def transfer(temp_view_name, table, pgeom):
+            if workers == 1:
+                self.transfer.pg_to_sqlite(
+                    pg_conn_info, pcur, temp_view_name,
+                    sqlite_filename, scur, table,
+                    fid='ogc_fid', geometry_name=pgeom, spatial_index=False)
+                return
+            tpcur = pg_connect(pg_conn_info, self.pool)
+            tscur = Db(dbapi2.connect(sqlite_filename, timeout=SQLITE_TIMEOUT))
+            sqlite_bulk_load(tscur)
+            try:
+                self.transfer.pg_to_sqlite(
+                    pg_conn_info, tpcur, temp_view_name,
+                    sqlite_filename, tscur, table,
+                    fid='ogc_fid', geometry_name=pgeom, spatial_index=False)
+            finally:
+                tscur.close()
+                tpcur.close()
+
+        run_parallel(transfer, [(temp_view_name, table, pgeom)
+                                for (schema, table, branch, current_rev,
+                                     max_pg_pk, temp_view_name, pgeom)
+                                in layers], workers)
+
+        first_table = True
+        for (schema, table, branch, current_rev, max_pg_pk, temp_view_name,
+             pgeom) in layers:
             if first_table:
                 first_table = False
-                cmd = ['ogr2ogr',
-                        '-f', 'SQLite',
-                       '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                        '-dsco', 'SPATIALITE=yes',
-                        '"' + sqlite_filename + '"',
-                        'PG:"'+pg_conn_info+'"', temp_view_name,
-                        '-nln', table]
-                # We need to create a temp view because of windows commandline
-                # limitations, e.g. ogr2ogr with a very long where clause
-                # GDAL > 2.1 allows specifying a filename for where args, e.g.
-                #cmd += ['-where', '"'+pkey+' in ('+",".join([str(feature_list[i]) for i in range(0, len(feature_list))])+')"']
-                # Get column names because we cannot just call 'SELECT *'
-                pcur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = \'"+schema+"\' AND table_name   = \'"+table+"\'")
-                column_list = pcur.fetchall()
-                new_columns_str = preserve_fid( pkey, column_list)
-                view_str = f"""
-                CREATE OR REPLACE VIEW {temp_view_name} AS
-                SELECT {new_columns_str} FROM {schema}.{table}"""
-                if feature_list:
-                    actual_table_pk = get_pkey(pcur, schema, table)
-                    fids_str = ",".join([str(feature_list[i]) for i in range(0, len(feature_list))])
-                    view_str += f" WHERE {actual_table_pk} in ({fids_str})"
-
-                pcur.execute(view_str)
-                pcur.commit()
-    
-                if DEBUG: print(' '.join(cmd))
-                os.system(' '.join(cmd))
-
                 # save target revision in a table
-                scur = Db(dbapi2.connect(sqlite_filename))
                 scur.execute("CREATE TABLE initial_revision AS SELECT "+
                         str(current_rev)+" AS rev, '"+
                         branch+"' AS branch, '"+
                         schema+"' AS table_schema, '"+
                         table+"' AS table_name, "+
-                        str(max_pg_pk)+" AS max_pk")
+                        str(max_pg_pk)+" AS max_pk, "
+                        "0 AS changes")
                 scur.commit()
-                scur.close()
-    
             else:
-                cmd = ['ogr2ogr',
-                       '-f', 'SQLite',
-                       '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                       '-update',
-                       '"' + sqlite_filename + '"',
-                       'PG:"'+pg_conn_info+'"', temp_view_name,
-                       '-nln', table]
-                # Same comments as in 'if feature_list' above
-                pcur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = \'"+schema+"\' AND table_name   = \'"+table+"\'")
-                column_list = pcur.fetchall()
-                new_columns_str = preserve_fid( pkey, column_list)
-                view_str = "CREATE OR REPLACE VIEW "+temp_view_name+" AS SELECT "+new_columns_str+" FROM " +schema+"."+table
-                if feature_list:
-                    view_str = "CREATE OR REPLACE VIEW "+temp_view_name+" AS SELECT "+new_columns_str+" FROM " +schema+"."+table+" WHERE "+pkey+' in ('+",".join([str(feature_list[i]) for i in range(0, len(feature_list))])+')'
-                pcur.execute(view_str)
-                pcur.commit()
-    
-                if DEBUG: print(' '.join(cmd))
-                os.system(' '.join(cmd))
-    
                 # save target revision in a table if not in there
-                scur = Db(dbapi2.connect(sqlite_filename))
                 scur.execute("INSERT INTO initial_revision"
-                        "(rev, branch, table_schema, table_name, max_pk) "
+                        "(rev, branch, table_schema, table_name, max_pk, "
+                        "changes) "
                         "VALUES ("+str(current_rev)+", '"+branch+"', '"+
-                        schema+"', '"+table+"', "+str(max_pg_pk)+")" )
+                        schema+"', '"+table+"', "+str(max_pg_pk)+", 0)" )
                 scur.commit()
-                scur.close()
     
-            scur = Db(dbapi2.connect(sqlite_filename))
-
-            constraint_builder = ConstraintBuilder(pcur, scur, schema, None)
+            constraint_builder = ConstraintBuilder(pcur, scur, schema, None,
+                                                   branch)
+            constraint_builder.create_indexes(table)
+            for geom in sqlite_geometry_columns(scur, table):
+                scur.execute("SELECT CreateSpatialIndex('"+table+"', "
+                    "'"+geom+"')")
             
             # create views and triggers in spatilite db
             
@@ -456,6 +454,9 @@ class spVersioning(object):
                 "FROM initial_revision WHERE table_name = '"+table+"') )")
             current_rev_sub = ("(SELECT rev FROM initial_revision "
                 "WHERE table_name = '"+table+"')")
+            # edits are counted so that commit skips untouched tables
+            count_change = ("UPDATE initial_revision "
+                "SET changes = changes + 1 WHERE table_name = '"+table+"';\n")
     
             scur.execute("DELETE FROM views_geometry_columns "
                 "WHERE view_name = '"+table+"_view'")
@@ -486,6 +487,7 @@ class spVersioning(object):
                   "old.ogc_fid);\n"
                 "UPDATE "+table+" SET "+branch+"_rev_end = "+current_rev_sub+", "
                 +branch+"_child = "+max_fid_sub+" WHERE ogc_fid = old.ogc_fid;\n"+
+                count_change+
                 constraint_after+"\n"+
                 "END")
             
@@ -503,6 +505,7 @@ class spVersioning(object):
                     "(new.ogc_fid, "+newcols+", "+current_rev_sub+"+1, (SELECT "
                     +branch+"_parent FROM "+table+
                     " WHERE ogc_fid = new.ogc_fid));\n"+
+                    count_change+
                     constraint_after+"\n"+
                   "END")
     
@@ -514,7 +517,8 @@ class spVersioning(object):
                     "INSERT INTO "+table+" "+
                     "(ogc_fid, "+cols+", "+branch+"_rev_begin) "
                     "VALUES "
-                    "("+max_fid_sub+"+1, "+newcols+", "+current_rev_sub+"+1);\n"
+                    "("+max_fid_sub+"+1, "+newcols+", "+current_rev_sub+"+1);\n"+
+                    count_change+
                 "END")
 
             constraint = constraint_builder.get_referenced_constraint('delete', table)
@@ -538,7 +542,8 @@ class spVersioning(object):
                         "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
                     "DELETE FROM "+table+" "
                         "WHERE ogc_fid = old.ogc_fid "
-                        "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"
+                        "AND "+branch+"_rev_begin = "+current_rev_sub+"+1;\n"+
+                    count_change+
                 "END")
     
             scur.commit()
@@ -548,7 +553,11 @@ class spVersioning(object):
             del_view_str = "DROP VIEW IF EXISTS " + i
             pcur.execute(del_view_str)
             pcur.commit()
+        for i in temp_table_names:
+            pcur.execute("DROP TABLE IF EXISTS " + i)
+            pcur.commit()
 
+        sqlite_end_bulk_load(scur)
         pcur.close()
         scur.close()
     
@@ -594,20 +603,22 @@ class spVersioning(object):
         scur.execute("SELECT rev, branch, table_schema, table_name "
             "FROM initial_revision")
         versioned_layers = scur.fetchall()
-
-        pcur = Db(psycopg2.connect(pg_conn_info))
-        check_unique_constraints(pcur, scur, "main")
     
         if not versioned_layers:
             raise RuntimeError("Cannot find a versioned layer in "+sqlite_filename)
-    
-        schema_list = {} # for final cleanup
-        nb_of_updated_layer = 0
+
+        # tables that have not been edited have nothing to commit
+        changed = changed_tables(scur, "main")
+        if changed is not None:
+            candidate_layers = [layer for layer in versioned_layers
+                                if layer[3] in changed]
+        else:
+            candidate_layers = versioned_layers
+
+        # build the diffs locally, only the non empty ones are transfered
+        modified_layers = []
         next_rev = 0
-        for [rev, branch, table_schema, table] in versioned_layers:
-            diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
-                    "_to_"+str(rev+1)+"_diff")
-    
+        for [rev, branch, table_schema, table] in candidate_layers:
             if next_rev:
                 assert( next_rev == rev + 1 )
             else:
@@ -643,138 +654,155 @@ class spVersioning(object):
             scur.execute( "SELECT ogc_fid FROM "+table+"_diff")
             there_is_something_to_commit = scur.fetchone()
             if DEBUG: print("there_is_something_to_commit ", there_is_something_to_commit)
+
+            if there_is_something_to_commit:
+                modified_layers.append([rev, branch, table_schema, table])
+            else:
+                if DEBUG: print("nothing to commit for ", table)
+                scur.execute("DELETE FROM geometry_columns "
+                    "WHERE f_table_name = '"+table+"_diff'")
+                scur.execute("DROP TABLE "+table+"_diff")
             scur.commit()
-    
+
+        if not modified_layers:
+            if changed is not None:
+                scur.execute("UPDATE initial_revision SET changes = 0")
+            scur.commit()
+            scur.close()
+            return 0
+
+        pcur = pg_connect(pg_conn_info, self.pool)
+        diff_schema = None
+        try:
+            check_unique_constraints(
+                pcur, scur, "main",
+                [table for [_, _, _, table] in modified_layers])
+
             # Better if we could have a QgsDataSourceURI.username()
             try:
                 pg_username = pg_conn_info.split(' ')[3].replace("'","").split('=')[1]
             except (IndexError):
                 pg_username = ''
-    
-            pg_users_list = get_pg_users_list(pg_conn_info)
-            pkey = pg_pk( pcur, table_schema, table )
-            pgeom = pg_geom( pcur, table_schema, table )
-    
-            # import layers in postgis schema
-            pcur.execute("SELECT schema_name FROM information_schema.schemata "
-                "WHERE schema_name = '"+diff_schema+"'")
-            if not pcur.fetchone():
-                schema_list[diff_schema] = pg_conn_info
-                pcur.execute("CREATE SCHEMA "+diff_schema)
-            pcur.execute( "DROP TABLE IF EXISTS "+diff_schema+"."+table+"_diff")
+
+            # all the diffs are staged in a single schema
+            [rev, branch, table_schema, table] = modified_layers[0]
+            diff_schema = (table_schema+"_"+branch+"_"+str(rev)+
+                    "_to_"+str(rev+1)+"_diff")
+            pcur.execute("DROP SCHEMA IF EXISTS "+diff_schema+" CASCADE")
+            pcur.execute("CREATE SCHEMA "+diff_schema)
             pcur.commit()
-            cmd = ['ogr2ogr',
-                    '-preserve_fid',
-                   '-lco', 'GEOMETRY_NAME={}'.format(pgeom),
-                    '-f',
-                    'PostgreSQL',
-                    'PG:"'+pg_conn_info+'"',
-                    '-lco',
-                    'FID='+pkey,
-                    '"' + sqlite_filename + '"',
-                    table+"_diff",
-                    '-nln', diff_schema+'.'+table+"_diff"]
-
-            if DEBUG: print(' '.join(cmd))
-            os.system(' '.join(cmd))
-
-            for l in pcur.execute( "select * from geometry_columns").fetchall():
-                if DEBUG: print(l)
-    
-            # remove dif table and geometry column
-            scur.execute("DELETE FROM geometry_columns "
-                "WHERE f_table_name = '"+table+"_diff'")
-            scur.execute("DROP TABLE "+table+"_diff")
-    
-    
-            if not there_is_something_to_commit:
-                if DEBUG: print("nothing to commit for ", table)
-                continue
-    
-            nb_of_updated_layer += 1
-    
-            pcur.execute("SELECT rev FROM "+table_schema+".revisions "
-                "WHERE rev = "+str(rev+1))
-            if not pcur.fetchone():
-                if DEBUG: print("inserting rev ", str(rev+1))
-                pcur.execute("INSERT INTO "+table_schema+".revisions "
-                    "(rev, commit_msg, branch, author) "
-                    "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+"', '"+branch+"',"
-                    "'"+os_info()+":"+get_username()+"."+pg_username+"."+commit_user+"')")
-    
-            other_branches = pg_branches( pcur, table_schema ).remove(branch)
-            other_branches = other_branches if other_branches else []
-            other_branches_columns = sum([
-                [brch+'_rev_begin', brch+'_rev_end',
-                brch+'_parent', brch+'_child']
-                for brch in other_branches], [])
-            pcur.execute("""
-                SELECT column_name, data_type, character_maximum_length
-                FROM information_schema.columns
-                WHERE table_schema = '{table_schema}'
-                AND table_name = '{table}'
-                """.format(table_schema=table_schema, table=table))
-            cols = ""
-            cols_cast = ""
-            for col in pcur.fetchall():
-                if col[0] not in other_branches_columns:
-                    cols += quote_ident(col[0])+", "
-                    if col[1] != 'ARRAY':
-                        if col[1] == 'USER-DEFINED':
-                            cast = "::" + pg_user_defined_type(pcur, table_schema, table, col[0])
-                        elif col[1] == 'character' and col[2]:
-                            cast = "::varchar"
-                        else:
-                            cast = "::"+col[1] 
-                        cols_cast += quote_ident(col[0])+cast+", "
-                    else :
-                        cols_cast += ("regexp_replace(regexp_replace("
-                                +col[0]+"::varchar,'^\(.*:','{'),'\)$','}')::"
-                                +pg_array_elem_type(pcur,
-                                    table_schema, table, col[0])+"[], ")
-            cols = cols[:-2] # remove last coma and space
-            cols_cast = cols_cast[:-2] # remove last coma and space
-            # insert inserted and modified
-            pcur.execute("INSERT INTO "+table_schema+"."+table+" ("+cols+") "
-                "SELECT "+cols_cast+" FROM "+diff_schema+"."+table+"_diff "
-                "WHERE "+branch+"_rev_begin = "+str(rev+1))
-    
-            # update deleted and modified
-            pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
-                    "SET ("+branch+"_rev_end, "+branch+"_child)"
-                    "=(src."+branch+"_rev_end, src."+branch+"_child) "
-                    "FROM "+diff_schema+"."+table+"_diff AS src "
-                    "WHERE dest."+pkey+" = src."+pkey+" "
-                    "AND src."+branch+"_rev_end = "+str(rev))
+
+            for [rev, branch, table_schema, table] in modified_layers:
+                pkey = pg_pk( pcur, table_schema, table )
+                pgeom = pg_geom( pcur, table_schema, table )
+                self.transfer.sqlite_to_pg(
+                    sqlite_filename, scur, table+"_diff",
+                    pg_conn_info, pcur,
+                    diff_schema+'.'+table_schema+'_'+table+"_diff",
+                    fid=pkey, geometry_name=pgeom)
+
+                # remove dif table and geometry column
+                scur.execute("DELETE FROM geometry_columns "
+                    "WHERE f_table_name = '"+table+"_diff'")
+                scur.execute("DROP TABLE "+table+"_diff")
+                scur.commit()
+
+            for [rev, branch, table_schema, table] in modified_layers:
+                diff_table = diff_schema+"."+table_schema+"_"+table+"_diff"
+                pkey = pg_pk( pcur, table_schema, table )
+
+                pcur.execute("SELECT rev FROM "+table_schema+".revisions "
+                    "WHERE rev = "+str(rev+1))
+                if not pcur.fetchone():
+                    if DEBUG: print("inserting rev ", str(rev+1))
+                    pcur.execute("INSERT INTO "+table_schema+".revisions "
+                        "(rev, commit_msg, branch, author) "
+                        "VALUES ("+str(rev+1)+", '"+escape_quote(commit_msg)+"', '"+branch+"',"
+                        "'"+os_info()+":"+get_username()+"."+pg_username+"."+commit_user+"')")
+    
+                other_branches = pg_branches( pcur, table_schema ).remove(branch)
+                other_branches = other_branches if other_branches else []
+                other_branches_columns = sum([
+                    [brch+'_rev_begin', brch+'_rev_end',
+                    brch+'_parent', brch+'_child']
+                    for brch in other_branches], [])
+                cols = ""
+                cols_cast = ""
+                for col in pg_columns(pcur, table_schema, table):
+                    if col[0] not in other_branches_columns:
+                        cols += quote_ident(col[0])+", "
+                        if col[1] != 'ARRAY':
+                            if col[1] == 'USER-DEFINED':
+                                cast = "::" + pg_user_defined_type(pcur, table_schema, table, col[0])
+                            elif col[1] == 'character' and col[3]:
+                                cast = "::varchar"
+                            else:
+                                cast = "::"+col[1] 
+                            cols_cast += quote_ident(col[0])+cast+", "
+                        else :
+                            cols_cast += ("regexp_replace(regexp_replace("
+                                    +col[0]+"::varchar,'^\(.*:','{'),'\)$','}')::"
+                                    +pg_array_elem_type(pcur,
+                                        table_schema, table, col[0])+"[], ")
+                cols = cols[:-2] # remove last coma and space
+                cols_cast = cols_cast[:-2] # remove last coma and space
+                # insert inserted and modified
+                pcur.execute("INSERT INTO "+table_schema+"."+table+" ("+cols+") "
+                    "SELECT "+cols_cast+" FROM "+diff_table+" "
+                    "WHERE "+branch+"_rev_begin = "+str(rev+1))
     
+                # update deleted and modified
+                pcur.execute("UPDATE "+table_schema+"."+table+" AS dest "
+                        "SET ("+branch+"_rev_end, "+branch+"_child)"
+                        "=(src."+branch+"_rev_end, src."+branch+"_child) "
+                        "FROM "+diff_table+" AS src "
+                        "WHERE dest."+pkey+" = src."+pkey+" "
+                        "AND src."+branch+"_rev_end = "+str(rev))
+
+            # all the tables are merged in a single transaction, a failure
+            # leaves none of them in the base database
             pcur.commit()
-            # pcur.close()
-    
+        except Exception:
+            # the diffs are not left in the working copy, nor in the base
+            # database, e.g. when a key is already used
+            pcur.con.rollback()
+            if diff_schema:
+                pcur.execute("DROP SCHEMA IF EXISTS "+diff_schema+" CASCADE")
+                pcur.commit()
+            pcur.close()
+            scur.con.rollback()
+            for [rev, branch, table_schema, table] in modified_layers:
+                scur.execute("DELETE FROM geometry_columns "
+                    "WHERE f_table_name = '"+table+"_diff'")
+                scur.execute("DROP TABLE IF EXISTS "+table+"_diff")
             scur.commit()
+            scur.close()
+            raise
 
-        if nb_of_updated_layer:
-            for [rev, branch, table_schema, table] in versioned_layers:
-                pkey = pg_pk( pcur, table_schema, table )
-                pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
-                [rev] = pcur.fetchone()
-                pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
-                [max_pk] = pcur.fetchone()
-                if not max_pk :
-                    max_pk = 0
-                
-                scur.execute("UPDATE initial_revision "
-                    "SET rev = "+str(rev)+", max_pk = "+str(max_pk)+" "
-                    "WHERE table_schema = '"+table_schema+"' "
-                    "AND table_name = '"+table+"' "
-                    "AND branch = '"+branch+"'")
+        nb_of_updated_layer = len(modified_layers)
+        for [rev, branch, table_schema, table] in versioned_layers:
+            pkey = pg_pk( pcur, table_schema, table )
+            pcur.execute("SELECT MAX(rev) FROM "+table_schema+".revisions")
+            [rev] = pcur.fetchone()
+            pcur.execute("SELECT MAX("+pkey+") FROM "+table_schema+"."+table)
+            [max_pk] = pcur.fetchone()
+            if not max_pk :
+                max_pk = 0
+            
+            scur.execute("UPDATE initial_revision "
+                "SET rev = "+str(rev)+", max_pk = "+str(max_pk)+" "
+                "WHERE table_schema = '"+table_schema+"' "
+                "AND table_name = '"+table+"' "
+                "AND branch = '"+branch+"'")
+        if changed is not None:
+            scur.execute("UPDATE initial_revision SET changes = 0")
     
         scur.commit()
         scur.close()
     
         # cleanup diffs in postgis
-        for schema, conn_info in schema_list.items():
-            pcur.execute("DROP SCHEMA "+schema+" CASCADE")
-            pcur.commit()
+        pcur.execute("DROP SCHEMA "+diff_schema+" CASCADE")
+        pcur.commit()
         
         pcur.close()
         return nb_of_updated_layer
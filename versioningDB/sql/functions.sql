@@ -0,0 +1,501 @@
+-- Server side implementation of the update and commit of postgres working
+-- copies (pgServer), each one is a single call instead of several
+-- statements per table, see postgresqlServer.py for the python version
+
+-- primary key column of a table
+CREATE OR REPLACE FUNCTION {schema}.versioning_pk(
+    table_schema text, table_name text)
+RETURNS text AS $$
+DECLARE
+    pkey text;
+BEGIN
+    SELECT a.attname INTO pkey
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid
+    AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = format('%I.%I', table_schema, table_name)::regclass
+    AND i.indisprimary;
+    IF pkey IS NULL THEN
+        RAISE EXCEPTION 'table %.% does not have a primary key',
+            table_schema, table_name;
+    END IF;
+    RETURN pkey;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- geometry column of a table, NULL if none, chosen among several like
+-- utils.pg_geom with geometry_column standing for VERSIONING_GEOMETRY_COLUMN
+CREATE OR REPLACE FUNCTION {schema}.versioning_geom(
+    table_schema text, table_name text, geometry_column text)
+RETURNS text AS $$
+DECLARE
+    geoms text[];
+BEGIN
+    SELECT array_agg(f_geometry_column::text) INTO geoms
+    FROM geometry_columns
+    WHERE f_table_schema = table_schema AND f_table_name = table_name;
+    IF geoms IS NULL THEN
+        RETURN NULL;
+    ELSIF array_length(geoms, 1) = 1 THEN
+        RETURN geoms[1];
+    ELSIF geometry_column IS NOT NULL THEN
+        IF geometry_column = ANY(geoms) THEN
+            RETURN geometry_column;
+        END IF;
+        RAISE EXCEPTION 'more than one geometry column in %.% but none is % '
+            '(i.e. the value of VERSIONING_GEOMETRY_COLUMN) ',
+            table_schema, table_name, geometry_column;
+    ELSIF 'geometry' = ANY(geoms) THEN
+        RETURN 'geometry';
+    END IF;
+    RAISE EXCEPTION 'more than one geometry column in %.% but the environment '
+        'variable VERSIONING_GEOMETRY_COLUMN is not defined and the geometry '
+        'column name is not geometry', table_schema, table_name;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- tables of the working copy with unresolved conflicts
+CREATE OR REPLACE FUNCTION {schema}.versioning_unresolved_conflicts(wcs text)
+RETURNS text[] AS $$
+DECLARE
+    cflt text;
+    has_row boolean;
+    found text[] := ARRAY[]::text[];
+BEGIN
+    FOR cflt IN
+        SELECT c.relname::text FROM pg_class AS c
+        JOIN pg_namespace AS n ON n.oid = c.relnamespace
+        WHERE n.nspname = wcs AND c.relname LIKE '%_cflt'
+        AND c.relkind IN ('r', 'p', 'v', 'f')
+    LOOP
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I.%I)', wcs, cflt)
+        INTO has_row;
+        IF has_row THEN
+            found := found || left(cflt, -5);
+        END IF;
+    END LOOP;
+    RETURN found;
+END;
+$$ LANGUAGE plpgsql;
+
+-- merge modifications since last update into the working copy
+CREATE OR REPLACE FUNCTION {schema}.versioning_update(
+    wcs text, geometry_column text DEFAULT NULL)
+RETURNS void AS $$
+DECLARE
+    layer record;
+    max_rev integer;
+    max_pg_pk integer;
+    bump integer;
+    pkey text;
+    pgeom text;
+    srid integer;
+    geom_type text;
+    cols text;
+    geom text;
+    geom_sel text;
+    diff_cols text;
+    has_conflicts boolean;
+    diff text;
+    update_diff text;
+    cflt text;
+    rev_begin text;
+    rev_end text;
+    parent text;
+    child text;
+BEGIN
+    IF array_length({schema}.versioning_unresolved_conflicts(wcs), 1) > 0 THEN
+        RAISE EXCEPTION 'There are unresolved conflicts in %', wcs;
+    END IF;
+
+    FOR layer IN EXECUTE format(
+        'SELECT rev, branch, table_schema, table_name, max_pk '
+        'FROM %I.initial_revision', wcs)
+    LOOP
+        EXECUTE format('SELECT MAX(rev) FROM %I.revisions WHERE branch = %L',
+            layer.table_schema, layer.branch) INTO max_rev;
+        CONTINUE WHEN max_rev = layer.rev;
+
+        diff := layer.table_name || '_diff';
+        update_diff := layer.table_name || '_update_diff';
+        cflt := layer.table_name || '_cflt';
+        rev_begin := layer.branch || '_rev_begin';
+        rev_end := layer.branch || '_rev_end';
+        parent := layer.branch || '_parent';
+        child := layer.branch || '_child';
+
+        -- get the max pkey
+        pkey := {schema}.versioning_pk(layer.table_schema, layer.table_name);
+        pgeom := {schema}.versioning_geom(layer.table_schema,
+            layer.table_name, geometry_column);
+        EXECUTE format('SELECT MAX(%I) FROM %I.%I', pkey,
+            layer.table_schema, layer.table_name) INTO max_pg_pk;
+        max_pg_pk := coalesce(max_pg_pk, 0);
+
+        -- create the diff
+        SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+        INTO cols
+        FROM pg_attribute AS a
+        WHERE a.attrelid = format('%I.%I', layer.table_schema,
+            layer.table_name)::regclass
+        AND a.attnum > 0 AND NOT a.attisdropped
+        AND a.attname IS DISTINCT FROM pgeom;
+
+        geom := '';
+        geom_sel := '';
+        IF pgeom IS NOT NULL THEN
+            SELECT g.srid, g.type INTO srid, geom_type
+            FROM geometry_columns AS g
+            WHERE g.f_table_schema = layer.table_schema
+            AND g.f_table_name = layer.table_name
+            AND g.f_geometry_column = pgeom;
+            geom := format(', %I::geometry(%L, %s) AS %I', pgeom, geom_type,
+                srid, pgeom);
+            geom_sel := ', ' || quote_ident(pgeom);
+        END IF;
+
+        EXECUTE format('DROP TABLE IF EXISTS %I.%I CASCADE', wcs, update_diff);
+        EXECUTE format('CREATE TABLE %I.%I AS SELECT %s%s FROM %I.%I '
+            'WHERE %I = %s OR %I > %s', wcs, update_diff, cols, geom,
+            layer.table_schema, layer.table_name, rev_end, layer.rev,
+            rev_begin, layer.rev);
+        EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I PRIMARY KEY (%I)',
+            wcs, update_diff, layer.table_name || '_' || layer.branch
+            || '_pk_pk', pkey);
+
+        -- update the initial revision
+        EXECUTE format('UPDATE %I.initial_revision SET rev = %s, max_pk = %s '
+            'WHERE table_name = %L', wcs, max_rev, max_pg_pk,
+            layer.table_name);
+
+        EXECUTE format('UPDATE %I.%I SET %I = %s WHERE %I = %s', wcs, diff,
+            rev_end, max_rev, rev_end, layer.rev);
+        EXECUTE format('UPDATE %I.%I SET %I = %s WHERE %I = %s', wcs, diff,
+            rev_begin, max_rev + 1, rev_begin, layer.rev + 1);
+
+        bump := max_pg_pk - layer.max_pk;
+        IF bump < 0 THEN
+            RAISE EXCEPTION 'max_pk of %.% is greater than its base table one',
+                wcs, layer.table_name;
+        END IF;
+        -- now bump the pks of inserted rows in working copy
+        -- parents will be updated thanks to the ON UPDATE CASCADE
+        EXECUTE format('UPDATE %I.%I SET %I = -%I WHERE %I = %s', wcs, diff,
+            pkey, pkey, rev_begin, max_rev + 1);
+        EXECUTE format('UPDATE %I.%I SET %I = -%I + %s WHERE %I = %s', wcs,
+            diff, pkey, pkey, bump, rev_begin, max_rev + 1);
+
+        -- detect conflicts: conflict occur if two lines with the same pkey
+        -- have been modified (i.e. have a non null child) or one has been
+        -- removed and the other modified
+        EXECUTE format('DROP VIEW IF EXISTS %I.%I', wcs,
+            layer.table_name || '_conflicts_pk');
+        EXECUTE format('CREATE VIEW %I.%I AS '
+            'SELECT DISTINCT d.%I as conflict_deleted_pk '
+            'FROM %I.%I AS d, %I.%I AS ud '
+            'WHERE d.%I = ud.%I '
+            'AND (d.%I != ud.%I '
+            'OR (d.%I IS NULL AND ud.%I IS NOT NULL) '
+            'OR (d.%I IS NOT NULL AND ud.%I IS NULL)) ',
+            wcs, layer.table_name || '_conflicts_pk', pkey,
+            wcs, diff, wcs, update_diff, pkey, pkey,
+            child, child, child, child, child, child);
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I.%I)', wcs,
+            layer.table_name || '_conflicts_pk') INTO has_conflicts;
+        CONTINUE WHEN NOT has_conflicts;
+
+        -- add layer for conflicts
+        EXECUTE format('DROP TABLE IF EXISTS %I.%I', wcs, cflt);
+        EXECUTE format('CREATE TABLE %1$I.%2$I AS '
+            -- insert new features from mine
+            'SELECT %3$I AS conflict_id, ''mine'' AS origin, '
+            '''modified'' AS action, %4$s%5$s '
+            'FROM %1$I.%6$I, %1$I.%7$I AS cflt '
+            'WHERE %8$I = (SELECT %9$I FROM %1$I.%6$I '
+            'WHERE %8$I = conflict_deleted_pk) '
+            'UNION ALL '
+            -- insert new features from theirs
+            'SELECT %3$I AS conflict_id, ''theirs'' AS origin, '
+            '''modified'' AS action, %4$s%5$s '
+            'FROM %1$I.%10$I, %1$I.%7$I AS cflt '
+            'WHERE %8$I = (SELECT %9$I FROM %1$I.%10$I '
+            'WHERE %8$I = conflict_deleted_pk) '
+            -- insert deleted features from mine
+            'UNION ALL '
+            'SELECT %3$I AS conflict_id, ''mine'' AS origin, '
+            '''deleted'' AS action, %4$s%5$s '
+            'FROM %1$I.%6$I, %1$I.%7$I AS cflt '
+            'WHERE %8$I = conflict_deleted_pk AND %9$I IS NULL '
+            -- insert deleted features from theirs
+            'UNION ALL '
+            'SELECT %3$I AS conflict_id, ''theirs'' AS origin, '
+            '''deleted'' AS action, %4$s%5$s '
+            'FROM %1$I.%10$I, %1$I.%7$I AS cflt '
+            'WHERE %8$I = conflict_deleted_pk AND %9$I IS NULL',
+            wcs, cflt, parent, cols, geom_sel, diff,
+            layer.table_name || '_conflicts_pk', pkey, child, update_diff);
+
+        -- identify conflicts for deleted
+        EXECUTE format('UPDATE %I.%I SET conflict_id = %I '
+            'WHERE action = ''deleted''', wcs, cflt, pkey);
+
+        -- now follow child if any for 'theirs' 'modified' since several
+        -- edition could be made we want the very last child, see
+        -- utils.follow_conflict_children
+        EXECUTE format('WITH RECURSIVE descendant(cflt_id, cflt_pk, cflt_child) AS ('
+            'SELECT conflict_id, %3$I, %4$I FROM %1$I.%2$I '
+            'WHERE origin = ''theirs'' AND action = ''modified'' '
+            'AND %4$I IS NOT NULL '
+            'UNION ALL '
+            'SELECT cflt_id, %3$I, %4$I '
+            'FROM descendant JOIN %1$I.%5$I ON %3$I = cflt_child) '
+            'INSERT INTO %1$I.%2$I '
+            'SELECT cflt_id AS conflict_id, ''theirs'' AS origin, '
+            'CASE WHEN %6$I IS NULL '
+            'THEN ''modified'' ELSE ''deleted'' END AS action, %7$s%8$s '
+            'FROM descendant JOIN %1$I.%5$I ON %3$I = cflt_pk '
+            'WHERE cflt_child IS NULL',
+            wcs, cflt, pkey, child, update_diff, rev_end, cols, geom_sel);
+        EXECUTE format('DELETE FROM %I.%I '
+            'WHERE origin = ''theirs'' AND action = ''modified'' '
+            'AND %I IS NOT NULL', wcs, cflt, child);
+
+        -- create trigers such that on delete the conflict is resolved
+        -- if we delete 'theirs', we set their child to our fid
+        -- and their rev_end
+        -- if we delete 'mine'... well, we delete 'mine'
+        SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+        INTO diff_cols
+        FROM pg_attribute AS a
+        WHERE a.attrelid = format('%I.%I', wcs, diff)::regclass
+        AND a.attnum > 0 AND NOT a.attisdropped;
+
+        EXECUTE format('CREATE OR REPLACE VIEW %I.%I AS SELECT * FROM %I.%I',
+            wcs, layer.table_name || '_conflicts', wcs, cflt);
+
+        EXECUTE format('CREATE OR REPLACE FUNCTION %1$I.%2$I() '
+            'RETURNS trigger AS $f$ '
+            'BEGIN '
+            'DELETE FROM %1$I.%3$I '
+            'WHERE %4$I = OLD.%4$I AND OLD.origin = ''mine''; '
+            -- we need to insert their parent to update it
+            -- if it's not already there
+            'INSERT INTO %1$I.%3$I(%5$s) '
+            'SELECT %5$s FROM %6$I.%7$I '
+            'WHERE %4$I = OLD.%8$I '
+            'AND OLD.origin = ''theirs'' '
+            'AND (SELECT COUNT(*) FROM %1$I.%3$I '
+            'WHERE %4$I = OLD.%8$I) = 0; '
+            'UPDATE %1$I.%3$I '
+            'SET %9$I = (SELECT %4$I FROM %1$I.%10$I '
+            'WHERE origin = ''mine'' AND conflict_id = OLD.conflict_id), '
+            '%11$I = %12$s '
+            'WHERE %4$I = OLD.%4$I AND OLD.origin = ''theirs''; '
+            'UPDATE %1$I.%3$I '
+            'SET %8$I = OLD.%4$I '
+            'WHERE %4$I = (SELECT %4$I FROM %1$I.%10$I '
+            'WHERE origin = ''mine'' AND conflict_id = OLD.conflict_id) '
+            'AND OLD.origin = ''theirs''; '
+            'DELETE FROM %1$I.%10$I WHERE conflict_id = OLD.conflict_id; '
+            'RETURN NULL; '
+            'END; '
+            '$f$ LANGUAGE plpgsql',
+            wcs, 'delete_' || layer.table_name || '_conflicts', diff, pkey,
+            diff_cols, layer.table_schema, layer.table_name, parent, child,
+            cflt, rev_end, max_rev);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I.%I',
+            'delete_' || layer.table_name || '_conflicts', wcs,
+            layer.table_name || '_conflicts');
+        EXECUTE format('CREATE TRIGGER %1$I INSTEAD OF DELETE ON %2$I.%3$I '
+            'FOR EACH ROW EXECUTE PROCEDURE %2$I.%1$I()',
+            'delete_' || layer.table_name || '_conflicts', wcs,
+            layer.table_name || '_conflicts');
+
+        EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I PRIMARY KEY (%I)',
+            wcs, cflt, layer.table_name || '_' || layer.branch
+            || 'conflicts_pk_pk', pkey);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- merge modifications into database, returns the number of updated layers
+CREATE OR REPLACE FUNCTION {schema}.versioning_commit(
+    wcs text, commit_msg text, author text)
+RETURNS integer AS $$
+DECLARE
+    layer record;
+    unresolved text[];
+    max_rev integer;
+    late_by integer := 0;
+    nb_layers integer := 0;
+    errors text[] := ARRAY[]::text[];
+    error text;
+    pkeys text[];
+    pkey text;
+    pkey_list text;
+    new_pkeys_filter text;
+    label text;
+    cols text;
+    hcols text;
+    modified boolean;
+    nb_of_updated_layer integer := 0;
+    next_rev integer;
+BEGIN
+    unresolved := {schema}.versioning_unresolved_conflicts(wcs);
+    IF array_length(unresolved, 1) > 0 THEN
+        RAISE EXCEPTION 'There are unresolved conflicts in % for table(s) %',
+            wcs, array_to_string(unresolved, ', ');
+    END IF;
+
+    FOR layer IN EXECUTE format(
+        'SELECT rev, branch, table_schema, table_name '
+        'FROM %I.initial_revision', wcs)
+    LOOP
+        nb_layers := nb_layers + 1;
+        EXECUTE format('SELECT MAX(rev) FROM %I.revisions WHERE branch = %L',
+            layer.table_schema, layer.branch) INTO max_rev;
+        late_by := greatest(late_by, max_rev - layer.rev);
+    END LOOP;
+    IF late_by > 0 THEN
+        RAISE EXCEPTION E'Working copy % is not up to date. It''s late by % '
+            E'commit(s).\n\nPlease update before committing your '
+            'modifications', wcs, late_by;
+    END IF;
+
+    -- new or updated keys already used in the base table, see
+    -- constraints.check_unique_constraints
+    FOR layer IN EXECUTE format(
+        'SELECT rev, branch, table_schema, table_name '
+        'FROM %I.initial_revision', wcs)
+    LOOP
+        EXECUTE format('SELECT array_agg(c) FROM (SELECT UNNEST(columns_from) '
+            'AS c FROM %I.versioning_constraints WHERE table_from = %L '
+            'AND table_to IS NULL) AS pk', layer.table_schema,
+            layer.table_name) INTO pkeys;
+        CONTINUE WHEN pkeys IS NULL;
+        pkey := {schema}.versioning_pk(layer.table_schema, layer.table_name);
+
+        SELECT string_agg(format('trev.%I', c), ', '),
+               string_agg(format('trev.%1$I != trev2.%1$I', c), ' OR '),
+               string_agg(format('%L || dup.%I', c || '=', c),
+                          ' || '' and '' || ')
+        INTO pkey_list, new_pkeys_filter, label
+        FROM unnest(pkeys) AS c;
+
+        EXECUTE format('SELECT string_agg(%1$L || %2$s, E''\n'') FROM ('
+            'SELECT %3$s FROM %4$I.%5$I trev '
+            'WHERE %6$I IS NULL AND %7$I IS NULL '
+            'INTERSECT ('
+            -- inserted pkey
+            'SELECT %3$s FROM %8$I.%9$I trev '
+            'WHERE %6$I IS NULL AND %7$I IS NULL AND %10$I > %11$s '
+            'UNION '
+            -- updated pkey
+            'SELECT %3$s FROM %8$I.%9$I trev, %8$I.%9$I trev2 '
+            'WHERE trev.%7$I IS NOT NULL '
+            'AND trev.%10$I > 1 '
+            'AND trev.%7$I = trev2.%12$I '
+            'AND (%13$s))) AS dup',
+            '   ' || wcs || '.' || layer.table_name || ' : ', label,
+            pkey_list, layer.table_schema, layer.table_name,
+            layer.branch || '_rev_end', layer.branch || '_parent',
+            wcs, layer.table_name || '_diff', layer.branch || '_rev_begin',
+            layer.rev, pkey, new_pkeys_filter) INTO error;
+        IF error IS NOT NULL THEN
+            errors := errors || error;
+        END IF;
+    END LOOP;
+    IF array_length(errors, 1) > 0 THEN
+        RAISE EXCEPTION E'Some new or updated row violate the primary key '
+            E'constraint in base database :\n%', array_to_string(errors, E'\n');
+    END IF;
+
+    IF nb_layers = 0 THEN
+        RAISE EXCEPTION 'Cannot find a versioned layer in %', wcs;
+    END IF;
+
+    FOR layer IN EXECUTE format(
+        'SELECT rev, branch, table_schema, table_name '
+        'FROM %I.initial_revision', wcs)
+    LOOP
+        IF next_rev IS NOT NULL AND next_rev != layer.rev + 1 THEN
+            RAISE EXCEPTION 'layers of % are at different revisions', wcs;
+        END IF;
+        next_rev := layer.rev + 1;
+
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I.%I)', wcs,
+            layer.table_name || '_diff') INTO modified;
+        CONTINUE WHEN NOT modified;
+        nb_of_updated_layer := nb_of_updated_layer + 1;
+
+        pkey := {schema}.versioning_pk(layer.table_schema, layer.table_name);
+        EXECUTE format('SELECT string_agg(quote_ident(a.attname), '', '') '
+            'FROM pg_attribute AS a '
+            'WHERE a.attrelid = %L::regclass '
+            'AND a.attnum > 0 AND NOT a.attisdropped AND a.attname != %L '
+            'AND a.attname NOT IN ('
+            'SELECT b.branch || s.suffix '
+            'FROM (SELECT DISTINCT branch FROM %I.revisions) AS b, '
+            'unnest(ARRAY[''_rev_begin'', ''_rev_end'', ''_parent'', '
+            '''_child'']) AS s(suffix))',
+            format('%I.%I', layer.table_schema, layer.table_name), pkey,
+            layer.table_schema) INTO cols;
+        hcols := format('%I, %I, %I, %I, %I', pkey,
+            layer.branch || '_rev_begin', layer.branch || '_rev_end',
+            layer.branch || '_parent', layer.branch || '_child');
+
+        EXECUTE format('INSERT INTO %I.revisions '
+            '(rev, commit_msg, branch, author) '
+            'SELECT %s, %L, %L, %L WHERE NOT EXISTS '
+            '(SELECT 1 FROM %I.revisions WHERE rev = %s)',
+            layer.table_schema, layer.rev + 1, commit_msg, layer.branch,
+            author, layer.table_schema, layer.rev + 1);
+
+        -- insert inserted and modified
+        EXECUTE format('INSERT INTO %I.%I (%s, %s) '
+            'SELECT %s, %s FROM %I.%I WHERE %I = %s',
+            layer.table_schema, layer.table_name, cols, hcols, cols, hcols,
+            wcs, layer.table_name || '_diff', layer.branch || '_rev_begin',
+            layer.rev + 1);
+
+        -- update deleted and modified
+        EXECUTE format('UPDATE %1$I.%2$I AS dest '
+            'SET (%3$I, %4$I) = (src.%3$I, src.%4$I) '
+            'FROM %5$I.%6$I AS src '
+            'WHERE dest.%7$I = src.%7$I AND src.%3$I = %8$s',
+            layer.table_schema, layer.table_name, layer.branch || '_rev_end',
+            layer.branch || '_child', wcs, layer.table_name || '_diff', pkey,
+            layer.rev);
+
+        -- clears the diff
+        EXECUTE format('TRUNCATE TABLE %I.%I CASCADE', wcs,
+            layer.table_name || '_diff');
+    END LOOP;
+
+    IF nb_of_updated_layer > 0 THEN
+        FOR layer IN EXECUTE format(
+            'SELECT rev, branch, table_schema, table_name '
+            'FROM %I.initial_revision', wcs)
+        LOOP
+            EXECUTE format('UPDATE %I.initial_revision SET (rev, max_pk) '
+                '= ((SELECT MAX(rev) FROM %I.revisions), '
+                '(SELECT MAX(%I) FROM %I.%I)) '
+                'WHERE table_schema = %L AND table_name = %L AND branch = %L',
+                wcs, layer.table_schema,
+                {schema}.versioning_pk(layer.table_schema, layer.table_name),
+                layer.table_schema, layer.table_name, layer.table_schema,
+                layer.table_name, layer.branch);
+        END LOOP;
+    END IF;
+
+    RETURN nb_of_updated_layer;
+END;
+$$ LANGUAGE plpgsql;
+
+-- version of these functions, pgServer does not call the functions of a
+-- schema where they are missing or older than the python code
+CREATE OR REPLACE FUNCTION {schema}.versioning_functions_version()
+RETURNS integer AS $$
+    SELECT {version};
+$$ LANGUAGE sql IMMUTABLE;
@@ -0,0 +1,437 @@
+"""
+/***************************************************************************
+ versioning
+                                 A QGIS plugin
+ postgis database versioning
+                              -------------------
+        begin                : 2018-06-14
+        copyright            : (C) 2018 by Oslandia
+        email                : infos@oslandia.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+
+Transfer engines used to copy tables between the versioned database and
+the working copies.
+
+The default engine streams rows between the connections the backend already
+has opened. The ogr2ogr engine spawns one ogr2ogr process per table, it is
+selected with the environment variable VERSIONING_TRANSFER=ogr2ogr
+"""
+
+import os
+import json
+import datetime
+import threading
+from decimal import Decimal
+
+from .utils import quote_ident, copy_rows
+
+DEBUG = False
+
+# number of rows fetched and inserted at once by the stream engine
+BATCH_SIZE = 10000
+
+# size in bytes of the chunks piped between two postgres COPY
+COPY_CHUNK_SIZE = 1 << 20
+
+# postgres type name -> spatialite column type, the same types ogr2ogr uses
+SQLITE_TYPES = {
+    'int2': 'INTEGER',
+    'int4': 'INTEGER',
+    'int8': 'BIGINT',
+    'float4': 'FLOAT',
+    'float8': 'FLOAT',
+    'numeric': 'FLOAT',
+    'bool': 'BOOLEAN',
+    'date': 'DATE',
+    'timestamp': 'DATETIME',
+    'timestamptz': 'DATETIME',
+    'time': 'TIME',
+    'bytea': 'BLOB'}
+
+# spatialite geometry type codes
+SQLITE_GEOMETRY_TYPES = {
+    0: 'GEOMETRY', 1: 'POINT', 2: 'LINESTRING', 3: 'POLYGON',
+    4: 'MULTIPOINT', 5: 'MULTILINESTRING', 6: 'MULTIPOLYGON',
+    7: 'GEOMETRYCOLLECTION'}
+SQLITE_GEOMETRY_DIMS = {0: '', 1: 'Z', 2: 'M', 3: 'ZM'}
+
+
+def pg_type(sqlite_type):
+    """Returns the postgres type of a spatialite declared column type,
+    mimics the OGR SQLite driver"""
+    sqlite_type = (sqlite_type or '').upper()
+    if 'BIGINT' in sqlite_type or 'INTEGER64' in sqlite_type:
+        return 'bigint'
+    elif 'BOOL' in sqlite_type:
+        return 'boolean'
+    elif 'INT' in sqlite_type:
+        return 'integer'
+    elif ('FLOAT' in sqlite_type or 'REAL' in sqlite_type
+          or 'DOUBLE' in sqlite_type or 'NUMERIC' in sqlite_type):
+        return 'double precision'
+    elif 'DATETIME' in sqlite_type or 'TIMESTAMP' in sqlite_type:
+        return 'timestamp'
+    elif 'DATE' in sqlite_type:
+        return 'date'
+    elif 'TIME' in sqlite_type:
+        return 'time'
+    elif 'BLOB' in sqlite_type:
+        return 'bytea'
+    return 'varchar'
+
+
+def sqlite_value(value):
+    """Convert a value fetched by psycopg2 to a value sqlite can bind"""
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    elif isinstance(value, memoryview):
+        return bytes(value)
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, list):
+        # OGR list format, converted back to an array on commit
+        return "({}:{})".format(len(value), ",".join(str(v) for v in value))
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, dict):
+        return json.dumps(value)
+    return str(value)
+
+
+def pg_columns(pcur, relation):
+    """Returns the list of (name, type name) of the postgres relation
+    schema.table in ordinal order"""
+    pcur.execute("SELECT a.attname, t.typname "
+                 "FROM pg_attribute a "
+                 "JOIN pg_type t ON t.oid = a.atttypid "
+                 "WHERE a.attrelid = '"+relation+"'::regclass "
+                 "AND a.attnum > 0 AND NOT a.attisdropped "
+                 "ORDER BY a.attnum")
+    return pcur.fetchall()
+
+
+def pg_geometry_columns(pcur, relation):
+    """Returns a dict geometry column -> (srid, type, coord_dimension) of the
+    postgres relation schema.table"""
+    schema, table = relation.split('.')
+    pcur.execute("SELECT f_geometry_column, srid, type, coord_dimension "
+                 "FROM geometry_columns "
+                 "WHERE f_table_schema = '"+schema+"' "
+                 "AND f_table_name = '"+table+"'")
+    return {name: (srid, geom_type, dim)
+            for name, srid, geom_type, dim in pcur.fetchall()}
+
+
+def pg_copy_columns(pcur, relation):
+    """Returns the list of (name, type, copyable) of the postgres relation
+    schema.table in ordinal order. The type is the complete type with its
+    modifier, copyable is False for types that may not exist in another
+    database (enums, domains...) and should be copied as varchar"""
+    pcur.execute("SELECT a.attname, format_type(a.atttypid, a.atttypmod), "
+                 "n.nspname = 'pg_catalog' "
+                 "OR t.typname IN ('geometry', 'geography') "
+                 "FROM pg_attribute a "
+                 "JOIN pg_type t ON t.oid = a.atttypid "
+                 "JOIN pg_namespace n ON n.oid = t.typnamespace "
+                 "WHERE a.attrelid = '"+relation+"'::regclass "
+                 "AND a.attnum > 0 AND NOT a.attisdropped "
+                 "ORDER BY a.attnum")
+    return pcur.fetchall()
+
+
+def sqlite_geometry_columns(scur, table):
+    """Returns a dict geometry column -> (srid, postgis type) of the
+    spatialite table"""
+    scur.execute("SELECT f_geometry_column, srid, geometry_type "
+                 "FROM geometry_columns "
+                 "WHERE f_table_name = '"+table.lower()+"'")
+    return {name: (srid, SQLITE_GEOMETRY_TYPES[code % 1000]
+                   + SQLITE_GEOMETRY_DIMS[code // 1000])
+            for name, srid, code in scur.fetchall()}
+
+
+class StreamTransfer(object):
+    """Copy tables through the already opened connections, rows are read
+    with a server-side cursor and inserted by batches of BATCH_SIZE"""
+
+    # tables can be copied to the same spatialite file from several threads,
+    # each with its own connections, every batch is committed
+    concurrent_sqlite = True
+
+    def pg_to_sqlite(self, pg_conn_info, pcur, source, sqlite_filename, scur,
+                     dest, fid, geometry_name='', spatial_index=True):
+        """Copy the postgres relation source (schema.table) into the new
+        spatialite table dest, the source column fid becomes ogc_fid.
+        The spatialite file must already hold the spatial metadata"""
+        columns = pg_columns(pcur, source)
+        geometries = pg_geometry_columns(pcur, source)
+
+        attributes = [col for col, typ in columns
+                      if col != fid and col not in geometries]
+        types = dict(columns)
+
+        scur.execute("CREATE TABLE "+dest+" ("
+                     "ogc_fid INTEGER PRIMARY KEY AUTOINCREMENT"
+                     + "".join([", {} {}".format(
+                         quote_ident(col),
+                         SQLITE_TYPES.get(types[col], 'VARCHAR'))
+                                for col in attributes])+")")
+
+        for geom, (srid, geom_type, dim) in geometries.items():
+            if geom_type.endswith('M') and dim == 3:
+                geom_type, dims = geom_type[:-1], 'XYM'
+            else:
+                dims = {3: 'XYZ', 4: 'XYZM'}.get(dim, 'XY')
+            scur.execute("SELECT AddGeometryColumn('{}', '{}', {}, '{}', "
+                         "'{}')".format(dest, geom, srid, geom_type, dims))
+
+        select = ", ".join(
+            [quote_ident(fid)] + [quote_ident(col) for col in attributes]
+            + ["ST_AsEWKB({})".format(quote_ident(geom))
+               for geom in geometries])
+        insert = ("INSERT INTO "+dest+" (" + ", ".join(
+            ["ogc_fid"] + [quote_ident(col) for col in attributes]
+            + [quote_ident(geom) for geom in geometries]) + ") "
+                  "VALUES (" + ", ".join(
+                      ["?"] * (1 + len(attributes))
+                      + ["GeomFromEWKB(?)"] * len(geometries)) + ")")
+
+        if DEBUG:
+            print("streaming", source, "to", dest)
+        # rows stay on the server until fetched
+        for rows in pcur.stream("SELECT "+select+" FROM "+source, BATCH_SIZE):
+            scur.executemany(insert, [[sqlite_value(val) for val in row]
+                                      for row in rows])
+            # let concurrent writers in between batches
+            scur.commit()
+
+        if spatial_index:
+            for geom in geometries:
+                scur.execute("SELECT CreateSpatialIndex('{}', '{}')".format(
+                    dest, geom))
+        scur.commit()
+
+    def sqlite_to_pg(self, sqlite_filename, scur, source, pg_conn_info, pcur,
+                     dest, fid, geometry_name=''):
+        """Copy the spatialite table source into the new postgres table dest
+        (schema.table), ogc_fid becomes the primary key fid.
+
+        Rows are sent by batches of BATCH_SIZE with COPY, geometries as hex
+        EWKB, booleans as 0/1, postgres parses them on input"""
+        registered = sqlite_geometry_columns(scur, source)
+        scur.execute("PRAGMA table_info("+source+")")
+        table_info = scur.fetchall()
+        geometries = {col: registered[col.lower()]
+                      for [_, col, _, _, _, _] in table_info
+                      if col.lower() in registered}
+        attributes = [(col, pg_type(typ))
+                      for [_, col, typ, _, _, _] in table_info
+                      if col.lower() != 'ogc_fid' and col not in geometries]
+
+        pcur.execute("CREATE TABLE "+dest+" ("+fid+" integer PRIMARY KEY"
+                     + "".join([", {} {}".format(quote_ident(col), typ)
+                                for col, typ in attributes])
+                     + "".join([", {} geometry('{}', {})".format(
+                         quote_ident(geom), geom_type, srid)
+                                for geom, (srid, geom_type)
+                                in geometries.items()])+")")
+
+        select = ", ".join(
+            ["ogc_fid"] + [quote_ident(col) for col, typ in attributes]
+            + ["AsEWKB({})".format(quote_ident(geom)) for geom in geometries])
+        names = ([fid] + [quote_ident(col) for col, typ in attributes]
+                 + [quote_ident(geom) for geom in geometries])
+        nb_attributes = 1 + len(attributes)
+
+        if DEBUG:
+            print("streaming", source, "to", dest)
+        for rows in scur.stream("SELECT "+select+" FROM "+source,
+                                BATCH_SIZE):
+            if geometries:
+                rows = [row[:nb_attributes] + tuple(
+                            None if val is None else bytes(val).hex()
+                            for val in row[nb_attributes:])
+                        for row in rows]
+            copy_rows(pcur, dest, names, rows)
+        pcur.commit()
+
+
+    def pg_to_pg(self, pg_conn_info, pcur, source, pg_conn_info_copy,
+                 pcurcpy, dest, fid, geometry_name='', spatial_index=True,
+                 dest_fid='ogc_fid'):
+        """Copy the postgres relation source (schema.table) into the new
+        table dest (schema.table) of another postgres database, the source
+        column fid becomes the primary key dest_fid.
+
+        Data is piped from a binary COPY TO STDOUT into a binary COPY FROM
+        STDIN by chunks of COPY_CHUNK_SIZE bytes, it is never held in
+        memory as a whole"""
+        columns = pg_copy_columns(pcur, source)
+        geometries = pg_geometry_columns(pcur, source)
+
+        pcurcpy.execute("CREATE TABLE "+dest+" (" + ", ".join(
+            ["{} {}{}".format(
+                dest_fid if col == fid else quote_ident(col),
+                typ if copyable else "varchar",
+                " PRIMARY KEY" if col == fid else "")
+             for col, typ, copyable in columns])+")")
+
+        select = ", ".join(
+            [quote_ident(col) if copyable
+             else quote_ident(col)+"::varchar"
+             for col, typ, copyable in columns])
+        names = ", ".join([dest_fid if col == fid else quote_ident(col)
+                           for col, typ, copyable in columns])
+
+        if DEBUG:
+            print("copying", source, "to", dest)
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb')
+        writer = os.fdopen(write_fd, 'wb')
+        errors = []
+        reader_closed = threading.Event()
+
+        def copy_to():
+            try:
+                pcur.copy_expert("COPY (SELECT "+select+" FROM "+source+") "
+                                 "TO STDOUT (FORMAT binary)", writer,
+                                 COPY_CHUNK_SIZE)
+            except Exception as e:
+                # once the reader is closed, the writer only fails because
+                # of the broken pipe
+                if not reader_closed.is_set():
+                    errors.append(e)
+            finally:
+                writer.close()
+
+        thread = threading.Thread(target=copy_to)
+        thread.start()
+        try:
+            pcurcpy.copy_expert("COPY "+dest+" ("+names+") "
+                                "FROM STDIN (FORMAT binary)", reader,
+                                COPY_CHUNK_SIZE)
+        except Exception as e:
+            # unblocks the writer if the COPY FROM failed
+            reader_closed.set()
+            reader.close()
+            thread.join()
+            # a COPY TO failed before truncates the pipe, which makes the
+            # COPY FROM fail too, the source error is the cause
+            if errors:
+                raise errors[0] from e
+            raise
+        reader.close()
+        thread.join()
+        if errors:
+            raise errors[0]
+
+        if spatial_index:
+            for geom in geometries:
+                pcurcpy.execute("CREATE INDEX ON "+dest+" "
+                                "USING gist ("+quote_ident(geom)+")")
+        pcurcpy.commit()
+
+
+class Ogr2ogrTransfer(object):
+    """Copy tables by running one ogr2ogr process per table"""
+
+    # concurrent ogr2ogr processes fail on a locked spatialite file
+    concurrent_sqlite = False
+
+    def pg_to_sqlite(self, pg_conn_info, pcur, source, sqlite_filename, scur,
+                     dest, fid, geometry_name='', spatial_index=True):
+        """Copy the postgres relation source (schema.table) into the new
+        spatialite table dest, the source column fid becomes ogc_fid.
+        The spatialite file must already hold the spatial metadata"""
+        # ogr2ogr writes with its own connections
+        pcur.commit()
+        scur.commit()
+        # same bulk load settings as the spatialite backend connections,
+        # see utils.sqlite_bulk_load
+        cmd = ['ogr2ogr',
+               '--config', 'OGR_SQLITE_SYNCHRONOUS', 'OFF',
+               '--config', 'OGR_SQLITE_CACHE', '64',
+               '-gt', str(BATCH_SIZE),
+               '-preserve_fid',
+               '-lco', 'FID=ogc_fid',
+               '-lco', 'GEOMETRY_NAME={}'.format(geometry_name),
+               '-lco', 'SPATIAL_INDEX={}'.format(
+                   'YES' if spatial_index else 'NO'),
+               '-f', 'SQLite',
+               '-update',
+               '"' + sqlite_filename + '"',
+               'PG:"'+pg_conn_info+'"',
+               source,
+               '-nln', dest]
+        if DEBUG:
+            print(' '.join(cmd))
+        os.system(' '.join(cmd))
+
+    def sqlite_to_pg(self, sqlite_filename, scur, source, pg_conn_info, pcur,
+                     dest, fid, geometry_name=''):
+        """Copy the spatialite table source into the new postgres table dest
+        (schema.table), ogc_fid becomes the primary key fid"""
+        pcur.commit()
+        scur.commit()
+        cmd = ['ogr2ogr',
+               '-preserve_fid',
+               '-lco', 'GEOMETRY_NAME={}'.format(geometry_name),
+               '-f',
+               'PostgreSQL',
+               'PG:"'+pg_conn_info+'"',
+               '-lco',
+               'FID='+fid,
+               '"' + sqlite_filename + '"',
+               source,
+               '-nln', dest]
+        if DEBUG:
+            print(' '.join(cmd))
+        os.system(' '.join(cmd))
+
+
+    def pg_to_pg(self, pg_conn_info, pcur, source, pg_conn_info_copy,
+                 pcurcpy, dest, fid, geometry_name='', spatial_index=True,
+                 dest_fid='ogc_fid'):
+        """Copy the postgres relation source (schema.table) into the new
+        table dest (schema.table) of another postgres database, the source
+        column fid becomes the primary key dest_fid"""
+        pcur.commit()
+        pcurcpy.commit()
+        cmd = ['ogr2ogr',
+               '-preserve_fid',
+               '-lco', 'FID='+dest_fid,
+               '-lco', 'schema=' + dest.split('.')[0],
+               '-lco', 'GEOMETRY_NAME={}'.format(geometry_name),
+               '-lco', 'SPATIAL_INDEX={}'.format(
+                   'GIST' if spatial_index else 'NONE'),
+               '-f', 'PostgreSQL',
+               '-update',
+               'PG:"'+pg_conn_info_copy+'"',
+               'PG:"'+pg_conn_info+'"',
+               source,
+               '-nln', dest]
+        if DEBUG:
+            print(' '.join(cmd))
+        os.system(' '.join(cmd))
+
+
+TRANSFERS = {'stream': StreamTransfer, 'ogr2ogr': Ogr2ogrTransfer}
+
+
+def get_transfer(name=None):
+    """Returns the transfer engine called name, defaults to the environment
+    variable VERSIONING_TRANSFER or to 'stream'"""
+    name = name or os.environ.get('VERSIONING_TRANSFER', 'stream')
+    if name not in TRANSFERS:
+        raise RuntimeError("Unknown transfer engine "+name+", "
+                           "expected one of "+", ".join(TRANSFERS))
+    return TRANSFERS[name]()
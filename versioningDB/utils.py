@@ -23,13 +23,20 @@
 import platform
 import re
 import psycopg2
+import psycopg2.extras
 from sqlite3 import dbapi2
 import getpass
 import sys
 import traceback
 import codecs
+import io
 import os
-from itertools import zip_longest
+import threading
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import zip_longest, count, islice
 from collections import defaultdict
 
 # Deactivate stdout (like output of print statements) because windows
@@ -40,15 +47,159 @@ if iswin:
     sys.stdout = open(os.devnull, 'w')
 
 
+class StatementCollector(object):
+    """Trace sink keeping the traced statements in memory, in entries"""
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+    def report(self, n=10):
+        """see trace_report"""
+        with self.lock:
+            return trace_report(self.entries, n)
+
+
+class JsonLinesSink(object):
+    """Trace sink writing each traced statement as a line of JSON"""
+    def __init__(self, filename):
+        self.file = codecs.open(filename, 'a', 'utf-8')
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry)+'\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# sink receiving the statements executed by all Db objects, set with
+# set_trace_sink or with the environment variable VERSIONING_TRACE=filename
+# to append them to a JSON lines file
+trace_sink = (JsonLinesSink(os.environ['VERSIONING_TRACE'])
+              if os.environ.get('VERSIONING_TRACE') else None)
+
+
+def set_trace_sink(sink):
+    """Trace the statements executed by all Db objects to sink, an object
+    with a record(entry) method such as StatementCollector or JsonLinesSink,
+    None stops tracing. Returns the previous sink"""
+    global trace_sink
+    previous = trace_sink
+    trace_sink = sink
+    return previous
+
+
+def trace_report(entries, n=10):
+    """Returns the n statements with the longest total duration of each
+    operation of the traced entries, as {operation: [(seconds, calls,
+    sql), ...]}"""
+    totals = defaultdict(lambda: [0., 0])
+    for entry in entries:
+        total = totals[(entry['operation'], entry['sql'])]
+        total[0] += entry['seconds']
+        total[1] += 1
+    report = defaultdict(list)
+    for (operation, sql), (seconds, calls) in totals.items():
+        report[operation].append((seconds, calls, sql))
+    return {operation: sorted(statements, reverse=True)[:n]
+            for operation, statements in report.items()}
+
+
+def _trace_callers():
+    """Returns the versioningDB functions that executed the statement, the
+    first one called (the operation) and the last one (the caller), as
+    module.function names"""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    operation = caller = None
+    frame = sys._getframe(2)
+    while frame:
+        filename = frame.f_code.co_filename
+        if (os.path.dirname(os.path.abspath(filename)) == package_dir
+                and os.path.basename(filename) not in ('utils.py',
+                                                       'versioningAbc.py')):
+            operation = "{}.{}".format(
+                os.path.basename(filename)[:-3], frame.f_code.co_name)
+            caller = caller or operation
+        frame = frame.f_back
+    return operation, caller
+
+
+# pragmas of the spatialite working copies, applied by Db to each connection.
+# page_size only applies to a new file and must be set before it is in WAL
+# mode, the journal mode can be set with VERSIONING_SQLITE_JOURNAL_MODE (e.g.
+# DELETE for files on a network share, where WAL does not work)
+SQLITE_JOURNAL_MODE = os.environ.get('VERSIONING_SQLITE_JOURNAL_MODE', 'WAL')
+if SQLITE_JOURNAL_MODE.upper() not in ('DELETE', 'TRUNCATE', 'PERSIST',
+                                       'MEMORY', 'WAL', 'OFF'):
+    # sqlite ignores an unknown mode silently
+    sys.stderr.write("VERSIONING_SQLITE_JOURNAL_MODE={} is not a SQLite "
+                     "journal mode, WAL is used\n".format(SQLITE_JOURNAL_MODE))
+    SQLITE_JOURNAL_MODE = 'WAL'
+
+SQLITE_PRAGMAS = [
+    "page_size = 8192",
+    "journal_mode = " + SQLITE_JOURNAL_MODE,
+    "synchronous = NORMAL",
+    "cache_size = -65536"]
+
+
+def sqlite_bulk_load(scur):
+    """Stop syncing the spatialite file to disk before a bulk load, a crash
+    in between leaves a working copy to checkout again, see
+    sqlite_end_bulk_load"""
+    scur.commit()
+    scur.execute("PRAGMA synchronous = OFF")
+
+
+def sqlite_end_bulk_load(scur):
+    """Sync the spatialite file again after sqlite_bulk_load and gather the
+    statistics of the loaded tables"""
+    scur.commit()
+    scur.execute("PRAGMA synchronous = NORMAL")
+    scur.execute("PRAGMA analysis_limit = 1000")
+    scur.execute("ANALYZE")
+    scur.commit()
+
+
+# rows fetched at once by Db.stream
+STREAM_ITERSIZE = 10000
+
+# version of the server side functions of sql/functions.sql, to be increased
+# when they change so that older installs are not called
+SERVER_FUNCTIONS_VERSION = 1
+
+# suffixes of the names of the postgres server-side cursors of Db.stream
+_stream_ids = count()
+
+
 class Db(object):
     """Basic wrapper arround DB cursor that allows for logging SQL commands"""
-    def __init__(self, con, filename=''):
-        """The passed connection must be closed with close()"""
+    def __init__(self, con, filename='', release=None, catalog=None):
+        """The passed connection must be closed with close(), if release is
+        given it is called with the connection instead of closing it.
+        catalog is the optional Catalog of the database"""
         self.con = con
+        self.release = release
+        self.catalog = catalog
         if isinstance(con, dbapi2.Connection):
             self.db_type = 'sp : '
             self.con.enable_load_extension(True)
             self.con.execute("SELECT load_extension('mod_spatialite')")
+            for pragma in SQLITE_PRAGMAS:
+                try:
+                    self.con.execute("PRAGMA "+pragma)
+                except dbapi2.OperationalError as e:
+                    # a file opened by another process keeps its journal
+                    # mode until it is opened alone
+                    if not pragma.startswith("journal_mode"):
+                        sys.stderr.write("PRAGMA {} failed: {}\n".format(
+                            pragma, e))
         else:
             self.db_type = 'pg : '
         self.cur = self.con.cursor()
@@ -78,8 +229,8 @@ class Db(object):
         """Set verbose level"""
         self._verbose = verbose
 
-    def execute(self, sql):
-        """Execute SQL command"""
+    def __log(self, sql):
+        """Log SQL command, and the implicit BEGIN if needed"""
         if not self.begun:
             self.begun = True
             if self._verbose:
@@ -90,14 +241,106 @@ class Db(object):
             print(self.db_type, sql, ';')
         if self.log:
             self.log.write(sql+';\n')
+
+    def __trace(self, sql, start, cursor=None):
+        """Send the statement started at start to the trace sink, cursor is
+        the one that executed it if not the default one"""
+        operation, caller = _trace_callers()
+        trace_sink.record({'db': self.db_type[:2],
+                           'sql': sql,
+                           'seconds': time.perf_counter() - start,
+                           'rowcount': (cursor or self.cur).rowcount,
+                           'operation': operation,
+                           'caller': caller})
+
+    def execute(self, sql):
+        """Execute SQL command"""
+        self.__log(sql)
         try:
+            start = time.perf_counter()
             self.cur.execute(sql)
+            if trace_sink:
+                self.__trace(sql, start)
             return self.cur
         except Exception as e:
             sys.stderr.write(traceback.format_exc())
             sys.stderr.write("\n sql: {}\n\n".format(sql))
             raise e
 
+    def executemany(self, sql, rows, template=None):
+        """Execute SQL command once for each row of parameters
+
+        Postgres statements must use the 'INSERT ... VALUES %s' form, rows
+        are then sent in a single multi-row statement. The optional template
+        is the psycopg2 template of one row, e.g. '(%s, ST_GeomFromEWKB(%s))'
+        """
+        self.__log('-- {} rows\n{}'.format(len(rows), sql))
+        try:
+            start = time.perf_counter()
+            if self.isPostgres():
+                psycopg2.extras.execute_values(
+                    self.cur, sql, rows, template, page_size=len(rows))
+            else:
+                self.cur.executemany(sql, rows)
+            if trace_sink:
+                self.__trace(sql, start)
+            return self.cur
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+            sys.stderr.write("\n sql: {}\n\n".format(sql))
+            raise e
+
+    def copy_expert(self, sql, file_, size=8192):
+        """Execute a Postgres COPY ... FROM STDIN or COPY ... TO STDOUT
+        command, reading or writing file_ by chunks of size bytes"""
+        self.__log(sql)
+        try:
+            start = time.perf_counter()
+            self.cur.copy_expert(sql, file_, size)
+            if trace_sink:
+                self.__trace(sql, start)
+            return self.cur
+        except Exception as e:
+            sys.stderr.write(traceback.format_exc())
+            sys.stderr.write("\n sql: {}\n\n".format(sql))
+            raise e
+
+    def stream(self, sql, itersize=None):
+        """Execute the query sql and yield its result by lists of up to
+        itersize rows (STREAM_ITERSIZE by default) instead of fetching it
+        as a whole.
+
+        Postgres rows are read with a server-side cursor and stay on the
+        server until fetched, which needs the transaction to last until the
+        last list: do not commit before the end of the iteration. The query
+        runs on its own cursor, other statements can be executed between
+        two lists"""
+        itersize = itersize or STREAM_ITERSIZE
+        self.__log(sql)
+        if self.isPostgres():
+            cursor = self.con.cursor(
+                name="versioning_stream_{}".format(next(_stream_ids)))
+            cursor.itersize = itersize
+        else:
+            cursor = self.con.cursor()
+        try:
+            try:
+                start = time.perf_counter()
+                cursor.execute(sql)
+                if trace_sink:
+                    self.__trace(sql, start, cursor)
+            except Exception as e:
+                sys.stderr.write(traceback.format_exc())
+                sys.stderr.write("\n sql: {}\n\n".format(sql))
+                raise e
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
     def fetchall(self):
         """Returns the result of the previous execute as a list of tuples"""
         return self.cur.fetchall()
@@ -124,7 +367,240 @@ class Db(object):
                 self.log.write('END;\n')
         if self.log:
             self.log.write('-- closing connection\n')
-        self.con.close()
+        if self.release:
+            self.release(self.con)
+        else:
+            self.con.close()
+
+
+class ConnectionPool(object):
+    """Keeps postgres connections open for reuse, keyed by connection string.
+
+    The Db returned by connect() gives its connection back to the pool when
+    closed, uncommitted changes are rolled back as closing the connection
+    would do. At most size idle connections are kept per connection string.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.__idle = defaultdict(list)
+        self.__catalogs = defaultdict(Catalog)
+        self.__lock = threading.Lock()
+
+    def connect(self, pg_conn_info):
+        """Returns a Db on an idle connection, or on a new one, sharing the
+        Catalog of the other connections to the same database"""
+        with self.__lock:
+            idle = self.__idle[pg_conn_info]
+            con = idle.pop() if idle else None
+            catalog = self.__catalogs[pg_conn_info]
+        if con is None:
+            con = psycopg2.connect(pg_conn_info)
+        return Db(con, release=partial(self.__release, pg_conn_info),
+                  catalog=catalog)
+
+    def __release(self, pg_conn_info, con):
+        if con.closed:
+            return
+        try:
+            con.rollback()
+        except psycopg2.Error:
+            con.close()
+            return
+        with self.__lock:
+            idle = self.__idle[pg_conn_info]
+            if len(idle) < self.size:
+                idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        """Close all idle connections and forget the cached catalogs"""
+        with self.__lock:
+            cons = sum(self.__idle.values(), [])
+            self.__idle.clear()
+            self.__catalogs.clear()
+        for con in cons:
+            con.close()
+
+
+def pg_columns_sql(schema, table=None):
+    """Returns the query of the columns of the tables of schema, or of
+    table only, as (table, column, is_pk, quoted column, data_type,
+    udt_name, character_maximum_length, element type) in ordinal order.
+
+    pg_catalog is read directly since information_schema.columns is slow
+    on large catalogs, the values are the information_schema ones except
+    for the element type of arrays which is format_type of the element,
+    i.e. usable in a cast, even for user defined types"""
+    return """
+        SELECT c.relname, a.attname, a.attnum = ANY(i.indkey),
+            quote_ident(a.attname),
+            CASE WHEN COALESCE(b.typelem, t.typelem) != 0
+                    AND COALESCE(b.typlen, t.typlen) = -1 THEN 'ARRAY'
+                WHEN COALESCE(bn.nspname, tn.nspname) = 'pg_catalog'
+                    THEN format_type(COALESCE(b.oid, t.oid), NULL)
+                ELSE 'USER-DEFINED' END,
+            COALESCE(b.typname, t.typname),
+            CASE WHEN COALESCE(b.oid, t.oid)
+                    IN ('bpchar'::regtype, 'varchar'::regtype)
+                AND COALESCE(NULLIF(t.typtypmod, -1), a.atttypmod) != -1
+                THEN COALESCE(NULLIF(t.typtypmod, -1), a.atttypmod) - 4 END,
+            CASE WHEN COALESCE(b.typelem, t.typelem) != 0
+                    AND COALESCE(b.typlen, t.typlen) = -1
+                THEN format_type(COALESCE(b.typelem, t.typelem), NULL) END
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid
+            AND a.attnum > 0 AND NOT a.attisdropped
+        JOIN pg_type t ON t.oid = a.atttypid
+        JOIN pg_namespace tn ON tn.oid = t.typnamespace
+        LEFT JOIN pg_type b ON t.typtype = 'd' AND b.oid = t.typbasetype
+        LEFT JOIN pg_namespace bn ON bn.oid = b.typnamespace
+        LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+        WHERE n.nspname = '"""+schema+"""'
+        """+("AND c.relname = '"+table+"'" if table is not None else "")+"""
+        AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+        ORDER BY c.relname, a.attnum"""
+
+
+class SchemaCatalog(object):
+    """Catalog metadata of the tables of a versioned schema:
+
+    columns: table -> list of (column, data_type, udt_name,
+        character_maximum_length, elem_type), see pg_columns
+    pkeys: table -> quoted primary key column
+    geoms: table -> list of geometry columns
+    branches: list of branches
+    """
+    def __init__(self, cur, schema):
+        self.columns = defaultdict(list)
+        self.pkeys = {}
+        cur.execute(pg_columns_sql(schema))
+        for (table, column, is_pk, quoted, data_type, udt_name, max_length,
+             elem_type) in cur.fetchall():
+            self.columns[table].append(
+                (column, data_type, udt_name, max_length, elem_type))
+            if is_pk and table not in self.pkeys:
+                self.pkeys[table] = quoted
+
+        self.geoms = defaultdict(list)
+        cur.execute("SELECT f_table_name, f_geometry_column "
+                    "FROM geometry_columns "
+                    "WHERE f_table_schema = '"+schema+"'")
+        for table, geom in cur.fetchall():
+            self.geoms[table].append(geom)
+
+        cur.execute("SELECT DISTINCT branch FROM "+schema+".revisions")
+        self.branches = [res for [res] in cur.fetchall()]
+
+
+# seconds a cached schema is used before checking that it did not change
+CATALOG_CHECK_SECONDS = 5
+
+
+class Catalog(object):
+    """Cache of the catalog metadata of the versioned schemas of a database,
+    each schema is loaded in one go the first time it is needed.
+
+    Schemas without a revisions table are not cached. A cached schema is
+    checked again at most every CATALOG_CHECK_SECONDS against its last
+    revision and the relations and columns count of the schema, so that
+    branches and tables added by other connections are seen. historize and
+    add_branch invalidate it right away.
+    """
+    def __init__(self):
+        self.__schemas = {}
+        self.__lock = threading.Lock()
+
+    def __stamp(self, cur, schema):
+        """Returns a cheap summary of the state of schema, None if it is
+        not versioned"""
+        cur.execute("SELECT to_regclass('"+quote_ident(schema)+".revisions')")
+        [revisions] = cur.fetchone()
+        if not revisions:
+            return None
+        cur.execute("SELECT (SELECT MAX(rev) FROM "+schema+".revisions), "
+                    "COUNT(*), MAX(c.oid::bigint), SUM(c.relnatts) "
+                    "FROM pg_class c "
+                    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                    "WHERE n.nspname = '"+schema+"' "
+                    "AND c.relkind IN ('r', 'p', 'v', 'f')")
+        return cur.fetchone()
+
+    def schema(self, cur, schema):
+        """Returns the SchemaCatalog of schema, None if it is not
+        versioned"""
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__schemas.get(schema)
+        if entry and now - entry[2] < CATALOG_CHECK_SECONDS:
+            return entry[0]
+        stamp = self.__stamp(cur, schema)
+        if stamp is None:
+            self.invalidate(schema)
+            return None
+        if entry and entry[1] == stamp:
+            cache = entry[0]
+        else:
+            cache = SchemaCatalog(cur, schema)
+        with self.__lock:
+            self.__schemas[schema] = (cache, stamp, now)
+        return cache
+
+    def table(self, cur, schema, table):
+        """Returns the SchemaCatalog of schema if table is part of it, None
+        otherwise"""
+        cache = self.schema(cur, schema)
+        return cache if cache and table in cache.columns else None
+
+    def invalidate(self, schema=None):
+        """Forget the metadata of schema, of all schemas by default"""
+        with self.__lock:
+            if schema is None:
+                self.__schemas.clear()
+            else:
+                self.__schemas.pop(schema, None)
+
+
+def catalog_table(cur, schema, table):
+    """Returns the cached SchemaCatalog of schema if cur has a Catalog and
+    table belongs to a versioned schema, None otherwise"""
+    catalog = getattr(cur, 'catalog', None)
+    return catalog.table(cur, schema, table) if catalog else None
+
+
+def invalidate_catalog(cur, schema):
+    """Forget the cached metadata of schema, if cur has a Catalog"""
+    catalog = getattr(cur, 'catalog', None)
+    if catalog:
+        catalog.invalidate(schema)
+
+
+def pg_connect(pg_conn_info, pool=None):
+    """Returns a Db on a connection taken from pool, or on a new connection
+    if no pool is given"""
+    if pool:
+        return pool.connect(pg_conn_info)
+    return Db(psycopg2.connect(pg_conn_info))
+
+
+def checkout_workers(workers=None):
+    """Returns the number of tables copied concurrently on checkout, workers
+    defaults to the environment variable VERSIONING_CHECKOUT_WORKERS or to 1,
+    i.e. tables are copied one after the other"""
+    if workers is None:
+        workers = int(os.environ.get('VERSIONING_CHECKOUT_WORKERS', 1))
+    return max(1, int(workers))
+
+
+def run_parallel(function, args_list, workers=1):
+    """Calls function(*args) for each args of args_list in a pool of
+    workers threads, or in the calling thread if workers is 1, and returns
+    the list of results. The first exception raised is raised again"""
+    if workers <= 1 or len(args_list) <= 1:
+        return [function(*args) for args in args_list]
+    with ThreadPoolExecutor(min(workers, len(args_list))) as executor:
+        return list(executor.map(lambda args: function(*args), args_list))
 
 
 def os_info():
@@ -142,6 +618,12 @@ def os_info():
 
 def pg_pk(cur, schema_name, table_name):
     """Fetch the primary key of the specified postgis table"""
+    cache = catalog_table(cur, schema_name, table_name)
+    if cache:
+        if table_name not in cache.pkeys:
+            raise RuntimeError("table "+schema_name + "." + table_name +
+                               " does not have a primary key")
+        return cache.pkeys[table_name]
     cur.execute("SELECT quote_ident(a.attname) as column_name "
                 "FROM pg_index i "
                 "JOIN pg_attribute a ON a.attrelid = i.indrelid "
@@ -159,6 +641,9 @@ def pg_pk(cur, schema_name, table_name):
 def pg_geoms(cur, schema_name, table_name):
     """Fetch the list of geometry columns of the specified postgis table,
     empty if none"""
+    cache = catalog_table(cur, schema_name, table_name)
+    if cache:
+        return list(cache.geoms[table_name])
     cur.execute("SELECT f_geometry_column FROM geometry_columns "
                 "WHERE f_table_schema = '"+schema_name+"' "
                 "AND f_table_name = '"+table_name+"'")
@@ -195,10 +680,49 @@ def pg_geom(cur, schema_name, table_name):
 
 def pg_branches(pcur, schema):
     """returns a list of branches for this schema"""
+    catalog = getattr(pcur, 'catalog', None)
+    cache = catalog.schema(pcur, schema) if catalog else None
+    if cache:
+        return list(cache.branches)
     pcur.execute("SELECT DISTINCT branch FROM "+schema+".revisions")
     return [res for [res] in pcur.fetchall()]
 
 
+def pg_columns(cur, schema, table):
+    """Fetch the (column, data_type, udt_name, character_maximum_length,
+    elem_type) of the columns of the specified table in ordinal order,
+    with the values of information_schema.columns, elem_type being the
+    type of the elements of ARRAY columns, None for other columns"""
+    cache = catalog_table(cur, schema, table)
+    if cache:
+        return list(cache.columns[table])
+    cur.execute(pg_columns_sql(schema, table))
+    return [(column, data_type, udt_name, max_length, elem_type)
+            for (_, column, _, _, data_type, udt_name, max_length, elem_type)
+            in cur.fetchall()]
+
+
+def pg_tables(cur, schema, like=None, base_tables=False):
+    """Fetch the names of the tables and views of schema, with names
+    matching the LIKE pattern like if given, only the tables if
+    base_tables (i.e. table_type = 'BASE TABLE' in information_schema)"""
+    cur.execute("SELECT c.relname FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = '"+schema+"' "
+                "AND c.relkind IN "
+                + ("('r', 'p') " if base_tables else "('r', 'p', 'v', 'f') ")
+                + ("AND c.relname LIKE '"+like+"' " if like else "")
+                + "ORDER BY c.relname")
+    return [table for [table] in cur.fetchall()]
+
+
+def pg_schema_exists(cur, schema):
+    """Returns True if schema exists"""
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_namespace "
+                "WHERE nspname = '"+schema+"')")
+    return cur.fetchone()[0]
+
+
 def pg_user_defined_type(cur, schema, table, column):
     """Return the user defined type for given column
 
@@ -207,39 +731,113 @@ def pg_user_defined_type(cur, schema, table, column):
     :param table: Table name
     :param column: Column name
     """
-    cur.execute(f"""SELECT udt_name
-    FROM information_schema.columns
-    WHERE table_schema = '{schema}' AND table_name = '{table}'
-    AND data_type = 'USER-DEFINED' AND column_name= '{column}';
-    """)
-
-    if not cur.hasrow():
-        raise RuntimeError(f"Column {column} from {schema}.{table} "
-                           "is not a user defined type")
-    res = cur.fetchone()[0]
-    return res
+    for col, data_type, udt_name, _, _ in pg_columns(cur, schema, table):
+        if col == column and data_type == 'USER-DEFINED':
+            return udt_name
+    raise RuntimeError(f"Column {column} from {schema}.{table} "
+                       "is not a user defined type")
 
 
 def pg_array_elem_type(cur, schema, table, column):
     """Fetch type of elements of a column of type ARRAY"""
-    cur.execute("SELECT e.data_type FROM information_schema.columns c "
-                "LEFT JOIN information_schema.element_types e "
-                "ON ((c.table_catalog, c.table_schema, c.table_name, "
-                "'TABLE', c.dtd_identifier) "
-                "= (e.object_catalog, e.object_schema, e.object_name, "
-                "e.object_type, e.collection_type_identifier)) "
-                "WHERE c.table_schema = '"+schema+"' "
-                "AND c.table_name = '"+table+"' "
-                "AND c.column_name = '"+column+"'")
-    if not cur.hasrow():
-        raise RuntimeError('column '+column+' of '
-                           + schema + '.' + table + ' is not an ARRAY')
-    [res] = cur.fetchone()
-    return res
-
-
-def get_pg_users_list(pg_conn_info):
-    pcur = Db(psycopg2.connect(pg_conn_info))
+    for col, _, _, _, elem_type in pg_columns(cur, schema, table):
+        if col == column:
+            return elem_type
+    raise RuntimeError('column '+column+' of '
+                       + schema + '.' + table + ' is not an ARRAY')
+
+
+def pg_column_names(cur, schema, table):
+    """Fetch the column names of the specified table"""
+    return [col for col, _, _, _, _ in pg_columns(cur, schema, table)]
+
+
+def pg_late(pcur, versioned_layers, detail=False):
+    """Returns the number of revisions the versioned layers, a list of
+    (rev, branch, table_schema, table_name) taken from initial_revision,
+    are late by, 0 if they are up to date.
+
+    The last revision of every (schema, branch) is fetched with one query.
+    With detail, returns (late_by, layers, revisions) where layers maps
+    (table_schema, table_name) to the number of revisions this layer is late
+    by and revisions lists the (table_schema, rev, branch, commit_msg, date,
+    author) of the revisions committed since the oldest layer was updated,
+    fetched with a second query"""
+    # oldest revision of the layers of each (schema, branch)
+    oldest = {}
+    for rev, branch, table_schema, table in versioned_layers:
+        key = (table_schema, branch)
+        oldest[key] = min(rev, oldest.get(key, rev))
+
+    pcur.execute(" UNION ALL ".join([
+        "SELECT '"+table_schema+"', '"+branch+"', MAX(rev) "
+        "FROM "+table_schema+".revisions WHERE branch = '"+branch+"'"
+        for table_schema, branch in oldest]))
+    max_revs = {(table_schema, branch): max_rev
+                for table_schema, branch, max_rev in pcur.fetchall()}
+
+    layers = {(table_schema, table):
+              max(max_revs[(table_schema, branch)] - rev, 0)
+              for rev, branch, table_schema, table in versioned_layers}
+    late_by = max(layers.values()) if layers else 0
+    if not detail:
+        return late_by
+
+    pcur.execute(" UNION ALL ".join([
+        "SELECT '"+table_schema+"', rev, branch, commit_msg, date, author "
+        "FROM "+table_schema+".revisions "
+        "WHERE branch = '"+branch+"' AND rev > "+str(rev)
+        for (table_schema, branch), rev in oldest.items()])
+        + " ORDER BY 1, 2")
+    return late_by, layers, pcur.fetchall()
+
+
+def changed_tables(cur, wc_schema):
+    """Returns the names of the tables of the working copy wc_schema
+    ('main' for spatialite) edited since the last commit, as counted by the
+    triggers of their views in initial_revision.changes, None if the working
+    copy predates the counter"""
+    if cur.isSpatialite():
+        cur.execute("PRAGMA "+wc_schema+".table_info(initial_revision)")
+        columns = [res[1] for res in cur.fetchall()]
+    else:
+        columns = pg_column_names(cur, wc_schema, 'initial_revision')
+    if 'changes' not in columns:
+        return None
+    cur.execute("SELECT table_name FROM "+wc_schema+".initial_revision "
+                "WHERE changes > 0")
+    return [table for [table] in cur.fetchall()]
+
+
+def follow_conflict_children(cur, conflicts, diff, pkey, branch, cols):
+    """Replace the 'theirs' 'modified' rows of the conflicts table that have
+    a child by the last descendant of their {branch}_child chain in the diff
+    table, as a 'modified' row if it is still alive, 'deleted' otherwise.
+
+    All chains are followed at once by a recursive query, cols are the
+    columns of the conflicts table after conflict_id, origin and action"""
+    cur.execute("WITH RECURSIVE descendant(cflt_id, cflt_pk, cflt_child) AS ("
+                "SELECT conflict_id, "+pkey+", "+branch+"_child "
+                "FROM "+conflicts+" "
+                "WHERE origin = 'theirs' AND action = 'modified' "
+                "AND "+branch+"_child IS NOT NULL "
+                "UNION ALL "
+                "SELECT cflt_id, "+pkey+", "+branch+"_child "
+                "FROM descendant JOIN "+diff+" ON "+pkey+" = cflt_child) "
+                "INSERT INTO "+conflicts+" "
+                "SELECT cflt_id AS conflict_id, 'theirs' AS origin, "
+                "CASE WHEN "+branch+"_rev_end IS NULL "
+                "THEN 'modified' ELSE 'deleted' END AS action, "+cols+" "
+                "FROM descendant JOIN "+diff+" ON "+pkey+" = cflt_pk "
+                "WHERE cflt_child IS NULL")
+    # the rows inserted above have no child
+    cur.execute("DELETE FROM "+conflicts+" "
+                "WHERE origin = 'theirs' AND action = 'modified' "
+                "AND "+branch+"_child IS NOT NULL")
+
+
+def get_pg_users_list(pg_conn_info, pool=None):
+    pcur = pg_connect(pg_conn_info, pool)
     pcur.execute("select usename from pg_user order by usename ASC")
     pg_users_list = pcur.fetchall()
     pg_users_str_list = []
@@ -249,12 +847,12 @@ def get_pg_users_list(pg_conn_info):
     return pg_users_str_list
 
 
-def get_actual_pk(uri, pg_conn_info):
+def get_actual_pk(uri, pg_conn_info, pool=None):
     """Get actual PK from corresponding table or view.  The result serves to
     ascertain that the PK found by QGIS for PG views matches the real PK.
     """
     mtch = re.match(r'(.+)_([^_]+)_rev_(head|\d+)', uri.schema())
-    pcur = Db(psycopg2.connect(pg_conn_info))
+    pcur = pg_connect(pg_conn_info, pool)
     actual_pkey = get_pkey(pcur, mtch.group(1), uri.table())
     pcur.close()
 
@@ -321,76 +919,186 @@ def get_pkeys(b_cur, schema, table):
     return [res[0] for res in b_cur.fetchall()]
 
 
+FEATURES_CHUNK = 10000
+
+
+def stage_features(pcur, staging_table, schema, table, column, feature_list,
+                   temporary=False):
+    """Store the ids of feature_list in the fid column of staging_table,
+    typed like column of schema.table, and return the subquery selecting
+    them, e.g. for 'WHERE pk IN (SELECT fid FROM staging_table)'.
+    feature_list can be any iterable, its ids are inserted by chunks of
+    FEATURES_CHUNK rows. A temporary staging_table must not be schema
+    qualified"""
+    pcur.execute("DROP TABLE IF EXISTS "+staging_table)
+    pcur.execute("CREATE "+("TEMP " if temporary else "")+"TABLE "
+                 +staging_table+" AS SELECT "+column+" AS fid "
+                 "FROM "+schema+"."+table+" WHERE False")
+    features = iter(feature_list)
+    while True:
+        rows = [(fid,) for fid in islice(features, FEATURES_CHUNK)]
+        if not rows:
+            break
+        pcur.executemany("INSERT INTO "+staging_table+"(fid) VALUES %s",
+                         rows)
+    pcur.execute("ANALYZE "+staging_table)
+    return "(SELECT fid FROM "+staging_table+")"
+
+
+def copy_text(value):
+    """Returns value in the text format of COPY, i.e. the input format of
+    its postgres type with the special characters escaped"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_rows(pcur, table, columns, rows):
+    """Insert rows, a list of tuples of python values, in the columns of
+    the postgres table with a single COPY ... FROM STDIN, postgres parses
+    the values with the input function of the column types"""
+    data = io.StringIO("".join(
+        "\t".join(copy_text(value) for value in row) + "\n"
+        for row in rows))
+    pcur.copy_expert("COPY "+table+" ("+", ".join(columns)+") FROM STDIN",
+                     data)
+
+
 def add_connected_features(pcur, tables, mode):
     """ Add referenced table in tables according to given mode
 
     mode can be referenced or referencing whether you want to checkout
     the foreign key referenced feature or whether you want to checkout
-    the features referencing your primary key
+    the features referencing your primary key. Features connected through
+    several foreign keys are added too, each pass only follows the
+    features found by the previous one: the features of each table are
+    staged once and all the foreign keys are followed by a single query.
     """
 
     assert(mode == "referenced" or mode == "referencing")
 
-    table_orig = "table_from" if mode == "referenced" else "table_to"
-    table_ref = "table_to" if mode == "referenced" else "table_from"
-
-    columns_orig = "columns_from" if mode == "referenced" else "columns_to"
-    columns_ref = "columns_to" if mode == "referenced" else "columns_from"
-
-    tables_cpy = tables.copy()
-
-    # We checkout all referenced features
-    for (schema, table, branch), feature_list in tables_cpy.items():
-
+    # foreign keys of each table, from the checked out features to the
+    # connected ones: (connected table, columns, connected columns)
+    links = defaultdict(list)
+    for schema in set(schema for schema, table, branch in tables):
         pcur.execute(f"""
-        SELECT {table_ref}, {columns_orig}, {columns_ref}
+        SELECT table_from, columns_from, table_to, columns_to
         FROM {schema}.versioning_constraints
-        WHERE {table_orig} = '{table}'
-        AND {table_ref} IS NOT NULL;
+        WHERE table_to IS NOT NULL
         """)
-
-        # get referenced feature ids for each referenced table
-        for t_ref, cols_orig, cols_ref in pcur.fetchall():
-
-            key = (schema, t_ref, branch)
-
-            # t_ref is already in tables and not filtered (feature_list is
-            # None) so we have all feature
-            if (key in tables_cpy and tables_cpy[key] is None):
-                continue
-
-            pkey_orig = pg_pk(pcur, schema, table)
-            pkey_ref = pg_pk(pcur, schema, t_ref)
-
-            where_filter = " AND ".join(
-                ["torig.{} = tref.{}".format(col_orig, col_ref)
-                 for col_orig, col_ref in
-                 zip(cols_orig, cols_ref)])
-
+        for table_from, columns_from, table_to, columns_to in pcur.fetchall():
+            if mode == "referenced":
+                links[(schema, table_from)].append(
+                    (table_to, columns_from, columns_to))
+            else:
+                links[(schema, table_to)].append(
+                    (table_from, columns_to, columns_from))
+
+    pkeys = {}
+
+    def pkey(schema, table):
+        if (schema, table) not in pkeys:
+            pkeys[(schema, table)] = pg_pk(pcur, schema, table)
+        return pkeys[(schema, table)]
+
+    def pkey_type(schema, table):
+        """type of the primary key, to type the NULL ids of the other
+        tables in the UNION ALL below"""
+        for column, data_type, udt_name, _, elem_type in pg_columns(
+                pcur, schema, table):
+            if quote_ident(column) == pkey(schema, table):
+                if data_type == 'ARRAY':
+                    return elem_type+"[]"
+                return udt_name if data_type == 'USER-DEFINED' else data_type
+        raise RuntimeError("Cannot find the primary key of "
+                           + schema + "." + table)
+
+    # features to follow, None means all the features of the table
+    new_features = dict(tables)
+    while new_features:
+        # the features of each table are staged once per pass
+        staged = {}
+        for i, (key, feature_list) in enumerate(new_features.items()):
             if feature_list:
-                fids = ",".join([str(fid) for fid in feature_list])
-                where_filter += f" AND torig.{pkey_orig} in ({fids})"
-
-            pcur.execute(f"""
-            SELECT tref.{pkey_ref}
-            FROM {schema}.{t_ref} tref, {schema}.{table} torig
-            WHERE {where_filter}
-            """)
-
-            tables[key] |= set(
-                [res[0] for res in pcur.fetchall()])
-
-
-def get_checkout_tables(connection, table_names, selected_feature_lists):
+                schema, table, branch = key
+                staged[key] = stage_features(
+                    pcur, "connected_features_fids_{}".format(i), schema,
+                    table, pkey(schema, table), feature_list, temporary=True)
+
+        # all the foreign keys are followed by a single query, the ids of
+        # each connected table are in their own column
+        targets = []
+        selects = []
+        for (schema, table, branch), feature_list in new_features.items():
+            for t_ref, cols_orig, cols_ref in links[(schema, table)]:
+
+                key = (schema, t_ref, branch)
+
+                # t_ref is already in tables and not filtered (feature_list
+                # is None) so we have all feature
+                if tables.setdefault(key, set()) is None:
+                    continue
+
+                where_filter = " AND ".join(
+                    ["torig.{} = tref.{}".format(col_orig, col_ref)
+                     for col_orig, col_ref in
+                     zip(cols_orig, cols_ref)])
+
+                if feature_list:
+                    where_filter += " AND torig.{} IN {}".format(
+                        pkey(schema, table), staged[(schema, table, branch)])
+
+                if key not in targets:
+                    targets.append(key)
+                selects.append((targets.index(key), f"""
+                SELECT DISTINCT tref.{pkey(schema, t_ref)}
+                FROM {schema}.{t_ref} tref, {schema}.{table} torig
+                WHERE {where_filter}
+                """))
+
+        found = defaultdict(set)
+        if selects:
+            # untyped NULLs of a column would be resolved as text
+            nulls = ["NULL::"+pkey_type(schema, table)
+                     for schema, table, branch in targets]
+            sql = " UNION ALL ".join(
+                "SELECT {}, {} FROM ({}) AS connected(fid)".format(
+                    target, ", ".join("fid" if i == target else nulls[i]
+                                      for i in range(len(targets))), select)
+                for target, select in selects)
+            for rows in pcur.stream(sql):
+                for row in rows:
+                    key = targets[row[0]]
+                    fid = row[1 + row[0]]
+                    if fid not in tables[key]:
+                        found[key].add(fid)
+
+        if staged:
+            pcur.execute("DROP TABLE " + ", ".join(
+                "connected_features_fids_{}".format(i)
+                for i, key in enumerate(new_features) if key in staged))
+
+        for key, fids in found.items():
+            tables[key] |= fids
+
+        new_features = {key: fids for key, fids in found.items() if fids}
+
+
+def get_checkout_tables(connection, table_names, selected_feature_lists,
+                        pool=None):
     """ Build and return tables to be checkout according to given
     pg_tables parameter.
 
     :param connection: database connection string
     :param table_names: table name list
     :param selected_feature_lists: selected feature list (ids)
+    :param pool: optional ConnectionPool
 
     """
-    pcur = Db(psycopg2.connect(connection))
+    pcur = pg_connect(connection, pool)
 
     # We build table dictionnary with associated feature set
     tables = defaultdict(set)
@@ -409,6 +1117,7 @@ def get_checkout_tables(connection, table_names, selected_feature_lists):
 
     add_connected_features(pcur, tables, "referenced")
     add_connected_features(pcur, tables, "referencing")
+    pcur.close()
 
     # transform set in list before return
     return {table: list(fids) if fids is not None else []
@@ -9,22 +9,25 @@ import re
 import os
 import psycopg2
 import platform
+from collections import defaultdict
 from . import utils
 from .versioningAbc import versioningAbc
 
 versioningDb = versioningAbc
 
 
-def spatialite(sqlite_filename, pg_conn_info):
-    return versioningDb([sqlite_filename, pg_conn_info], 'spatialite')
+def spatialite(sqlite_filename, pg_conn_info, transfer=None):
+    return versioningDb([sqlite_filename, pg_conn_info], 'spatialite',
+                        transfer)
 
 
 def pgServer(pg_conn_info, schema):
     return versioningDb([pg_conn_info, schema], 'postgres')
 
 
-def pgLocal(pg_conn_info, schema, pg_conn_info_out):
-    return versioningDb([pg_conn_info, schema, pg_conn_info_out], 'pgDistant')
+def pgLocal(pg_conn_info, schema, pg_conn_info_out, transfer=None):
+    return versioningDb([pg_conn_info, schema, pg_conn_info_out], 'pgDistant',
+                        transfer)
 
 
 Db = utils.Db
@@ -34,12 +37,23 @@ pg_geoms = utils.pg_geoms
 pg_geom = utils.pg_geom
 pg_branches = utils.pg_branches
 pg_array_elem_type = utils.pg_array_elem_type
+pg_column_names = utils.pg_column_names
+pg_columns = utils.pg_columns
+pg_tables = utils.pg_tables
+pg_schema_exists = utils.pg_schema_exists
+pg_user_defined_type = utils.pg_user_defined_type
 get_pg_users_list = utils.get_pg_users_list
 get_actual_pk = utils.get_actual_pk
 preserve_fid = utils.preserve_fid
 escape_quote = utils.escape_quote
 quote_ident = utils.quote_ident
 get_username = utils.get_username
+ConnectionPool = utils.ConnectionPool
+pg_connect = utils.pg_connect
+StatementCollector = utils.StatementCollector
+JsonLinesSink = utils.JsonLinesSink
+set_trace_sink = utils.set_trace_sink
+trace_report = utils.trace_report
 
 DEBUG = False
 
@@ -50,13 +64,17 @@ if any(platform.mac_ver()) and gdal_mac_path not in os.environ["PATH"]:
 
 sql_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
 
+# the functions below take an optional pool argument, a ConnectionPool such
+# as the pool attribute of versioningDb objects, to reuse its connections
 
-def historize(pg_conn_info, schema):
-    """Create historisation for the given schema"""
+
+def historize(pg_conn_info, schema, pool=None, partitioned=False):
+    """Create historisation for the given schema, the ended trunk rows are
+    stored apart if partitioned, see partition_history"""
     if not schema:
         raise RuntimeError("no schema specified")
 
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     sql_file = open(os.path.join(sql_path, 'historize.sql'), 'r')
     sql = sql_file.read()
@@ -64,20 +82,267 @@ def historize(pg_conn_info, schema):
     pcur.execute(sql.format(schema=schema))
 
     pcur.commit()
+    utils.invalidate_catalog(pcur, schema)
     pcur.close()
-    add_branch(pg_conn_info, schema, 'trunk', 'initial commit')
+    install_functions(pg_conn_info, schema, pool)
+    add_branch(pg_conn_info, schema, 'trunk', 'initial commit', pool=pool)
+    if partitioned:
+        partition_history(pg_conn_info, schema, pool)
+
+
+def partition_history(pg_conn_info, schema, pool=None):
+    """Store the rows of the versioned tables of schema that are ended in
+    trunk (trunk_rev_end IS NOT NULL) in tables of the same name in the
+    {schema}_history schema, inheriting from the versioned ones.
+
+    Rows are moved by a trigger when their trunk_rev_end is set. Queries on
+    the versioned tables still return all the rows, but the head rows only
+    are read when trunk_rev_end IS NULL is part of the query, as in the head
+    views, thanks to the CHECK constraint of the history tables. Since the
+    parent and child of a row may be in different tables, the foreign keys
+    of the _parent and _child columns are dropped, the ones of the
+    _rev_begin and _rev_end columns, which are not inherited, are created on
+    the history tables"""
+    pcur = utils.pg_connect(pg_conn_info, pool)
+    history = schema+"_history"
+    pcur.execute("CREATE SCHEMA IF NOT EXISTS "+history)
+    partitioned = utils.pg_tables(pcur, history, base_tables=True)
+    branches = utils.pg_branches(pcur, schema)
+
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
+        if table in ('revisions', 'versioning_constraints') \
+                or table in partitioned:
+            continue
+        statements = [
+            "ALTER TABLE "+schema+"."+table+" "
+            + ", ".join("DROP CONSTRAINT IF EXISTS "+table+"_"+brch+ext+"_fkey"
+                        for brch in branches for ext in ["_parent", "_child"]),
+            "CREATE TABLE "+history+"."+table+" "
+            "(CHECK (trunk_rev_end IS NOT NULL)) "
+            "INHERITS ("+schema+"."+table+")",
+            "ALTER TABLE "+history+"."+table+" "
+            "ADD PRIMARY KEY (versioning_id)",
+            "WITH moved AS (DELETE FROM ONLY "+schema+"."+table+" "
+            "WHERE trunk_rev_end IS NOT NULL RETURNING *) "
+            "INSERT INTO "+history+"."+table+" SELECT * FROM moved",
+            "ALTER TABLE "+history+"."+table+" "
+            + ", ".join("ADD CONSTRAINT "+table+"_"+brch+ext+"_fkey "
+                        "FOREIGN KEY ("+brch+ext+") "
+                        "REFERENCES "+schema+".revisions(rev)"
+                        for brch in branches
+                        for ext in ["_rev_begin", "_rev_end"]),
+            "CREATE OR REPLACE FUNCTION "+schema+"."+table+"_to_history() "
+            "RETURNS trigger AS $$ "
+            "BEGIN "
+            "INSERT INTO "+history+"."+table+" SELECT NEW.*; "
+            "DELETE FROM ONLY "+schema+"."+table+" "
+            "WHERE versioning_id = NEW.versioning_id; "
+            "RETURN NULL; "
+            "END; "
+            "$$ LANGUAGE plpgsql",
+            "CREATE TRIGGER "+table+"_to_history "
+            "AFTER UPDATE OF trunk_rev_end ON "+schema+"."+table+" "
+            "FOR EACH ROW WHEN (OLD.trunk_rev_end IS NULL "
+            "AND NEW.trunk_rev_end IS NOT NULL) "
+            "EXECUTE PROCEDURE "+schema+"."+table+"_to_history()"]
+        pcur.execute(";\n".join(statements))
+        for brch in branches:
+            createIndex(pcur, history, table, brch)
+        pcur.execute("ANALYZE "+schema+"."+table)
+    pcur.commit()
+    pcur.close()
+
+
+def install_functions(pg_conn_info, schema, pool=None):
+    """Create (or replace) in schema the functions updating and committing
+    postgres working copies on the server, done by historize. They are used
+    by pgServer update and commit when VERSIONING_SERVER_FUNCTIONS=1"""
+    pcur = utils.pg_connect(pg_conn_info, pool)
+
+    sql_file = open(os.path.join(sql_path, 'functions.sql'), 'r')
+    sql = sql_file.read()
+    sql_file.close()
+    pcur.execute(sql.format(schema=schema,
+                            version=utils.SERVER_FUNCTIONS_VERSION))
+
+    pcur.commit()
+    pcur.close()
+
+
+def branch_indexes(table, branch, geometries=()):
+    """Returns the (name, columns, predicate, method, queries) of the indexes
+    of a versioned table needed by the queries of the branch, predicate is
+    the WHERE clause of partial indexes, None for the other ones, method is
+    None for btree indexes. The head rows of the geometries columns get a
+    partial GiST index"""
+    head = branch+"_rev_end IS NULL AND "+branch+"_rev_begin IS NOT NULL"
+    return [
+        ("idx_rev_"+table+"_"+branch+"_head", ["versioning_id"], head, None,
+         "head views, checkout and commit of the "+branch+" rows"),
+        ("idx_rev_"+table+"_"+branch+"_rev",
+         [branch+"_rev_begin", branch+"_rev_end"], None, None,
+         "rev_view_str, diff_rev_view_str and working copy updates"),
+        ("idx_rev_"+table+"_"+branch+"_rev_end", [branch+"_rev_end"], None,
+         None, "working copy updates and archive"),
+        ("idx_rev_"+table+"_"+branch+"_parent", [branch+"_parent"], None,
+         None, "foreign key and conflict resolution"),
+        ("idx_rev_"+table+"_"+branch+"_child", [branch+"_child"], None, None,
+         "foreign key, conflict resolution and archive")] + [
+        ("idx_rev_"+table+"_"+branch+"_head_"+geom, [geom], head, 'gist',
+         "spatial filters of the head views and pgServer working copies")
+        for geom in geometries]
+
+
+def index_sql(schema, table, name, columns, predicate, method=None,
+              concurrently=False):
+    """Returns the CREATE INDEX statement of an index of branch_indexes"""
+    return ("CREATE INDEX "+("CONCURRENTLY " if concurrently else "")
+            + "IF NOT EXISTS "+name+" ON "+schema+"."+table+" "
+            + ("USING "+method+" " if method else "")
+            + "("+", ".join(columns)+")"
+            + (" WHERE "+predicate if predicate else ""))
 
 
 def createIndex(pcur, schema, table, branch):
     """ create index on columns used for versinoning"""
-    for ext in ["_rev_begin", "_rev_end", "_parent", "_child"]:
-        query = "CREATE INDEX IF NOT EXISTS idx_rev_%s%s ON %s.%s (%s%s)"
-        data = (table, ext, schema, table, branch, ext)
-        pcur.execute(query % data)
-            
+    pcur.execute(";\n".join(
+        index_sql(schema, table, name, columns, predicate, method)
+        for name, columns, predicate, method, _ in branch_indexes(
+            table, branch, utils.pg_geoms(pcur, schema, table))))
+
+
+def advise_indexes(pg_conn_info, schema, pool=None):
+    """Compares the indexes of the versioned tables of schema with the
+    ones needed by the queries of each branch (see branch_indexes).
+
+    Returns a list of (table, status, sql, queries) where status is
+    'present' for an existing index matching the columns and predicate of a
+    needed one, sql being its definition, 'missing' for a needed index not
+    found, sql being its CREATE INDEX statement, 'invalid' for a needed
+    index left invalid by a failed or cancelled CREATE INDEX CONCURRENTLY,
+    sql being its DROP INDEX and CREATE INDEX statements, or 'redundant' for
+    an index on versioning columns only whose columns start another index,
+    sql being its definition. queries tells which queries use the index"""
+    pcur = utils.pg_connect(pg_conn_info, pool)
+
+    def normalized(predicate):
+        return re.sub(r'[\s()]', '', predicate or '').lower()
+
+    pcur.execute("""
+        SELECT c.relname, i.relname, x.indisunique, x.indisvalid, am.amname,
+            array_agg(a.attname::text ORDER BY k.ord),
+            pg_get_expr(x.indpred, x.indrelid), pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class c ON c.oid = x.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        JOIN LATERAL unnest(x.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+            ON true
+        JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k.attnum
+        WHERE n.nspname = '"""+schema+"""'
+        GROUP BY c.relname, i.relname, x.indisunique, x.indisvalid,
+            am.amname, x.indpred, x.indrelid, x.indexrelid""")
+    existing = defaultdict(list)
+    invalid = defaultdict(list)
+    for table, name, unique, valid, method, columns, predicate, sql \
+            in pcur.fetchall():
+        if valid:
+            existing[table].append(
+                (unique, method, columns, normalized(predicate), sql))
+        else:
+            invalid[table].append(name)
+
+    branches = utils.pg_branches(pcur, schema)
+    versioning_columns = set(sum([
+        [brch+'_rev_end', brch+'_rev_begin', brch+'_child', brch+'_parent']
+        for brch in branches], []))
+
+    advice = []
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
+        if table in ('revisions', 'versioning_constraints'):
+            continue
+        columns = utils.pg_column_names(pcur, schema, table)
+        geometries = utils.pg_geoms(pcur, schema, table)
+        needed = sum([branch_indexes(table, brch, geometries)
+                      for brch in branches
+                      if brch+"_rev_begin" in columns], [])
+        for name, cols, predicate, method, queries in needed:
+            found = [sql for _, imethod, icols, ipredicate, sql
+                     in existing[table]
+                     if icols == cols and imethod == (method or 'btree')
+                     and ipredicate == normalized(predicate)]
+            if found:
+                advice.append((table, 'present', found[0], queries))
+            elif name in invalid[table]:
+                advice.append((table, 'invalid',
+                    "DROP INDEX IF EXISTS "+schema+"."+name+";\n"
+                    + index_sql(schema, table, name, cols, predicate, method),
+                    queries))
+            else:
+                advice.append((table, 'missing', index_sql(
+                    schema, table, name, cols, predicate, method), queries))
+        for unique, _, icols, ipredicate, sql in existing[table]:
+            if (unique or ipredicate
+                    or not set(icols) <= versioning_columns):
+                continue
+            longer = [queries for _, cols, predicate, _, queries in needed
+                      if not predicate and len(cols) > len(icols)
+                      and cols[:len(icols)] == icols]
+            if longer:
+                advice.append((table, 'redundant', sql, longer[0]))
+    pcur.close()
+    return advice
+
+
+def create_indexes(pg_conn_info, schema, drop_redundant=False, workers=4):
+    """Creates the indexes reported missing by advise_indexes with CREATE
+    INDEX CONCURRENTLY, which does not lock the tables against writes,
+    rebuilds the ones left invalid by a failed build, and drops the
+    redundant ones if drop_redundant. The indexes of up to
+    workers tables are built in parallel, each table by its own connection.
+    Returns the executed statements"""
+    statements = defaultdict(list)
+    for table, status, sql, _ in advise_indexes(pg_conn_info, schema):
+        if status == 'missing':
+            statements[table].append(
+                sql.replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1))
+        elif status == 'invalid':
+            # IF NOT EXISTS would skip the invalid index, drop it first
+            statements[table] += [
+                stmt.replace("DROP INDEX ", "DROP INDEX CONCURRENTLY ", 1)
+                .replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1)
+                for stmt in sql.split(";\n")]
+        elif status == 'redundant' and drop_redundant:
+            name = re.match(r'CREATE INDEX (\S+) ', sql).group(1)
+            statements[table].append(
+                "DROP INDEX CONCURRENTLY IF EXISTS "+schema+"."+name)
+
+    def build(table):
+        # concurrent builds cannot run in a transaction
+        pcur = utils.Db(psycopg2.connect(pg_conn_info))
+        pcur.con.autocommit = True
+        try:
+            for sql in statements[table]:
+                pcur.execute(sql)
+        finally:
+            pcur.close()
+
+    utils.run_parallel(build, [(table,) for table in statements], workers)
+    return sum(statements.values(), [])
+
+
 def add_branch( pg_conn_info, schema, branch, commit_msg,
-        base_branch='trunk', base_rev='head' ):
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+        base_branch='trunk', base_rev='head', pool=None ):
+    """Create branch from base_branch at base_rev ('head' for its last
+    revision) in the versioned schema.
+
+    The branch columns are added with the branch revision as a constant
+    default, so that postgres (11 or later) does not rewrite the tables, and
+    the rows that are not in the base branch are then set to NULL. Their
+    foreign keys are created NOT VALID and validated once the new columns are
+    committed, and the indexes are built after the columns are filled."""
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     # check that branch doesn't exist and that base_branch exists
     # and that base_rev is ok
@@ -100,9 +365,10 @@ def add_branch( pg_conn_info, schema, branch, commit_msg,
         raise RuntimeError("Revision "+str(base_rev)+" doesn't exist")
     if DEBUG:
         print('max rev = ', max_rev)
+    branch_rev = max_rev + 1
 
     pcur.execute("INSERT INTO "+schema+".revisions(rev, branch, commit_msg ) "
-                 "VALUES ("+str(max_rev+1)+", '"+branch+"', '" + utils.escape_quote(commit_msg)+"')")
+                 "VALUES ("+str(branch_rev)+", '"+branch+"', '" + utils.escape_quote(commit_msg)+"')")
     pcur.execute("CREATE SCHEMA "+schema+"_"+branch+"_rev_head")
 
     history_columns = sum([
@@ -116,47 +382,70 @@ def add_branch( pg_conn_info, schema, branch, commit_msg,
     if mtch and int(mtch.group(1)) <= 9 and int(mtch.group(2)) <= 2:
         security = ''
 
+    # rows that are not part of the base branch at base_rev
+    if branch == 'trunk':  # initial versioning
+        not_in_base = None
+    elif base_rev == "head":
+        not_in_base = (base_branch+"_rev_begin IS NULL "
+                       "OR "+base_branch+"_rev_end IS NOT NULL")
+    else:
+        not_in_base = (base_branch+"_rev_begin IS NULL "
+                       "OR "+base_branch+"_rev_end <= "+str(base_rev))
+
+    # the parent and child of a row may be in different tables if the
+    # history is partitioned, see partition_history
+    history = schema+"_history"
+    partitioned = utils.pg_tables(pcur, history, base_tables=True)
+
     # note: do not version views
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-                 "WHERE table_schema = '"+schema+"' "
-                 "AND table_type = 'BASE TABLE'")
-    for [table] in pcur.fetchall():
+    foreign_keys = []
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
         if table in ('revisions', 'versioning_constraints'):
             continue
 
-        pcur.execute("""ALTER TABLE {schema}.{table}
-        ADD COLUMN {branch}_rev_begin integer REFERENCES {schema}.revisions(rev),
-        ADD COLUMN {branch}_rev_end   integer REFERENCES {schema}.revisions(rev),
-        ADD COLUMN {branch}_parent    integer REFERENCES {schema}.{table}(versioning_id),
-        ADD COLUMN {branch}_child     integer REFERENCES {schema}.{table}(versioning_id)""".format(
-            schema=schema, branch=branch, table=table))
+        references = [('_rev_begin', 'revisions(rev)'),
+                      ('_rev_end', 'revisions(rev)')]
+        if table not in partitioned:
+            references += [('_parent', table+'(versioning_id)'),
+                           ('_child', table+'(versioning_id)')]
+        fkeys = [(table, table+"_"+branch+ext+"_fkey")
+                 for ext, _ in references]
+        foreign_keys += [(schema+"."+table, fkey) for _, fkey in fkeys]
+
+        statements = [
+            "ALTER TABLE "+schema+"."+table+" "
+            "ADD COLUMN "+branch+"_rev_begin integer "
+            "DEFAULT "+str(branch_rev)+", "
+            "ADD COLUMN "+branch+"_rev_end integer, "
+            "ADD COLUMN "+branch+"_parent integer, "
+            "ADD COLUMN "+branch+"_child integer, "
+            + ", ".join(
+                "ADD CONSTRAINT "+fkey+" FOREIGN KEY ("+branch+ext+") "
+                "REFERENCES "+schema+"."+target+" NOT VALID"
+                for (ext, target), (_, fkey) in zip(references, fkeys)),
+            "ALTER TABLE "+schema+"."+table+" "
+            "ALTER COLUMN "+branch+"_rev_begin DROP DEFAULT"]
+        if table in partitioned:
+            # foreign keys are not inherited by the history table
+            statements.append(
+                "ALTER TABLE "+history+"."+table+" "
+                + ", ".join(
+                    "ADD CONSTRAINT "+fkey+" FOREIGN KEY ("+branch+ext+") "
+                    "REFERENCES "+schema+"."+target+" NOT VALID"
+                    for (ext, target), (_, fkey) in zip(references, fkeys)))
+            foreign_keys += [(history+"."+table, fkey) for _, fkey in fkeys]
+        if not_in_base:
+            statements.append("UPDATE "+schema+"."+table+" "
+                              "SET "+branch+"_rev_begin = NULL "
+                              "WHERE "+not_in_base)
+        pcur.execute(";\n".join(statements))
 
         createIndex(pcur, schema, table, branch)
+        if table in partitioned:
+            createIndex(pcur, history, table, branch)
 
-        if branch == 'trunk':  # initial versioning
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                         "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                         "FROM "+schema+".revisions)")
-        elif base_rev == "head":
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                         "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                         "FROM "+schema+".revisions "
-                         "WHERE "+base_branch+"_rev_end IS NULL "
-                         "AND "+base_branch+"_rev_begin IS NOT NULL)")
-        else:
-            pcur.execute("UPDATE "+schema+"."+table+" "
-                         "SET "+branch+"_rev_begin = (SELECT MAX(rev) "
-                         "FROM "+schema+".revisions)"
-                         "WHERE ("+base_branch+"_rev_end IS NULL "
-                         "OR "+base_branch+"_rev_end > "+base_rev+") "
-                         "AND "+base_branch+"_rev_begin IS NOT NULL")
-
-        pcur.execute("SELECT column_name "
-                     "FROM information_schema.columns "
-                     "WHERE table_schema = '"+schema+"' "
-                     "AND table_name = '"+table+"'")
         cols = ""
-        for [col] in pcur.fetchall():
+        for col in utils.pg_column_names(pcur, schema, table):
             if col not in history_columns:
                 cols = utils.quote_ident(col)+", "+cols
         cols = cols[:-2]  # remove last coma and space
@@ -166,17 +455,26 @@ def add_branch( pg_conn_info, schema, branch, commit_msg,
                      "WHERE "+branch+"_rev_end IS NULL "
                      "AND "+branch+"_rev_begin IS NOT NULL")
     pcur.commit()
+    utils.invalidate_catalog(pcur, schema)
+
+    # the validation does not prevent the tables from being read or written
+    if foreign_keys:
+        pcur.execute(";\n".join(
+            "ALTER TABLE "+table+" VALIDATE CONSTRAINT "+fkey
+            for table, fkey in foreign_keys))
+        pcur.commit()
     pcur.close()
 
 
-def diff_rev_view_str(pg_conn_info, schema, table, branch, rev_begin, rev_end):
+def diff_rev_view_str(pg_conn_info, schema, table, branch, rev_begin, rev_end,
+                      pool=None):
     """DIFFerence_REVision_VIEW_STRing
     Create the SQL view string of the specified revision difference (comparison).
     """
     rev_begin = str(rev_begin)
     rev_end = str(rev_end)
 
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     pcur.execute("SELECT * FROM "+schema+".revisions "
                  "WHERE branch = '"+branch+"'")
@@ -228,12 +526,12 @@ def diff_rev_view_str(pg_conn_info, schema, table, branch, rev_begin, rev_end):
     return select_str
 
 
-def rev_view_str(pg_conn_info, schema, table, branch, rev):
+def rev_view_str(pg_conn_info, schema, table, branch, rev, pool=None):
     """REVision_VIEW_STRing
     Create the SQL view string of the specified revision.
     Replaces add_revision_view()
     """
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     pcur.execute("SELECT * FROM "+schema+".revisions "
                  "WHERE branch = '"+branch+"'")
@@ -255,11 +553,11 @@ def rev_view_str(pg_conn_info, schema, table, branch, rev):
     return select_str, where_str
 
 
-def add_revision_view(pg_conn_info, schema, branch, rev):
+def add_revision_view(pg_conn_info, schema, branch, rev, pool=None):
     """Create schema with views of the specified revision.
     Deprecated as of version 0.5.
     """
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     pcur.execute("SELECT * FROM "+schema+".revisions "
                  "WHERE branch = '"+branch+"'")
@@ -278,11 +576,10 @@ def add_revision_view(pg_conn_info, schema, branch, rev):
 
     rev_schema = schema+"_"+branch+"_rev_"+str(rev)
 
-    pcur.execute("SELECT schema_name FROM information_schema.schemata "
-                 "WHERE schema_name = '"+rev_schema+"'")
-    if pcur.fetchone():
+    if utils.pg_schema_exists(pcur, rev_schema):
         if DEBUG:
             print(rev_schema, ' already exists')
+        pcur.close()
         return
 
     security = ' WITH (security_barrier)'
@@ -294,19 +591,11 @@ def add_revision_view(pg_conn_info, schema, branch, rev):
 
     pcur.execute("CREATE SCHEMA "+rev_schema)
 
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-                 "WHERE table_schema = '"+schema+"' "
-                 "AND table_type = 'BASE TABLE'")
-
-    for [table] in pcur.fetchall():
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
         if table in ('revisions', 'versioning_constraints'):
             continue
-        pcur.execute("SELECT column_name "
-                     "FROM information_schema.columns "
-                     "WHERE table_schema = '"+schema+"' "
-                     "AND table_name = '"+table+"'")
         cols = ""
-        for [col] in pcur.fetchall():
+        for col in utils.pg_column_names(pcur, schema, table):
             if col not in history_columns:
                 cols = utils.quote_ident(col)+", "+cols
         cols = cols[:-2]  # remove last coma and space
@@ -320,9 +609,133 @@ def add_revision_view(pg_conn_info, schema, branch, rev):
     pcur.close()
 
 
-def revisions(pg_conn_info, schema):
+# revision snapshots kept per versioned schema by materialize_revision
+SNAPSHOTS_KEPT = 5
+
+
+def materialize_revision(pg_conn_info, schema, branch, rev, pool=None,
+                         keep=None):
+    """Create the tables of the state of branch at revision rev, with a
+    primary key and spatial indexes, in the {schema}_{branch}_snapshot_{rev}
+    schema and return its name. An existing snapshot is reused.
+
+    The snapshot is built from the closest older snapshot of the branch if
+    any, by removing the rows ended since and adding the ones begun since,
+    otherwise from the history. The snapshots are listed in the
+    {schema}_snapshots.snapshots table, only the keep (SNAPSHOTS_KEPT by
+    default) most recently used ones are kept"""
+    keep = int(keep or SNAPSHOTS_KEPT)
+    rev = int(rev)
+    pcur = utils.pg_connect(pg_conn_info, pool)
+
+    pcur.execute("SELECT * FROM "+schema+".revisions "
+                 "WHERE branch = '"+branch+"'")
+    if not pcur.fetchone():
+        pcur.close()
+        raise RuntimeError("Branch "+branch+" doesn't exist")
+    pcur.execute("SELECT MAX(rev) FROM "+schema+".revisions")
+    [max_rev] = pcur.fetchone()
+    if rev > max_rev or rev <= 0:
+        pcur.close()
+        raise RuntimeError("Revision "+str(rev)+" doesn't exist")
+
+    registry = schema+"_snapshots.snapshots"
+    pcur.execute("CREATE SCHEMA IF NOT EXISTS "+schema+"_snapshots;\n"
+                 "CREATE TABLE IF NOT EXISTS "+registry+" ("
+                 "branch varchar, "
+                 "rev integer, "
+                 "last_used timestamp, "
+                 "PRIMARY KEY (branch, rev))")
+    snapshot = schema+"_"+branch+"_snapshot_"+str(rev)
+    pcur.execute("UPDATE "+registry+" SET last_used = clock_timestamp() "
+                 "WHERE branch = '"+branch+"' AND rev = "+str(rev)+" "
+                 "RETURNING rev")
+    if pcur.fetchone():
+        pcur.commit()
+        pcur.close()
+        return snapshot
+
+    pcur.execute("SELECT MAX(rev) FROM "+registry+" "
+                 "WHERE branch = '"+branch+"' AND rev < "+str(rev))
+    [base_rev] = pcur.fetchone()
+    base = schema+"_"+branch+"_snapshot_"+str(base_rev) if base_rev else None
+    base_tables = utils.pg_tables(pcur, base, base_tables=True) if base else []
+
+    history_columns = sum([
+        [brch+'_rev_end', brch+'_rev_begin',
+         brch+'_child', brch+'_parent'] for brch in utils.pg_branches(pcur, schema)], [])
+
+    pcur.execute("CREATE SCHEMA "+snapshot)
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
+        if table in ('revisions', 'versioning_constraints'):
+            continue
+        cols = ", ".join(utils.quote_ident(col)
+                         for col in utils.pg_column_names(pcur, schema, table)
+                         if col not in history_columns)
+        if table in base_tables:
+            statements = [
+                "CREATE TABLE "+snapshot+"."+table+" AS "
+                "SELECT * FROM "+base+"."+table,
+                "DELETE FROM "+snapshot+"."+table+" "
+                "WHERE versioning_id IN (SELECT versioning_id "
+                "FROM "+schema+"."+table+" "
+                "WHERE "+branch+"_rev_end >= "+str(base_rev)+" "
+                "AND "+branch+"_rev_end < "+str(rev)+")",
+                "INSERT INTO "+snapshot+"."+table+" ("+cols+") "
+                "SELECT "+cols+" FROM "+schema+"."+table+" "
+                "WHERE "+branch+"_rev_begin > "+str(base_rev)+" "
+                "AND "+branch+"_rev_begin <= "+str(rev)+" "
+                "AND ("+branch+"_rev_end IS NULL "
+                "OR "+branch+"_rev_end >= "+str(rev)+")"]
+        else:
+            statements = [
+                "CREATE TABLE "+snapshot+"."+table+" AS "
+                "SELECT "+cols+" FROM "+schema+"."+table+" "
+                "WHERE ("+branch+"_rev_end IS NULL "
+                "OR "+branch+"_rev_end >= "+str(rev)+") "
+                "AND "+branch+"_rev_begin <= "+str(rev)]
+        statements.append("ALTER TABLE "+snapshot+"."+table+" "
+                          "ADD PRIMARY KEY (versioning_id)")
+        statements += ["CREATE INDEX ON "+snapshot+"."+table+" "
+                       "USING gist ("+utils.quote_ident(geom)+")"
+                       for geom in utils.pg_geoms(pcur, schema, table)]
+        statements.append("ANALYZE "+snapshot+"."+table)
+        pcur.execute(";\n".join(statements))
+
+    pcur.execute("INSERT INTO "+registry+" (branch, rev, last_used) "
+                 "VALUES ('"+branch+"', "+str(rev)+", clock_timestamp())")
+
+    # least recently used snapshots
+    pcur.execute("SELECT branch, rev FROM "+registry+" "
+                 "ORDER BY last_used DESC OFFSET "+str(keep))
+    for old_branch, old_rev in pcur.fetchall():
+        pcur.execute("DROP SCHEMA "+schema+"_"+old_branch+"_snapshot_"
+                     + str(old_rev)+" CASCADE;\n"
+                     "DELETE FROM "+registry+" "
+                     "WHERE branch = '"+old_branch+"' AND rev = "+str(old_rev))
+    pcur.commit()
+    pcur.close()
+    return snapshot
+
+
+def snapshots(pg_conn_info, schema, pool=None):
+    """returns the (branch, rev, schema) of the revision snapshots of schema
+    (see materialize_revision), the most recently used first"""
+    pcur = utils.pg_connect(pg_conn_info, pool)
+    if not utils.pg_tables(pcur, schema+"_snapshots", like='snapshots'):
+        pcur.close()
+        return []
+    pcur.execute("SELECT branch, rev FROM "+schema+"_snapshots.snapshots "
+                 "ORDER BY last_used DESC")
+    res = [(branch, rev, schema+"_"+branch+"_snapshot_"+str(rev))
+           for branch, rev in pcur.fetchall()]
+    pcur.close()
+    return res
+
+
+def revisions(pg_conn_info, schema, pool=None):
     """returns a list of revisions for this schema"""
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
     pcur.execute("SELECT rev FROM "+schema+".revisions")
     revs = []
     for [res] in pcur.fetchall():
@@ -330,41 +743,55 @@ def revisions(pg_conn_info, schema):
     pcur.close()
     return revs
 
-def archive(pg_conn_info, schema, revision_end):
-    """Archiving tables from schema ended at revision_end"""
+# rows moved by each transaction of archive
+ARCHIVE_BATCH_SIZE = 10000
+
+
+def archive(pg_conn_info, schema, revision_end, pool=None, batch_size=None,
+            progress=None):
+    """Archiving tables from schema ended at revision_end
+
+    The rows are moved by batches of batch_size rows (ARCHIVE_BATCH_SIZE by
+    default), in (trunk_rev_end, pk) order so that parents are archived
+    before their children, each batch being committed with the last moved
+    key in the archive_progress table of the archive schema: an interrupted
+    archive resumes where it stopped when run again with the same
+    revision_end. progress(table, moved, total) is called after each batch
+    if given.
+
+    The rows of a table whose history is partitioned (see
+    partition_history) are read from and deleted in its history table only"""
+    batch_size = int(batch_size or ARCHIVE_BATCH_SIZE)
+    revision_end = int(revision_end)
 
-    pcur = Db(psycopg2.connect(pg_conn_info))
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     schema_archive= schema+'_archive'
     pcur.execute("CREATE SCHEMA IF NOT EXISTS {schema}".format(schema=schema_archive))
+    pcur.execute("""CREATE TABLE IF NOT EXISTS {schema}.archive_progress (
+                 table_name varchar PRIMARY KEY,
+                 revision_end integer,
+                 last_rev_end integer,
+                 last_pk integer)""".format(schema=schema_archive))
     pcur.commit()
     
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-        "WHERE table_schema = '"+schema+"' "
-        "AND table_type = 'BASE TABLE'")
-    
-    for [table] in pcur.fetchall():
+    archived = utils.pg_tables(pcur, schema_archive, base_tables=True)
+    partitioned = utils.pg_tables(pcur, schema+"_history", base_tables=True)
+
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
         if table in ('revisions', 'versioning_constraints'):
             continue
         
+        # the ended rows of a partitioned table are all in its history table
+        source = (schema+"_history." if table in partitioned
+                  else schema+".")+table
+
         pk = utils.pg_pk(pcur, schema, table)
         # get columns from table. ONLY revisionned table and 4 columns for revision can be used
-        pcur.execute("""WITH pos as (
-                    SELECT ordinal_position FROM information_schema.columns 
-                    WHERE table_schema = '{schema}' AND table_name = '{table}' and column_name = 'trunk_child'
-                    )
-                    SELECT column_name FROM information_schema.columns WHERE
-                    table_schema = '{schema}' AND table_name = '{table}' and ordinal_position <= (SELECT ordinal_position FROM pos)""".format(schema=schema, table=table))
-
-        colsall = ",".join([i[0] for i in pcur.fetchall()])
-        
-        pcur.execute("""SELECT EXISTS
-                     (SELECT 1 
-                     FROM information_schema.tables
-                     WHERE  table_schema = '{schema}' AND
-                     table_name = '{table}' )""".format(schema=schema_archive, table=table))
-        exists = pcur.fetchone()[0]
-        if not exists:
+        columns = utils.pg_column_names(pcur, schema, table)
+        colsall = ",".join(columns[:columns.index('trunk_child') + 1])
+
+        if table not in archived:
             sql = """CREATE TABLE {schemaarc}.{table} as SELECT {cols} FROM {schema}.{table} LIMIT 0""".format(schemaarc=schema_archive, schema=schema, table=table, cols=colsall)
             if DEBUG: 
                 print(sql)
@@ -377,13 +804,8 @@ def archive(pg_conn_info, schema, revision_end):
                         table=table))
             createIndex(pcur, schema, table, 'trunk')
             
-            pcur.execute("""WITH pos as (
-            SELECT ordinal_position FROM information_schema.columns 
-            WHERE table_schema = '{schema}' AND table_name = '{table}' and column_name = 'trunk_rev_begin'
-            )
-            SELECT column_name FROM information_schema.columns WHERE
-            table_schema = '{schema}' AND table_name = '{table}' and ordinal_position < (SELECT ordinal_position FROM pos)""".format(schema=schema, table=table))
-            colswithoutvcols = ",".join([i[0] for i in pcur.fetchall()])
+            colswithoutvcols = ",".join(
+                columns[:columns.index('trunk_rev_begin')])
             
             pcur.execute("""CREATE VIEW {schemaarc}.{table}_all as (WITH un as (
                         SELECT {colsall} FROM {schema}.{table}
@@ -395,37 +817,91 @@ def archive(pg_conn_info, schema, revision_end):
                         on a.trunk_child = {pk}
                         ORDER BY {pk})""".format(schema=schema,
                         schemaarc=schema_archive, table=table, colsall=colsall, colswithoutvcols=colswithoutvcols, pk=pk))
-        
-        pcur.execute("""INSERT INTO {schemaarc}.{table} ({cols}) (SELECT {cols} 
-                    FROM {schema}.{table} 
-                    WHERE trunk_rev_end <= {rev_number})""".format(schema=schema,
-                    schemaarc=schema_archive, table=table, rev_number=revision_end, cols=colsall))
-        
-        pcur.execute("""UPDATE {schema}.{table} 
-                    SET trunk_parent = NULL 
-                    WHERE {pk} IN (
-                    SELECT trunk_child 
-                    FROM {schema}.{table} 
-                    WHERE trunk_rev_end <= {rev_number})""".format(
-                    schema=schema,
-                    table=table, 
+            pcur.commit()
+
+        # resume after the last batch of an interrupted archive
+        pcur.execute("""SELECT last_rev_end, last_pk FROM {schemaarc}.archive_progress
+                    WHERE table_name = '{table}' AND revision_end = {rev_number}""".format(
+                    schemaarc=schema_archive, table=table, rev_number=revision_end))
+        last = pcur.fetchone() or (0, 0)
+
+        pcur.execute("""SELECT COUNT(*) FROM {source}
+                    WHERE trunk_rev_end <= {rev_number}""".format(
+                    source=source, rev_number=revision_end))
+        [total] = pcur.fetchone()
+        moved = 0
+
+        # the parent of a row archived after its parent was reset below,
+        # it is found back from the archived parent
+        archived_cols = ",".join(
+            "COALESCE(trunk_parent, (SELECT a.{pk} FROM {schemaarc}.{table} a "
+            "WHERE a.trunk_child = moved.{pk}))".format(
+                pk=pk, schemaarc=schema_archive, table=table)
+            if col == 'trunk_parent' else col
+            for col in colsall.split(","))
+
+        while True:
+            # the parents of the moved rows that are kept lose their parent,
+            # the rows are copied in the archive and deleted, the progress is
+            # saved with them
+            pcur.execute("""WITH moved AS (
+                        SELECT {cols} FROM {source}
+                        WHERE trunk_rev_end <= {rev_number}
+                        AND (trunk_rev_end, {pk}) > ({last_rev_end}, {last_pk})
+                        ORDER BY trunk_rev_end, {pk}
+                        LIMIT {batch_size}),
+                    ins AS (
+                        INSERT INTO {schemaarc}.{table} ({cols})
+                        SELECT {archived_cols} FROM moved),
+                    upd AS (
+                        UPDATE {schema}.{table} SET trunk_parent = NULL
+                        WHERE {pk} IN (SELECT trunk_child FROM moved)
+                        AND {pk} NOT IN (SELECT {pk} FROM moved)),
+                    del AS (
+                        DELETE FROM {source}
+                        WHERE {pk} IN (SELECT {pk} FROM moved)),
+                    last AS (
+                        SELECT trunk_rev_end, {pk} FROM moved
+                        ORDER BY trunk_rev_end DESC, {pk} DESC LIMIT 1),
+                    mark AS (
+                        INSERT INTO {schemaarc}.archive_progress
+                        SELECT '{table}', {rev_number}, trunk_rev_end, {pk}
+                        FROM last
+                        ON CONFLICT (table_name) DO UPDATE
+                        SET (revision_end, last_rev_end, last_pk)
+                        = (EXCLUDED.revision_end, EXCLUDED.last_rev_end,
+                        EXCLUDED.last_pk))
+                    SELECT COUNT(*), (SELECT trunk_rev_end FROM last),
+                    (SELECT {pk} FROM last) FROM moved""".format(
+                    schema=schema, schemaarc=schema_archive, table=table,
+                    source=source, cols=colsall, archived_cols=archived_cols,
+                    pk=pk,
                     rev_number=revision_end,
-                    pk=pk))
-        pcur.execute("""DELETE FROM {schema}.{table} WHERE trunk_rev_end <= {rev_number}""".format(schema=schema,
-                    table=table, rev_number=revision_end))
-    pcur.commit()
+                    last_rev_end=last[0], last_pk=last[1],
+                    batch_size=batch_size))
+            [count, last_rev_end, last_pk] = pcur.fetchone()
+            pcur.commit()
+            if not count:
+                break
+            last = (last_rev_end, last_pk)
+            moved += count
+            if DEBUG:
+                print("archived", moved, "/", total, "rows of", table)
+            if progress:
+                progress(table, moved, total)
+
+        pcur.execute("""DELETE FROM {schemaarc}.archive_progress
+                    WHERE table_name = '{table}'""".format(
+                    schemaarc=schema_archive, table=table))
+        pcur.commit()
     pcur.close()
         
-def merge(pg_conn_info, schema, branch_name):
+def merge(pg_conn_info, schema, branch_name, pool=None):
     """merge the branch into trunk of schema"""
-    pcur = utils.Db(psycopg2.connect(pg_conn_info))
-
-    pcur.execute("SELECT table_name FROM information_schema.tables "
-                 "WHERE table_schema = '"+schema+"' "
-                 "AND table_type = 'BASE TABLE'")
+    pcur = utils.pg_connect(pg_conn_info, pool)
 
     total = 0
-    for [table] in pcur.fetchall():
+    for table in utils.pg_tables(pcur, schema, base_tables=True):
         if table in ('revisions', 'versioning_constraints'):
             continue
         
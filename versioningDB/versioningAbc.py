@@ -5,13 +5,15 @@ from __future__ import absolute_import
 from .postgresqlServer import pgVersioningServer
 from .spatialite import spVersioning
 from .postgresqlLocal import pgVersioningLocal
+from .transfer import get_transfer
+from .utils import ConnectionPool
 
 TYPE = ('postgres', 'spatialite', 'pgDistant')
 CONNECTIONS = {'postgres': 2, 'spatialite': 2, 'pgDistant': 3}
 
 class versioningAbc(object):
     
-    def __init__(self, connection, typebase):
+    def __init__(self, connection, typebase, transfer=None):
         assert(isinstance(connection, list) and 
                typebase in TYPE and
                len(connection) == CONNECTIONS[typebase])
@@ -21,24 +23,44 @@ class versioningAbc(object):
         # postgres : [pg_conn_info, working_copy_schema]
         # pgDistant : [pg_conn_info, working_copy_schema, pg_conn_info_out]
         self.connection = connection
+        # transfer : engine name used to copy tables to and from the working
+        # copy, see transfer.get_transfer
+        # pool : postgres connections shared by all operations, it can be
+        # passed to the functions of the versioning module, call close() or
+        # use a with statement to close them
+        self.pool = ConnectionPool()
         if self.typebase == 'spatialite':
-            self.ver = spVersioning()
+            self.ver = spVersioning(get_transfer(transfer), self.pool)
         elif self.typebase == 'pgDistant':
-            self.ver = pgVersioningLocal()
+            self.ver = pgVersioningLocal(get_transfer(transfer), self.pool)
         else:
-            self.ver = pgVersioningServer()
-            
+            self.ver = pgVersioningServer(self.pool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the postgres connections kept open by this object"""
+        self.pool.close()
+
     def revision(self):
         return self.ver.revision(self.connection)
     
-    def late(self ):
-        return self.ver.late(self.connection)
+    def late(self, detail=False):
+        return self.ver.late(self.connection, detail)
     
     def update(self):
         self.ver.update(self.connection)
     
-    def checkout(self, pg_table_names, selected_feature_lists = []):
-        self.ver.checkout(self.connection, pg_table_names, selected_feature_lists)
+    def checkout(self, pg_table_names, selected_feature_lists = [],
+                 workers=None):
+        # workers : number of tables copied concurrently, see
+        # utils.checkout_workers
+        self.ver.checkout(self.connection, pg_table_names,
+                          selected_feature_lists, workers)
     
     def unresolved_conflicts(self):
         return self.ver.unresolved_conflicts(self.connection)